@@ -14,3 +14,11 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bigquery_query_builder.settings')
 
 application = get_asgi_application()
+
+# Before the first request, import the BigQuery modules, create the shared client and fetch its token in
+# the background, and warm the result cache with the most requested queries, again whenever the tables are
+# refreshed. Pre-forking servers that load the application in the master turn off STARTUP['WARM_UP_ON_IMPORT']
+# and warm up each worker instead, e.g. with the startup.post_fork hook of gunicorn.
+from query_builder_backend.startup import warm_up_on_import
+
+warm_up_on_import()
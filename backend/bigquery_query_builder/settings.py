@@ -10,12 +10,10 @@ CONFIG_PATH = os.path.join(BASE_DIR, 'config.json')
 # See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
 
 # SECURITY WARNING: keep the secret key used in production secret!
-import json
+# config.json is parsed once per process, the BigQuery endpoints reuse the same copy
+from query_builder_backend.projectConfig import read_config
 
-# Step 1: Open the file
-with open('./config.json', 'r') as file:
-    # Step 2: Load JSON data
-    data = json.load(file)
+data = read_config(CONFIG_PATH)
 SECRET_KEY = data.get('django-key')
 
 # SECURITY WARNING: don't run with debug turned on in production!
@@ -30,19 +28,23 @@ CORS_ORIGIN_WHITELIST = [
 INSTALLED_APPS = [
     'corsheaders',
     'query_builder_backend',
-    'google.cloud',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 ]
 
 
 MIDDLEWARE = [
+    # Times the whole request, so it runs first
+    'query_builder_backend.queryMetrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    # Compresses the response bodies, so it runs after every middleware that changes them
+    'query_builder_backend.responseCompression.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -54,6 +56,19 @@ MIDDLEWARE = [
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:9000", 
 ]
+# Let the frontend read the pagination, saved query snapshot, granularity and validator headers
+CORS_EXPOSE_HEADERS = [
+    'X-Next-Cursor',
+    'Link',
+    'X-Snapshot-Status',
+    'X-Snapshot-Executed-At',
+    'X-Snapshot-Row-Count',
+    'X-Snapshot-Execution-Seconds',
+    'X-BigQuery-Bytes-Processed',
+    'X-Granularity',
+    'ETag',
+    'Last-Modified',
+]
 ALLOWED_HOSTS = ['127.0.0.1', 'localhost']
 
 
@@ -135,3 +150,215 @@ STATIC_URL = '/static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# The DRF views encode their JSON with orjson when it is installed
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'query_builder_backend.fastJson.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
+# Compression of the responses
+# Bodies of at least MIN_SIZE bytes are compressed with brotli (if the brotli package is installed)
+# or gzip, whichever the client accepts, at BROTLI_QUALITY or GZIP_LEVEL.
+
+RESPONSE_COMPRESSION = {
+    'MIN_SIZE': 200,
+    'GZIP_LEVEL': 6,
+    'BROTLI_QUALITY': 5,
+}
+
+# Keyset pagination of the database endpoints
+# Pages have DB_PAGE_SIZE rows unless ?limit= asks for another size, up to DB_MAX_PAGE_SIZE.
+
+DB_PAGE_SIZE = 100
+DB_MAX_PAGE_SIZE = 500
+
+# Bulk endpoints: items are written BATCH_SIZE at a time, one transaction per batch,
+# and a request may have up to MAX_ITEMS items and a body of up to MAX_BODY_SIZE bytes.
+# The other endpoints keep the DATA_UPLOAD_MAX_MEMORY_SIZE limit of Django.
+
+BULK_INGEST = {
+    'BATCH_SIZE': 500,
+    'MAX_ITEMS': 50000,
+    'MAX_BODY_SIZE': 32 * 1024 * 1024,
+}
+
+# Text search configuration of the saved query search (a PostgreSQL regconfig such as 'simple' or 'english')
+
+SEARCH_CONFIG = 'simple'
+
+# BigQuery result cache
+# BACKEND is 'lru' for an in-process cache, 'django' to use the Django cache ALIAS,
+# or the dotted path of a custom backend class.
+# Entries live for TIMEOUT seconds and are dropped earlier when the table's
+# MAX(refresh_date) moves forward, which is re-checked every BIGQUERY_METADATA['REFRESH_INTERVAL'] seconds.
+
+BIGQUERY_CACHE = {
+    'BACKEND': 'lru',
+    'MAX_ENTRIES': 1024,
+    'TIMEOUT': 60 * 60 * 24,
+    'ALIAS': 'default',
+}
+
+# Metadata of the trends tables (date bounds and countries), served from memory
+# and read again from the partition metadata every REFRESH_INTERVAL seconds.
+# When it cannot be read, the last one is served and read again ERROR_RETRY_INTERVAL seconds later.
+
+BIGQUERY_METADATA = {
+    'REFRESH_INTERVAL': 60 * 5,
+    'ERROR_RETRY_INTERVAL': 30,
+}
+
+# BigQuery cost guardrails
+# With DRY_RUN, every query is estimated first (estimates are cached per query shape) and
+# rejected if it would scan more than MAX_BYTES_PER_REQUEST bytes. The estimate is returned
+# in the X-BigQuery-Estimated-Bytes header. MAXIMUM_BYTES_BILLED caps every job on BigQuery.
+
+BIGQUERY_COST = {
+    'DRY_RUN': True,
+    'MAX_BYTES_PER_REQUEST': 5 * 1024 ** 3,
+    'MAXIMUM_BYTES_BILLED': 10 * 1024 ** 3,
+    'ESTIMATE_CACHE_SIZE': 1024,
+    'ESTIMATE_TIMEOUT': 60 * 60 * 24,
+}
+
+# Shared BigQuery client
+# Every thread uses one client whose HTTP session keeps up to POOL_SIZE connections open.
+# With WARM_ON_STARTUP the WSGI/ASGI entry points create it and fetch a token in the background.
+# FACTORY, the dotted path of a function returning a client, replaces the BigQuery client, e.g. with
+# a query_builder_backend.replayClient.ReplayClient to run without network access.
+
+BIGQUERY_CLIENT = {
+    'POOL_SIZE': 10,
+    'WARM_ON_STARTUP': True,
+    'FACTORY': None,
+}
+
+# Startup of the serving processes
+# google.cloud.bigquery, google-auth and pandas are imported on first use, so that management commands
+# and new containers start quickly. With PRELOAD the WSGI/ASGI entry points import them in the background
+# ahead of the first request. `python manage.py benchmark_startup` measures the startup time.
+# Turn WARM_UP_ON_IMPORT off when a pre-forking server loads the application in its master process
+# (gunicorn --preload), and warm up each worker with query_builder_backend.startup.post_fork instead.
+
+STARTUP = {
+    'PRELOAD': True,
+    'WARM_UP_ON_IMPORT': True,
+}
+
+# Instrumentation
+# With ENABLED, request latencies per endpoint and BigQuery job statistics (queue and execution
+# time, rows, bytes processed and billed), result cache hits and JSON encoding times are exported
+# in the Prometheus format at /metrics. With SERVER_TIMING, every response has a Server-Timing header.
+
+METRICS = {
+    'ENABLED': True,
+    'SERVER_TIMING': True,
+}
+
+# Warming of the BigQuery result cache
+# With TRACK, the requests of the ENDPOINTS are counted per URL and the counts are written to the
+# database every FLUSH_INTERVAL seconds. With SCHEDULER, every serving process checks the table
+# watermarks every CHECK_INTERVAL seconds and, when they move, runs the TOP_N most requested URLs
+# of the last WINDOW_DAYS again, MAX_CONCURRENCY at a time. The warm_trends_cache command does the
+# same from outside the server for a shared result cache.
+
+BIGQUERY_CACHE_WARMING = {
+    'TRACK': True,
+    'SCHEDULER': False,
+    'TOP_N': 50,
+    'WINDOW_DAYS': 7,
+    'MAX_CONCURRENCY': 4,
+    'CHECK_INTERVAL': 60 * 5,
+    'FLUSH_INTERVAL': 60,
+}
+
+# Bounded latency of the BigQuery endpoints
+# Each endpoint waits at most DEADLINE seconds on BigQuery, or the seconds of its URL name in DEADLINES,
+# and the jobs it abandons are cancelled. Retryable errors are retried RETRIES times after a random
+# delay of up to RETRY_BASE_DELAY * 2 ** attempt seconds (at most RETRY_MAX_DELAY). After BREAKER_FAILURES
+# consecutive timeouts or retryable errors, queries fail at once for BREAKER_RESET seconds. Failed queries
+# are answered with their last good results, kept STALE_TIMEOUT seconds, and an X-BigQuery-Stale header.
+
+BIGQUERY_RESILIENCE = {
+    'DEADLINE': 15,
+    'DEADLINES': {
+        'bigquery-top-terms-batch-endpoint': 30,
+        'bigquery-top-rising-terms-batch-endpoint': 30,
+        'bigquery-top-terms-analytics-endpoint': 30,
+        'bigquery-top-rising-terms-analytics-endpoint': 30,
+    },
+    'RETRIES': 2,
+    'RETRY_BASE_DELAY': 0.2,
+    'RETRY_MAX_DELAY': 2.0,
+    'BREAKER_FAILURES': 5,
+    'BREAKER_RESET': 30,
+    'STALE_TIMEOUT': 60 * 60 * 24 * 7,
+}
+
+# HTTP caching of the BigQuery endpoints
+# Responses have a strong ETag and a Last-Modified date from the table watermark, and may be
+# reused for MAX_AGE seconds, then served stale for STALE_WHILE_REVALIDATE more seconds while
+# they are revalidated. Conditional requests for unchanged data get a 304 without running the query.
+
+BIGQUERY_HTTP_CACHE = {
+    'MAX_AGE': 60 * 5,
+    'STALE_WHILE_REVALIDATE': 60 * 60 * 24,
+}
+
+# Rows requested from BigQuery per page when a response is streamed (?stream=json or ?stream=ndjson)
+
+BIGQUERY_STREAM_PAGE_SIZE = 10000
+
+# Download large results requested as ?format=arrow, ?format=columnar or ?format=compact with the BigQuery
+# Storage Read API (requires the google-cloud-bigquery-storage package)
+
+BIGQUERY_STORAGE_API = False
+
+# Async (ASGI) BigQuery endpoints
+# Blocking client calls run on a pool of MAX_WORKERS threads, and running jobs are
+# polled every POLL_INTERVAL seconds, doubling up to MAX_POLL_INTERVAL.
+
+BIGQUERY_ASYNC = {
+    'MAX_WORKERS': 8,
+    'POLL_INTERVAL': 0.05,
+    'MAX_POLL_INTERVAL': 1.0,
+}
+
+# BigQuery background jobs
+# Long date range queries can be queued with api/bigquery/jobs/submit/... MAX_WORKERS jobs run
+# at the same time, up to MAX_QUEUED more wait for a worker, and finished jobs are kept
+# RESULT_TTL seconds.
+
+BIGQUERY_JOBS = {
+    'MAX_WORKERS': 4,
+    'MAX_QUEUED': 100,
+    'RESULT_TTL': 60 * 60,
+}
+
+# Local mirror of the Google Trends tables, filled by `python manage.py sync_trends_mirror`
+# When ENABLED, the BigQuery endpoints answer from the mirror if it covers the requested dates.
+# The first sync copies the last INITIAL_DAYS days (None for the whole table), later syncs
+# only copy the new refresh_date partitions. Rows are written BATCH_SIZE at a time.
+
+TRENDS_MIRROR = {
+    'ENABLED': False,
+    'INITIAL_DAYS': 30,
+    'BATCH_SIZE': 5000,
+}
+
+# Weekly and monthly rollups of the Google Trends tables, filled by `python manage.py sync_trends_rollups`
+# When ENABLED, the range endpoints called with ?granularity=week, month or auto answer from the
+# rollups if they cover the requested range, and ask BigQuery for the same summary otherwise.
+# auto picks month for ranges of MONTHLY_MIN_DAYS days or more, week from WEEKLY_MIN_DAYS days,
+# and daily rows below. The first sync summarizes the last INITIAL_DAYS days.
+
+TRENDS_ROLLUPS = {
+    'ENABLED': False,
+    'INITIAL_DAYS': 365,
+    'BATCH_SIZE': 5000,
+    'WEEKLY_MIN_DAYS': 31,
+    'MONTHLY_MIN_DAYS': 180,
+}
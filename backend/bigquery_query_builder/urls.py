@@ -7,18 +7,42 @@ from django.contrib import admin
 from django.urls import path
 from query_builder_backend.bigQueryQueries import *
 from query_builder_backend.databaseQueries import *
+from query_builder_backend.asyncBigQueryQueries import *
+from query_builder_backend.queryMetrics import MetricsEndpoint
 
 urlpatterns = [
     path('admin/', admin.site.urls), # Django admin
-    path('api/db/post/query', QueryAdderEndpoint.as_view(), name='db-query-endpoint'), # Endpoint for adding queries to the database
+    path('metrics', MetricsEndpoint.as_view(), name='metrics-endpoint'), # Endpoint for getting the metrics of the process in the Prometheus format
+    path('api/db/post/query', QueryAdderEndpoint.as_view(), name='db-query-adder-endpoint'), # Endpoint for adding queries to the database
     path('api/db/post/comment/<str:query_id>/<str:username>/<str:comment>', CommentAdderEndpoint.as_view(), name='db-comment-endpoint'), # Endpoint for adding comments to the database
+    path('api/db/post/queries/bulk', QueryBulkAdderEndpoint.as_view(), name='db-queries-bulk-endpoint'), # Endpoint for adding many queries to the database
+    path('api/db/post/comments/bulk', CommentBulkAdderEndpoint.as_view(), name='db-comments-bulk-endpoint'), # Endpoint for adding many comments to the database
     path('api/db/get/queries', QueriesGetterEndpoint.as_view(), name='db-queries-endpoint'), # Endpoint for getting queries from the database
+    path('api/db/get/queries/search', QuerySearchEndpoint.as_view(), name='db-queries-search-endpoint'), # Endpoint for searching the queries of the database
     path('api/db/get/query/<int:query_id>', QueryGetterEndpoint.as_view(), name='db-query-endpoint'), # Endpoint for getting a query form the database
+    path('api/db/get/query/<int:query_id>/results', SavedQueryResultsEndpoint.as_view(), name='db-query-results-endpoint'), # Endpoint for getting the results of a saved query from its snapshot
     path('api/db/get/comments/<int:query_id>', CommentGetterEndpoint.as_view(), name='db-comments-endpoint'), # Endpoint for getting comments from a given query from the database
-    path('api/bigquery/get/top_terms_dates/<str:country_name>/<str:init_date>/<str:finish_date>', BigQueryTopTermsDate.as_view(), name='bigquery-top-terms-day-endpoint'), # Endpoint for getting top terms from a given country and date range from BigQuery
+    path('api/bigquery/get/top_terms_dates/<str:country_name>/<str:init_date>/<str:finish_date>', BigQueryTopTermsDate.as_view(), name='bigquery-top-terms-dates-endpoint'), # Endpoint for getting top terms from a given country and date range from BigQuery
     path('api/bigquery/get/top_terms_day/<str:country_name>/<str:date>', BigQueryTopTermsDay.as_view(), name='bigquery-top-terms-day-endpoint'), # Endpoint for getting top terms from a given country and date from BigQuery
     path('api/bigquery/get/top_rising_terms_dates/<str:country_name>/<str:init_date>/<str:finish_date>', BigQueryTopRisingTermsDates.as_view(), name='bigquery-top-rising-terms-date-endpoint'), # Endpoint for getting top rising terms from a given country and date range from BigQuery
     path('api/bigquery/get/top_rising_terms_day/<str:country_name>/<str:date>', BigQueryTopRisingTermsDay.as_view(), name='bigquery-top-rising-terms-day-endpoint'), # Endpoint for getting top rising terms from a given country and date from BigQuery
     path('api/bigquery/get/top_terms_interval_dates', BigQueryDateIntervalTopTerms.as_view(), name='bigquery-interval-date-top-terms-endpoint'), # Endpoint for getting the minimum and maximum date we have data for in the top terms table
     path('api/bigquery/get/top_rising_terms_interval_dates', BigQueryDateIntervalTopRisingTerms.as_view(), name='bigquery-interval-top-rising-terms-endpoint'), # Endpoint for getting the minimum and maximum date we have data for in the top rising terms table
+    path('api/bigquery/get/top_terms_countries', BigQueryCountriesTopTerms.as_view(), name='bigquery-countries-top-terms-endpoint'), # Endpoint for getting the countries with top terms on the latest refresh date
+    path('api/bigquery/get/top_rising_terms_countries', BigQueryCountriesTopRisingTerms.as_view(), name='bigquery-countries-top-rising-terms-endpoint'), # Endpoint for getting the countries with top rising terms on the latest refresh date
+    path('api/bigquery/get/top_terms_batch', BigQueryTopTermsBatch.as_view(), name='bigquery-top-terms-batch-endpoint'), # Endpoint for getting top terms from several countries and dates from BigQuery in one query
+    path('api/bigquery/get/top_rising_terms_batch', BigQueryTopRisingTermsBatch.as_view(), name='bigquery-top-rising-terms-batch-endpoint'), # Endpoint for getting top rising terms from several countries and dates from BigQuery in one query
+    path('api/bigquery/analytics/top_terms/<str:metric>', BigQueryTopTermsAnalytics.as_view(), name='bigquery-top-terms-analytics-endpoint'), # Endpoint for computing persistence and overlap metrics of the top terms of a date range
+    path('api/bigquery/analytics/top_rising_terms/<str:metric>', BigQueryTopRisingTermsAnalytics.as_view(), name='bigquery-top-rising-terms-analytics-endpoint'), # Endpoint for computing persistence and overlap metrics of the top rising terms of a date range
+    path('api/bigquery/get/client_stats', BigQueryClientStats.as_view(), name='bigquery-client-stats-endpoint'), # Endpoint for getting statistics about the shared BigQuery client and its connection pool
+    path('api/bigquery/jobs/submit/top_terms_dates/<str:country_name>/<str:init_date>/<str:finish_date>', BigQueryTopTermsDateJob.as_view(), name='bigquery-job-top-terms-dates-endpoint'), # Endpoint for queuing the top terms of a given country and date range as a background job
+    path('api/bigquery/jobs/submit/top_rising_terms_dates/<str:country_name>/<str:init_date>/<str:finish_date>', BigQueryTopRisingTermsDatesJob.as_view(), name='bigquery-job-top-rising-terms-dates-endpoint'), # Endpoint for queuing the top rising terms of a given country and date range as a background job
+    path('api/bigquery/jobs/<str:job_id>', BigQueryJobStatus.as_view(), name='bigquery-job-status-endpoint'), # Endpoint for getting the status and progress of a background job
+    path('api/bigquery/jobs/<str:job_id>/result', BigQueryJobResult.as_view(), name='bigquery-job-result-endpoint'), # Endpoint for getting the rows of a background job
+    path('api/bigquery/async/get/top_terms_dates/<str:country_name>/<str:init_date>/<str:finish_date>', AsyncBigQueryTopTermsDate.as_view(), name='bigquery-async-top-terms-dates-endpoint'), # Async endpoint for getting top terms from a given country and date range from BigQuery
+    path('api/bigquery/async/get/top_terms_day/<str:country_name>/<str:date>', AsyncBigQueryTopTermsDay.as_view(), name='bigquery-async-top-terms-day-endpoint'), # Async endpoint for getting top terms from a given country and date from BigQuery
+    path('api/bigquery/async/get/top_rising_terms_dates/<str:country_name>/<str:init_date>/<str:finish_date>', AsyncBigQueryTopRisingTermsDates.as_view(), name='bigquery-async-top-rising-terms-dates-endpoint'), # Async endpoint for getting top rising terms from a given country and date range from BigQuery
+    path('api/bigquery/async/get/top_rising_terms_day/<str:country_name>/<str:date>', AsyncBigQueryTopRisingTermsDay.as_view(), name='bigquery-async-top-rising-terms-day-endpoint'), # Async endpoint for getting top rising terms from a given country and date from BigQuery
+    path('api/bigquery/async/get/top_terms_interval_dates', AsyncBigQueryDateIntervalTopTerms.as_view(), name='bigquery-async-interval-date-top-terms-endpoint'), # Async endpoint for getting the minimum and maximum date we have data for in the top terms table
+    path('api/bigquery/async/get/top_rising_terms_interval_dates', AsyncBigQueryDateIntervalTopRisingTerms.as_view(), name='bigquery-async-interval-top-rising-terms-endpoint'), # Async endpoint for getting the minimum and maximum date we have data for in the top rising terms table
 ]
\ No newline at end of file
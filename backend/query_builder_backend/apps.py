@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class QueryBuilderBackendConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'query_builder_backend'
+
+    def ready(self):
+        # Connect the signals that keep the search vectors up to date
+        from . import querySearch  # noqa: F401
@@ -0,0 +1,331 @@
+"""
+Async versions of the BigQuery endpoints, meant to be served under ASGI.
+
+The endpoints reuse the queries of the synchronous views. A query job is
+submitted and then polled, so no OS thread is held while BigQuery runs it. The
+blocking client calls (submitting, polling, fetching the rows) run on a bounded
+thread pool.
+
+The responses have the same validators (ETag, Last-Modified, 304 Not Modified)
+as the synchronous endpoints. The requests for a granularity, a stream or a
+columnar format are answered by the synchronous endpoint with sync_to_async,
+since the rollups, the streamed pages and the Arrow downloads are read with
+blocking calls.
+
+The polling stops at the deadline of the endpoint, and the job is cancelled on
+BigQuery when the deadline passes or the request is cancelled, for instance
+because the client went away.
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .fastJson import JsonResponse
+from django.views import View
+from .bigQueryQueries import (
+    TOP_RISING_TERMS_TABLE,
+    TOP_TERMS_TABLE,
+    BigQueryTopRisingTermsDates,
+    BigQueryTopRisingTermsDay,
+    BigQueryTopTermsDate,
+    BigQueryTopTermsDay,
+    check_query_cost,
+    date_interval_response,
+    fallback_response,
+    fetch_rows,
+    get_cached_rows,
+    peek_cached_rows,
+    response_validator,
+    rows_response,
+    store_rows,
+    submit_query,
+)
+from .columnarResults import get_result_format
+from .httpCaching import check_not_modified, validate_response
+from .queryStreaming import get_stream_format
+from .queryCache import get_query_cache, make_cache_key
+from .queryCost import ESTIMATE_HEADER, QueryOverBudget
+from .queryShapes import OTHER
+from .queryResilience import (
+    DeadlineExceeded,
+    async_call_with_retries,
+    cancel_job,
+    deadline,
+    get_endpoint_deadline,
+    remaining_time,
+)
+from .singleFlight import AsyncSingleFlight
+
+# Default configuration of the async execution path, overridable with settings.BIGQUERY_ASYNC
+DEFAULT_ASYNC_SETTINGS = {
+    'MAX_WORKERS': 8,
+    'POLL_INTERVAL': 0.05,
+    'MAX_POLL_INTERVAL': 1.0,
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Coalesces identical queries awaited at the same time into a single job
+async_query_flights = AsyncSingleFlight()
+
+
+def get_async_settings():
+    """
+    Get the async execution settings merged over the defaults.
+
+    :return: A dictionary with the async settings.
+    """
+    return {**DEFAULT_ASYNC_SETTINGS, **getattr(settings, 'BIGQUERY_ASYNC', {})}
+
+
+def get_executor():
+    """
+    Get the thread pool that runs the blocking BigQuery client calls, creating it on first use.
+
+    :return: A ThreadPoolExecutor bounded by BIGQUERY_ASYNC['MAX_WORKERS'].
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=get_async_settings()['MAX_WORKERS'],
+                    thread_name_prefix='bigquery-async',
+                )
+    return _executor
+
+
+async def run_blocking(fn, *args):
+    """
+    Run a blocking call on the BigQuery thread pool.
+
+    :param fn: The function to call.
+    :param args: The arguments of the function.
+    :return: The result of the function.
+    """
+    # Run it in the context of the request, so that its timings are recorded
+    call = functools.partial(copy_context().run, fn, *args)
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), call)
+
+
+async def wait_for_job(query_job):
+    """
+    Poll a query job until it is done, sleeping between polls with exponential backoff.
+
+    :param query_job: The BigQuery query job.
+    :raises DeadlineExceeded: If the job is not done by the deadline of the request, after cancelling it.
+    """
+    async_settings = get_async_settings()
+    interval = async_settings['POLL_INTERVAL']
+    while not await run_blocking(query_job.done):
+        remaining = remaining_time()
+        if remaining == 0:
+            await run_blocking(cancel_job, query_job, 'deadline')
+            raise DeadlineExceeded("The query did not finish within the deadline of the endpoint")
+        await asyncio.sleep(interval if remaining is None else min(interval, remaining))
+        interval = min(interval * 2, async_settings['MAX_POLL_INTERVAL'])
+
+
+async def async_execute_query(query, query_params):
+    """
+    Run a query on BigQuery without blocking the event loop and return its rows.
+
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :return: A list of dictionaries with the rows of the query.
+    """
+    query_job = await run_blocking(submit_query, query, query_params)
+    try:
+        await wait_for_job(query_job)
+    except asyncio.CancelledError:
+        # Nobody will read the results, stop the job without waiting for the cancellation
+        get_executor().submit(cancel_job, query_job, 'abandoned')
+        raise
+    return await run_blocking(fetch_rows, query_job)
+
+
+async def async_run_query(query, query_params, table=None):
+    """
+    Async counterpart of run_query: uses the same result cache and coalesces identical queries.
+
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :param table: The fully qualified table the query reads from, None to skip the cache.
+    :return: A list of dictionaries with the rows of the query.
+    """
+    def execute():
+        # Retry the query on retryable errors within the deadline
+        return async_call_with_retries(lambda: async_execute_query(query, query_params))
+
+    if table is None:
+        return await async_query_flights.do(make_cache_key(query, query_params), execute, remaining_time())
+
+    cache_key, rows = await run_blocking(get_cached_rows, query, query_params, table)
+    if rows is not None:
+        return rows
+
+    async def execute_and_store():
+        rows = await execute()
+        # Store the results for the next requests
+        await run_blocking(store_rows, cache_key, query, query_params, rows)
+        return rows
+
+    return await async_query_flights.do(cache_key, execute_and_store, remaining_time())
+
+
+async def async_process_query(query, query_params, table=None, request=None):
+    """
+    Async counterpart of process_query.
+
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :param table: The fully qualified table the query reads from, used to cache the results.
+    :param request: The HTTP request object, used to pick the response format.
+    :return: A JSON response with the results of the query.
+    """
+    try:
+        # Answer from the result cache without a dry run when the results are cached
+        if table is not None:
+            rows = await run_blocking(peek_cached_rows, query, query_params, table)
+            if rows is not None:
+                return rows_response(rows, request)
+        # Reject the queries that would scan too much before running them
+        estimated_bytes = await run_blocking(check_query_cost, query, query_params, table)
+        rows = await async_run_query(query, query_params, table)
+        response = rows_response(rows, request)
+    except QueryOverBudget as e:
+        return JsonResponse(e.to_dict(), status=400)
+    # If there is an error, answer with the last good results or the error
+    except Exception as e:
+        return await run_blocking(
+            fallback_response, e, query, query_params, lambda rows: rows_response(rows, request),
+        )
+
+    if estimated_bytes is not None:
+        response[ESTIMATE_HEADER] = str(estimated_bytes)
+    return response
+
+
+async def async_conditional_query_response(request, query, query_params, table, build_response, mirror_dates=None):
+    """
+    Async counterpart of conditional_query_response.
+
+    :param request: The HTTP request object.
+    :param query: The query of the endpoint.
+    :param query_params: The parameters of the query.
+    :param table: The fully qualified table the query reads from.
+    :param build_response: An async function that runs the query and returns its response.
+    :param mirror_dates: The first and last dates the request reads from the local mirror, None if it does not.
+    :return: The HTTP response.
+    """
+    # Reads the sync state of the mirror from the database
+    validator = await sync_to_async(response_validator)(request, query, query_params, table, mirror_dates)
+    if validator is None:
+        return await build_response()
+    cache_key, watermark = validator
+    cache = get_query_cache()
+    response = await run_blocking(check_not_modified, request, cache, cache_key, watermark)
+    if response is not None:
+        return response
+    response = await build_response()
+    return await run_blocking(validate_response, request, cache, cache_key, watermark, response)
+
+
+def needs_blocking_response(request):
+    """
+    :param request: The HTTP request object.
+    :return: Whether the request asks for a granularity, a stream or a columnar format, which are
+        answered with blocking calls.
+    """
+    return (request.GET.get('granularity') not in (None, '', 'day')
+            or get_stream_format(request) is not None or get_result_format(request) is not None)
+
+
+class AsyncBigQueryView(View):
+    """
+    Base class of the async endpoints. Subclasses point query_view to the synchronous
+    endpoint (a BigQueryShapeView) whose shape and mirror they reuse.
+    """
+    query_view = None
+
+    async def get(self, request, **kwargs):
+        """
+        Handle GET requests with the query of query_view.
+
+        :param request: The HTTP request object.
+        :param kwargs: The URL parameters of the endpoint.
+
+        :return: A response, the same as the synchronous endpoint.
+        """
+        query_view = self.query_view()
+        shape = query_view.shape
+        try:
+            query, query_params, table = query_view.build_query(**kwargs)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+        async def respond():
+            if needs_blocking_response(request):
+                return await sync_to_async(query_view.respond)(request, query, query_params, table, **kwargs)
+
+            # Answer from the local mirror when it has the requested dates
+            rows = await sync_to_async(query_view.query_mirror)(**kwargs)
+            if rows is not None:
+                shape.observe(OTHER)
+                return rows_response(rows, request)
+
+            response = await async_process_query(query, query_params, table, request)
+            shape.observe_response(response)
+            return response
+
+        # Bound the time the endpoint waits on BigQuery, see settings.BIGQUERY_RESILIENCE
+        with deadline(get_endpoint_deadline(request)):
+            # Answer with 304 Not Modified when the client already has the current data
+            return await async_conditional_query_response(
+                request, query, query_params, table, respond, mirror_dates=query_view.mirror_dates(**kwargs),
+            )
+
+
+class AsyncBigQueryTopTermsDay(AsyncBigQueryView):
+    query_view = BigQueryTopTermsDay
+
+
+class AsyncBigQueryTopTermsDate(AsyncBigQueryView):
+    query_view = BigQueryTopTermsDate
+
+
+class AsyncBigQueryTopRisingTermsDay(AsyncBigQueryView):
+    query_view = BigQueryTopRisingTermsDay
+
+
+class AsyncBigQueryTopRisingTermsDates(AsyncBigQueryView):
+    query_view = BigQueryTopRisingTermsDates
+
+
+class AsyncBigQueryDateIntervalView(View):
+    """
+    Base class of the async date interval endpoints, served from the table metadata.
+    """
+    table = None
+
+    async def get(self, request):
+        """
+        Handle GET requests to get the minimum and maximum date of the table.
+
+        :param request: The HTTP request object.
+
+        :return: A JSON response, the same as the synchronous endpoint.
+        """
+        return await run_blocking(date_interval_response, self.table)
+
+
+class AsyncBigQueryDateIntervalTopTerms(AsyncBigQueryDateIntervalView):
+    table = TOP_TERMS_TABLE
+
+
+class AsyncBigQueryDateIntervalTopRisingTerms(AsyncBigQueryDateIntervalView):
+    table = TOP_RISING_TERMS_TABLE
@@ -0,0 +1,490 @@
+"""
+Offline benchmark of the endpoints.
+
+Every URL pattern of urls.py has a scenario: the arguments, query parameters
+and body of a representative request. A scenario is run by a number of threads
+sending its request through the Django test client, with BigQuery replaced by a
+ReplayClient, and its report has the latency percentiles, the throughput, the
+status codes and the memory allocated per request, measured in a separate
+sequential pass with tracemalloc.
+
+The benchmark_endpoints management command runs the scenarios on a test
+database and writes the reports as JSON, which can be compared across commits.
+
+The startup benchmark runs each phase of the startup of a process (django.setup,
+importing the URLconf, preloading the heavy modules) in new interpreters, and
+reports its time, peak memory and the heavy modules it imported. The
+benchmark_startup management command writes its report as JSON.
+"""
+import json
+import math
+import os
+import platform
+import re
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.parse import quote
+import django
+from django.conf import settings
+from django.db import connections
+from django.test import Client
+from django.urls import URLPattern, URLResolver, get_resolver
+from .models import Comment, Query
+
+# Dates of the scenarios, within the synthetic tables of the ReplayClient
+DAY = '2023-11-20'
+INIT_DATE = '2023-10-22'
+FINISH_DATE = '2023-11-20'
+COUNTRIES = ['Argentina', 'Brazil', 'Colombia', 'Mexico']
+
+# Values filled in from the fixtures of the run
+QUERY_ID = '{query_id}'
+JOB_ID = '{job_id}'
+
+DAY_KWARGS = {'country_name': 'Colombia', 'date': DAY}
+RANGE_KWARGS = {'country_name': 'Colombia', 'init_date': INIT_DATE, 'finish_date': FINISH_DATE}
+RANGE_PARAMS = {'country': COUNTRIES, 'init_date': INIT_DATE, 'finish_date': FINISH_DATE}
+QUERY_ITEM = {
+    'query': f'http://localhost/api/bigquery/get/top_terms_day/Colombia/{DAY}',
+    'name': 'benchmark',
+    'username': 'benchmark',
+    'query_comment': 'benchmark query',
+}
+
+# The request of each URL pattern: its method, URL arguments, query parameters and JSON body
+SCENARIOS = {
+    'metrics': {},
+    'api/db/post/query': {'method': 'post', 'json': QUERY_ITEM},
+    'api/db/post/comment/<str:query_id>/<str:username>/<str:comment>': {
+        'method': 'post', 'kwargs': {'query_id': QUERY_ID, 'username': 'benchmark', 'comment': 'benchmark comment'},
+    },
+    'api/db/post/queries/bulk': {'method': 'post', 'json': [QUERY_ITEM] * 20},
+    'api/db/post/comments/bulk': {
+        'method': 'post',
+        'json': [{'query': QUERY_ID, 'username': 'benchmark', 'comment_text': 'benchmark comment'}] * 20,
+    },
+    'api/db/get/queries': {},
+    'api/db/get/queries/search': {'params': {'q': 'benchmark'}},
+    'api/db/get/query/<int:query_id>': {'kwargs': {'query_id': QUERY_ID}},
+    'api/db/get/query/<int:query_id>/results': {'kwargs': {'query_id': QUERY_ID}},
+    'api/db/get/comments/<int:query_id>': {'kwargs': {'query_id': QUERY_ID}},
+    'api/bigquery/get/top_terms_dates/<str:country_name>/<str:init_date>/<str:finish_date>': {'kwargs': RANGE_KWARGS},
+    'api/bigquery/get/top_terms_day/<str:country_name>/<str:date>': {'kwargs': DAY_KWARGS},
+    'api/bigquery/get/top_rising_terms_dates/<str:country_name>/<str:init_date>/<str:finish_date>': {
+        'kwargs': RANGE_KWARGS,
+    },
+    'api/bigquery/get/top_rising_terms_day/<str:country_name>/<str:date>': {'kwargs': DAY_KWARGS},
+    'api/bigquery/get/top_terms_interval_dates': {},
+    'api/bigquery/get/top_rising_terms_interval_dates': {},
+    'api/bigquery/get/top_terms_countries': {},
+    'api/bigquery/get/top_rising_terms_countries': {},
+    'api/bigquery/get/top_terms_batch': {'params': RANGE_PARAMS},
+    'api/bigquery/get/top_rising_terms_batch': {'params': RANGE_PARAMS},
+    'api/bigquery/analytics/top_terms/<str:metric>': {'kwargs': {'metric': 'persistence'}, 'params': RANGE_PARAMS},
+    'api/bigquery/analytics/top_rising_terms/<str:metric>': {'kwargs': {'metric': 'overlap'}, 'params': RANGE_PARAMS},
+    'api/bigquery/get/client_stats': {},
+    'api/bigquery/jobs/submit/top_terms_dates/<str:country_name>/<str:init_date>/<str:finish_date>': {
+        'method': 'post', 'kwargs': RANGE_KWARGS,
+    },
+    'api/bigquery/jobs/submit/top_rising_terms_dates/<str:country_name>/<str:init_date>/<str:finish_date>': {
+        'method': 'post', 'kwargs': RANGE_KWARGS,
+    },
+    'api/bigquery/jobs/<str:job_id>': {'kwargs': {'job_id': JOB_ID}},
+    'api/bigquery/jobs/<str:job_id>/result': {'kwargs': {'job_id': JOB_ID}, 'params': {'wait': 5}},
+    'api/bigquery/async/get/top_terms_dates/<str:country_name>/<str:init_date>/<str:finish_date>': {
+        'kwargs': RANGE_KWARGS,
+    },
+    'api/bigquery/async/get/top_terms_day/<str:country_name>/<str:date>': {'kwargs': DAY_KWARGS},
+    'api/bigquery/async/get/top_rising_terms_dates/<str:country_name>/<str:init_date>/<str:finish_date>': {
+        'kwargs': RANGE_KWARGS,
+    },
+    'api/bigquery/async/get/top_rising_terms_day/<str:country_name>/<str:date>': {'kwargs': DAY_KWARGS},
+    'api/bigquery/async/get/top_terms_interval_dates': {},
+    'api/bigquery/async/get/top_rising_terms_interval_dates': {},
+}
+
+# URL patterns that are not benchmarked
+EXCLUDED_ROUTES = ('admin/',)
+
+route_argument_re = re.compile(r'<(?:\w+:)?(\w+)>')
+
+
+def url_routes(patterns=None, prefix=''):
+    """
+    :return: The routes of every URL pattern of the project, such as 'api/db/get/query/<int:query_id>'.
+    """
+    routes = []
+    for pattern in get_resolver().url_patterns if patterns is None else patterns:
+        route = prefix + str(pattern.pattern)
+        if isinstance(pattern, URLResolver):
+            if route not in EXCLUDED_ROUTES:
+                routes += url_routes(pattern.url_patterns, route)
+        elif isinstance(pattern, URLPattern):
+            routes.append(route)
+    return routes
+
+
+def missing_scenarios():
+    """
+    :return: The routes of urls.py that have no scenario.
+    """
+    return [route for route in url_routes() if route not in SCENARIOS]
+
+
+def fill(value, fixtures):
+    """
+    Replace the placeholders of a scenario with the values of the fixtures.
+
+    :param value: A value of a scenario, a placeholder such as QUERY_ID, or a list or dictionary of them.
+    :param fixtures: The values of the placeholders.
+    :return: The value with the placeholders replaced.
+    """
+    if isinstance(value, dict):
+        return {key: fill(item, fixtures) for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill(item, fixtures) for item in value]
+    return fixtures.get(value, value)
+
+
+def build_url(route, kwargs):
+    """
+    :param route: The route of a URL pattern.
+    :param kwargs: The values of its arguments.
+    :return: The path of the URL.
+    """
+    return '/' + route_argument_re.sub(lambda match: quote(str(kwargs[match.group(1)]), safe=''), route)
+
+
+def send(client, route, scenario, fixtures):
+    """
+    Send the request of a scenario and read its whole body.
+
+    :param client: The Django test client.
+    :param route: The route of the URL pattern.
+    :param scenario: The scenario of the route.
+    :param fixtures: The values of the placeholders.
+    :return: The response.
+    """
+    url = build_url(route, fill(scenario.get('kwargs', {}), fixtures))
+    params = fill(scenario.get('params', {}), fixtures)
+    if scenario.get('method', 'get') == 'post':
+        if params:
+            url += '?' + '&'.join(f"{key}={quote(str(value))}" for key, value in params.items())
+        response = client.post(url, fill(scenario.get('json'), fixtures), content_type='application/json')
+    else:
+        response = client.get(url, params)
+    if response.streaming:
+        b"".join(response.streaming_content)
+    return response
+
+
+def create_fixtures():
+    """
+    Create the saved query, comment and background job the scenarios refer to.
+
+    :return: The values of the placeholders.
+    """
+    query = Query.objects.create(**QUERY_ITEM)
+    Comment.objects.create(query=query, username='benchmark', comment_text='benchmark comment')
+    route = 'api/bigquery/jobs/submit/top_terms_dates/<str:country_name>/<str:init_date>/<str:finish_date>'
+    job = send(Client(), route, SCENARIOS[route], {}).json()
+    return {QUERY_ID: query.id, JOB_ID: job.get('job_id', 'missing')}
+
+
+def percentile(sorted_values, fraction):
+    """
+    :param sorted_values: The values, sorted.
+    :param fraction: The fraction of the values at or below the percentile, such as 0.95.
+    :return: The nearest-rank percentile, or None if there are no values.
+    """
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(fraction * len(sorted_values)) - 1, 0)]
+
+
+def run_load(route, scenario, fixtures, requests, concurrency):
+    """
+    Send the request of a scenario a number of times from concurrent threads.
+
+    :param route: The route of the URL pattern.
+    :param scenario: The scenario of the route.
+    :param fixtures: The values of the placeholders.
+    :param requests: The total number of requests.
+    :param concurrency: The number of threads sending them.
+    :return: The latencies in seconds, the number of responses with each status, the failures and the wall time.
+    """
+    latencies = []
+    statuses = Counter()
+    failures = []
+    sent = iter(range(requests))
+    lock = threading.Lock()
+
+    def worker():
+        client = Client()
+        try:
+            while True:
+                with lock:
+                    if next(sent, None) is None:
+                        return
+                started = time.perf_counter()
+                try:
+                    response = send(client, route, scenario, fixtures)
+                except Exception as e:
+                    with lock:
+                        failures.append(str(e))
+                    continue
+                elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+                    statuses[response.status_code] += 1
+        finally:
+            # Each thread has its own database connection
+            connections.close_all()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, name=f'benchmark-{index}') for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, failures, time.perf_counter() - started
+
+
+def measure_memory(route, scenario, fixtures, requests):
+    """
+    Measure the memory allocated by the requests of a scenario, one request at a time.
+
+    :return: The peak number of bytes allocated by each request.
+    """
+    client = Client()
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(requests):
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            send(client, route, scenario, fixtures)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - baseline)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def benchmark_route(route, fixtures, requests, concurrency, memory_requests):
+    """
+    Benchmark the scenario of a route.
+
+    :return: The report of the route.
+    """
+    scenario = SCENARIOS[route]
+    latencies, statuses, failures, wall_seconds = run_load(route, scenario, fixtures, requests, concurrency)
+    latencies.sort()
+    milliseconds = [latency * 1000 for latency in latencies]
+    report = {
+        'method': scenario.get('method', 'get').upper(),
+        'requests': requests,
+        'concurrency': concurrency,
+        'statuses': {str(code): count for code, count in sorted(statuses.items())},
+        'errors': len(failures) + sum(count for code, count in statuses.items() if code >= 500),
+        'requests_per_second': round(len(latencies) / wall_seconds, 2) if wall_seconds else None,
+        'latency_ms': {
+            'p50': percentile(milliseconds, 0.50),
+            'p95': percentile(milliseconds, 0.95),
+            'p99': percentile(milliseconds, 0.99),
+            'mean': sum(milliseconds) / len(milliseconds) if milliseconds else None,
+            'max': milliseconds[-1] if milliseconds else None,
+        },
+    }
+    report['latency_ms'] = {key: round(value, 3) if value is not None else None
+                            for key, value in report['latency_ms'].items()}
+    if failures:
+        report['failures'] = sorted(set(failures))[:5]
+    if memory_requests:
+        peaks = measure_memory(route, scenario, fixtures, memory_requests)
+        report['memory_bytes_per_request'] = {'mean': round(sum(peaks) / len(peaks)), 'max': max(peaks)}
+    return report
+
+
+def git_commit():
+    """
+    :return: The commit the code is at, or None if it is not known.
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=5, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_meta(**options):
+    """
+    :param options: The options of the run.
+    :return: The metadata of a report: when and where it ran, and its options.
+    """
+    return {
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        **options,
+    }
+
+
+def run_benchmark(routes=None, requests=50, concurrency=8, memory_requests=10, options=None):
+    """
+    Benchmark the scenarios of some routes. The database must be a test database, since the
+    scenarios write to it.
+
+    :param routes: The routes to benchmark, every route of urls.py by default.
+    :param requests: The number of requests of each route.
+    :param concurrency: The number of threads sending them.
+    :param memory_requests: The number of requests of each route measured with tracemalloc, 0 to skip it.
+    :param options: The other options of the run, recorded in the report.
+    :return: The report, a JSON-serializable dictionary.
+    """
+    fixtures = create_fixtures()
+    routes = routes if routes is not None else url_routes()
+    return {
+        'meta': run_meta(
+            requests=requests, concurrency=concurrency, memory_requests=memory_requests, **(options or {}),
+        ),
+        'endpoints': {
+            route: benchmark_route(route, fixtures, requests, concurrency, memory_requests)
+            for route in routes
+        },
+    }
+
+
+def change(current, previous):
+    """
+    :return: The relative change from a previous value to the current one, or None if either is missing.
+    """
+    if current is None or not previous:
+        return None
+    return round(current / previous - 1, 4)
+
+
+def compare_reports(report, baseline):
+    """
+    Compare a report with the one of another commit.
+
+    :param report: The report of run_benchmark.
+    :param baseline: The report to compare it with.
+    :return: The relative change of the latency percentiles, throughput and memory of every route
+        of both reports, by route, such as {'p95': 0.12} for a p95 latency 12% higher.
+    """
+    comparison = {}
+    for route, current in report['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(route)
+        if previous is None:
+            continue
+        comparison[route] = {
+            **{key: change(current['latency_ms'][key], previous['latency_ms'].get(key))
+               for key in ('p50', 'p95', 'p99')},
+            'requests_per_second': change(current['requests_per_second'], previous.get('requests_per_second')),
+            'memory': change(
+                current.get('memory_bytes_per_request', {}).get('mean'),
+                previous.get('memory_bytes_per_request', {}).get('mean'),
+            ),
+        }
+    return comparison
+
+
+# Phases of the startup of a process: the code run after django.setup(), in a new interpreter
+STARTUP_PHASES = {
+    'setup': '',
+    'urlconf': 'from django.urls import get_resolver; get_resolver().url_patterns',
+    'preload': 'from query_builder_backend.startup import preload; preload()',
+}
+
+# Modules that only the requests needing them should import
+HEAVY_MODULES = ('google.cloud.bigquery', 'google.api_core', 'google.auth', 'pandas', 'numpy', 'pyarrow')
+
+STARTUP_SCRIPT = """
+import json, resource, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+{code}
+print(json.dumps({{
+    'seconds': time.perf_counter() - started,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'heavy_modules': [name for name in {heavy_modules!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure_startup(phase):
+    """
+    Run a startup phase in a new interpreter, with the settings of this process.
+
+    :param phase: The name of the phase, one of STARTUP_PHASES.
+    :return: The seconds the whole process took, the seconds from importing Django to the end of the
+        phase, the peak resident memory (in KB on Linux) and the HEAVY_MODULES it imported.
+    :raises subprocess.CalledProcessError: If the phase failed.
+    """
+    script = STARTUP_SCRIPT.format(code=STARTUP_PHASES[phase], heavy_modules=HEAVY_MODULES)
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, '-c', script],
+        cwd=settings.BASE_DIR,
+        env={**os.environ, 'DJANGO_SETTINGS_MODULE': settings.SETTINGS_MODULE},
+        capture_output=True, text=True, check=True,
+    )
+    process_seconds = time.perf_counter() - started
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    return process_seconds, result['seconds'], result['max_rss_kb'], result['heavy_modules']
+
+
+def run_startup_benchmark(phases=None, repeat=5):
+    """
+    Benchmark the startup phases of a process.
+
+    :param phases: The phases to benchmark, every one of STARTUP_PHASES by default.
+    :param repeat: The number of new interpreters each phase runs in.
+    :return: The report, a JSON-serializable dictionary.
+    """
+    def summary(seconds):
+        milliseconds = sorted(value * 1000 for value in seconds)
+        return {key: round(percentile(milliseconds, fraction), 3)
+                for key, fraction in (('min', 0), ('p50', 0.50), ('max', 1))}
+
+    report = {'meta': run_meta(repeat=repeat), 'phases': {}}
+    for phase in phases or STARTUP_PHASES:
+        runs = [measure_startup(phase) for _ in range(repeat)]
+        report['phases'][phase] = {
+            'process_ms': summary(run[0] for run in runs),
+            'django_ms': summary(run[1] for run in runs),
+            'max_rss_kb': max(run[2] for run in runs),
+            'heavy_modules': runs[-1][3],
+        }
+    return report
+
+
+def compare_startup_reports(report, baseline):
+    """
+    Compare a startup report with the one of another commit.
+
+    :param report: The report of run_startup_benchmark.
+    :param baseline: The report to compare it with.
+    :return: The relative change of the median times and of the peak memory of every phase of both
+        reports, by phase, such as {'process_ms': -0.4} for a process starting 40% faster.
+    """
+    comparison = {}
+    for phase, current in report['phases'].items():
+        previous = baseline.get('phases', {}).get(phase)
+        if previous is None:
+            continue
+        comparison[phase] = {
+            'process_ms': change(current['process_ms']['p50'], previous['process_ms'].get('p50')),
+            'django_ms': change(current['django_ms']['p50'], previous['django_ms'].get('p50')),
+            'max_rss_kb': change(current['max_rss_kb'], previous.get('max_rss_kb')),
+        }
+    return comparison
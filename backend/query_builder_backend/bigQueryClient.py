@@ -0,0 +1,189 @@
+"""
+Process-wide BigQuery client.
+
+The service account credentials are loaded once and every thread shares a
+single bigquery.Client, backed by one HTTP session whose connection pool size
+is configurable. The client can be warmed at startup so the first request does
+not pay for loading the credentials, fetching a token and the TLS handshake.
+
+google.cloud.bigquery takes longer to import than the rest of the project
+(it brings pandas along), so it is only imported when first used: modules use
+the lazy `bigquery` of this module instead of importing it themselves, and the
+credentials and HTTP session modules are imported when the client is created.
+Management commands and processes that only serve the database endpoints
+never import it; serving processes import it ahead of time in startup.preload.
+"""
+import threading
+import time
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+from django.utils.module_loading import import_string
+
+
+def import_bigquery():
+    """
+    :return: The google.cloud.bigquery module.
+    """
+    from google.cloud import bigquery
+    return bigquery
+
+
+# google.cloud.bigquery, imported on first attribute access
+bigquery = SimpleLazyObject(import_bigquery)
+
+# Default configuration of the client, overridable with settings.BIGQUERY_CLIENT
+DEFAULT_CLIENT_SETTINGS = {
+    'POOL_SIZE': 10,
+    'WARM_ON_STARTUP': True,
+    'FACTORY': None,
+}
+
+
+def get_client_settings():
+    """
+    Get the client settings merged over the defaults.
+
+    :return: A dictionary with the client settings.
+    """
+    return {**DEFAULT_CLIENT_SETTINGS, **getattr(settings, 'BIGQUERY_CLIENT', {})}
+
+
+class BigQueryClientManager:
+    """
+    Creates the shared BigQuery client on first use and keeps statistics about it.
+    """
+
+    def __init__(self, credentials_path, pool_size=10):
+        """
+        :param credentials_path: The path of the service account file.
+        :param pool_size: The maximum number of HTTP connections kept open to BigQuery.
+        """
+        self.credentials_path = credentials_path
+        self.pool_size = pool_size
+        self._client = None
+        self._credentials = None
+        self._session = None
+        self._lock = threading.Lock()
+        self.created_at = None
+        self.creation_seconds = None
+        self.requests = 0
+
+    def get_client(self):
+        """
+        Get the shared client, creating it if necessary.
+
+        :return: A BigQuery client.
+        """
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._create_client()
+                client = self._client
+        self.requests += 1
+        return client
+
+    def _create_client(self):
+        """
+        Load the credentials and build the client and its pooled HTTP session.
+
+        :return: A BigQuery client.
+        """
+        started = time.perf_counter()
+        factory = get_client_settings()['FACTORY']
+        if factory is not None:
+            # A stand-in client, such as the ReplayClient of the benchmarks
+            client = (import_string(factory) if isinstance(factory, str) else factory)()
+            self.created_at = time.time()
+            self.creation_seconds = time.perf_counter() - started
+            return client
+
+        from google.auth.transport.requests import AuthorizedSession
+        from google.oauth2 import service_account
+        from requests.adapters import HTTPAdapter
+
+        credentials = service_account.Credentials.from_service_account_file(
+            self.credentials_path,
+            scopes=bigquery.Client.SCOPE,
+        )
+        # One session, and therefore one connection pool, for every thread
+        session = AuthorizedSession(credentials)
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        client = bigquery.Client(credentials=credentials, project=credentials.project_id, _http=session)
+
+        self._credentials = credentials
+        self._session = session
+        self.created_at = time.time()
+        self.creation_seconds = time.perf_counter() - started
+        return client
+
+    def warm(self):
+        """
+        Create the client and fetch an access token ahead of the first request.
+        """
+        self.get_client()
+        if self._credentials is not None:
+            from google.auth.transport.requests import Request
+            self._credentials.refresh(Request())
+
+    def reset(self):
+        """
+        Close the client so that the next call creates a new one.
+        """
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._client = None
+            self._credentials = None
+            self._session = None
+
+    def stats(self):
+        """
+        Get statistics about the client and its connection pool.
+
+        :return: A dictionary with the statistics.
+        """
+        connection_pools = []
+        if self._session is not None:
+            adapter = self._session.get_adapter('https://')
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                connection_pools.append({
+                    'host': pool.host,
+                    'connections_opened': pool.num_connections,
+                    'requests': pool.num_requests,
+                    'idle_connections': pool.pool.qsize() if pool.pool is not None else 0,
+                })
+        return {
+            'client_created': self._client is not None,
+            'created_at': self.created_at,
+            'creation_seconds': self.creation_seconds,
+            'pool_size': self.pool_size,
+            'client_requests': self.requests,
+            'connection_pools': connection_pools,
+        }
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_client_manager():
+    """
+    Get the process-wide client manager, creating it on first use.
+
+    :return: The BigQueryClientManager.
+    """
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = BigQueryClientManager(
+                    getattr(settings, 'CONFIG_PATH', './config.json'),
+                    pool_size=get_client_settings()['POOL_SIZE'],
+                )
+    return _manager
+
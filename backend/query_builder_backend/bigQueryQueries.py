@@ -1,289 +1,1408 @@
-import threading
-import json
+import math
+import time
+from datetime import date
+from itertools import chain
 from .serializers import *
 from rest_framework.views import APIView
-from django.http import JsonResponse
-from django.conf import settings
-from google.cloud import bigquery
-from google.oauth2 import service_account
-thread_local = threading.local()
-
-CONFIG_JSON_PATH = getattr(settings, 'CONFIG_PATH', './config.json')
-with open(CONFIG_JSON_PATH, 'r') as file:
-    config = json.load(file)
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.exceptions import NotAcceptable
+from django.http import Http404
+from .fastJson import JsonResponse
+from django.urls import reverse
+from .bigQueryClient import bigquery, get_client_manager
+from .queryCache import get_query_cache, make_cache_key
+from .singleFlight import SingleFlight
+from .trendsMetadata import TableMetadataService
+from .trendsAnalytics import ANALYTICS_METRICS, build_range_query
+from .httpCaching import conditional_response
+from .queryMetrics import bigquery_errors, observe_cache_lookup, observe_query_job
+from .queryJobs import DONE, FAILED, QueueFull, get_job_queue
+from .queryCost import ESTIMATE_HEADER, QueryCostGuard, QueryOverBudget, get_maximum_bytes_billed
+from .queryResilience import (
+    CircuitOpen,
+    bigquery_breaker,
+    call_with_retries,
+    deadline,
+    get_endpoint_deadline,
+    get_last_good,
+    job_result,
+    mark_stale,
+    remaining_time,
+    store_last_good,
+    timeout_errors,
+)
+from . import trendsMirror
+from . import trendsRollups
+from . import cacheWarming
+from .projectConfig import get_config
+from .queryShapes import OTHER, QUERY, Between, Constant, Equals, InList, QueryShape, register
+from .queryStreaming import STREAM_FORMATS, get_stream_format, get_stream_page_size, streaming_rows_response
+from .columnarResults import (
+    RESULT_FORMATS,
+    columnar_response,
+    columnar_rows_response,
+    get_result_format,
+    import_pyarrow,
+    pyarrow_missing_response,
+    results_to_arrow,
+    rows_to_arrow,
+)
+
+config = get_config()
 # Data for BigQuery
 DATASET_ID = config.get('dataset_id')
 TOP_TERMS_ID = config.get('top_terms_id')
 TOP_RISING_TERMS_ID = config.get('top_rising_terms_id')
- # Create a thread-local storage for the client
+# Fully qualified names of the tables, used to track their refresh watermark
+TOP_TERMS_TABLE = f"{DATASET_ID}.{TOP_TERMS_ID}"
+TOP_RISING_TERMS_TABLE = f"{DATASET_ID}.{TOP_RISING_TERMS_ID}"
+
+# Shapes of the queries of the endpoints (see queryShapes)
+# The tables repeat the rows of every country, day and term once per region, hence distinct=True
+TOP_TERMS_DAY = register(QueryShape(
+    'top_terms_day', TOP_TERMS_TABLE,
+    columns=[('term', 'Top_Term'), 'rank'],
+    filters=[Equals('refresh_date', 'date', param_type='DATE'), Equals('country_name', 'country_name')],
+    order_by=['rank ASC'],
+    distinct=True,
+))
+TOP_TERMS_DATES = register(QueryShape(
+    'top_terms_dates', TOP_TERMS_TABLE,
+    columns=[('refresh_date', 'Day'), ('term', 'Top_Term')],
+    filters=[
+        Constant('rank', 1),
+        Between('refresh_date', 'init_date', 'finish_date', param_type='DATE'),
+        Equals('country_name', 'country_name'),
+    ],
+    order_by=['Day DESC'],
+    distinct=True,
+))
+TOP_RISING_TERMS_DAY = register(QueryShape(
+    'top_rising_terms_day', TOP_RISING_TERMS_TABLE,
+    columns=[('term', 'Top_Term'), 'rank', 'percent_gain'],
+    filters=[Equals('refresh_date', 'date', param_type='DATE'), Equals('country_name', 'country_name')],
+    order_by=['rank ASC'],
+    distinct=True,
+))
+TOP_RISING_TERMS_DATES = register(QueryShape(
+    'top_rising_terms_dates', TOP_RISING_TERMS_TABLE,
+    columns=[('refresh_date', 'Day'), ('term', 'Top_Term'), 'percent_gain'],
+    filters=[
+        Constant('rank', 1),
+        Between('refresh_date', 'init_date', 'finish_date', param_type='DATE'),
+        Equals('country_name', 'country_name'),
+    ],
+    order_by=['Day DESC'],
+    distinct=True,
+))
+
+
+def batch_shapes(name, table, columns):
+    """
+    Declare the shapes of a batch endpoint, which reads several countries on a list of dates or on a range.
+
+    :param name: The prefix of the names of the shapes.
+    :param table: The fully qualified table name.
+    :param columns: The columns selected besides the country, the day and the term.
+    :return: The shape reading a list of dates and the shape reading a range.
+    """
+    columns = ['country_name', ('refresh_date', 'Day'), ('term', 'Top_Term'), *columns]
+    countries = InList('country_name', 'countries')
+    order_by = ['country_name', 'Day', 'rank ASC']
+    return (
+        register(QueryShape(
+            f'{name}_dates', table, columns,
+            filters=[countries, InList('refresh_date', 'dates', param_type='DATE')],
+            order_by=order_by, distinct=True,
+        )),
+        register(QueryShape(
+            f'{name}_range', table, columns,
+            filters=[countries, Between('refresh_date', 'init_date', 'finish_date', param_type='DATE')],
+            order_by=order_by, distinct=True,
+        )),
+    )
+
+
+TOP_TERMS_BATCH_DATES, TOP_TERMS_BATCH_RANGE = batch_shapes('top_terms_batch', TOP_TERMS_TABLE, ['rank'])
+TOP_RISING_TERMS_BATCH_DATES, TOP_RISING_TERMS_BATCH_RANGE = batch_shapes(
+    'top_rising_terms_batch', TOP_RISING_TERMS_TABLE, ['rank', 'percent_gain'],
+)
 
 @staticmethod
 def get_client():
     """
-    Get a BigQuery client for the current thread, creating one if necessary.
+    Get the BigQuery client shared by every thread of the process.
 
     :return: A BigQuery client.
     """
-    # Retrieve or create a client for the current thread
-    if not hasattr(thread_local, "client"):
-        # Create a new client for the current thread
-        credentials = service_account.Credentials.from_service_account_file(CONFIG_JSON_PATH)
-        thread_local.client = bigquery.Client(credentials=credentials)
-    # Return the client
-    return thread_local.client
+    return get_client_manager().get_client()
+
+class BigQueryContentNegotiation(DefaultContentNegotiation):
+    """
+    Content negotiation that lets the BigQuery views handle the media types and formats they
+    produce themselves (such as NDJSON or Arrow) instead of rejecting them.
+    """
+    def select_renderer(self, request, renderers, format_suffix=None):
+        try:
+            return super().select_renderer(request, renderers, format_suffix)
+        except (NotAcceptable, Http404):
+            return (renderers[0], renderers[0].media_type)
 
-class BigQueryTopTermsDay(APIView):
-    def get(self, request, country_name, date):
+class BigQueryView(APIView):
+    """
+    Base class of the BigQuery endpoints.
+    """
+    content_negotiation_class = BigQueryContentNegotiation
+
+    def dispatch(self, request, *args, **kwargs):
+        # Bound the time the endpoint waits on BigQuery, see settings.BIGQUERY_RESILIENCE
+        with deadline(get_endpoint_deadline(request)):
+            return super().dispatch(request, *args, **kwargs)
+
+class BigQueryShapeView(BigQueryView):
+    """
+    Base class of the endpoints that run the query of a declared shape (see queryShapes), filled in
+    with the arguments of their URL. Subclasses set the shape, and query_mirror to answer from the
+    local mirror when it has the requested dates.
+    """
+    shape = None
+
+    def get(self, request, **kwargs):
         """
-        Handle GET requests to get the top terms for a given day from the BigQuery database.
+        Handle GET requests with the query of the shape.
 
         :param request: The HTTP request object.
-        :param country_name: The country to get the top terms from.
-        :param date: The date to get the top terms from.
+        :param kwargs: The arguments of the URL, the values of the parameters of the shape.
 
         :return: A JSON response.
-            - If the request is processed correctly, returns: 
-                a list of all the top 25 terms for the given day
+            - If the request is processed correctly, returns:
+                the rows of the query
                 with HTTP status 200 (OK).
-            - If the request data is invalid, returns:
-                the serializer errors
+            - If the arguments are invalid or the query is over budget, returns:
+                the error
                 with HTTP status 400 (Bad Request).
+            - If the client already has the current data (If-None-Match or If-Modified-Since), returns:
+                an empty response
+                with HTTP status 304 (Not Modified).
         """
-        # Define the parameters to use from the api request
-        query_params = [
-            bigquery.ScalarQueryParameter("date", "STRING", date),
-            bigquery.ScalarQueryParameter("country_name", "STRING", country_name),
-        ]
-        
-        # Query that selects the top 25 terms for a given day
-        query = f"""
-            SELECT
-                term AS Top_Term,
-                rank
-             FROM `{DATASET_ID}.{TOP_TERMS_ID}`
-            WHERE
-                refresh_date = @date
-                AND
-                country_name = @country_name
-            GROUP BY Top_Term, rank
-            ORDER BY rank ASC
+        try:
+            query, query_params, table = self.build_query(**kwargs)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+        # Answer with 304 Not Modified when the client already has the current data
+        return conditional_query_response(
+            request, query, query_params, table, lambda: self.respond(request, query, query_params, table, **kwargs),
+            mirror_dates=self.mirror_dates(**kwargs),
+        )
+
+    def respond(self, request, query, query_params, table, **kwargs):
         """
+        Build the response of the endpoint, from the local data when it has the request, or with the query.
+
+        :param request: The HTTP request object.
+        :param query: The query of the shape.
+        :param query_params: The parameters of the query.
+        :param table: The fully qualified table the query reads from.
+        :param kwargs: The arguments of the URL.
+        :return: The HTTP response.
+        """
+        response = self.local_response(request, **kwargs)
+        if response is not None:
+            self.shape.observe(OTHER)
+            return response
 
         # Sends the query to the process_query function
-        return process_query(query, query_params)
-    
+        response = process_query(query, query_params, table, request=request)
+        self.shape.observe_response(response)
+        return response
 
-class BigQueryTopTermsDate(APIView):
-    def get(self, request, country_name, init_date, finish_date):
+    def local_response(self, request, **kwargs):
         """
-        Handle GET requests to get the top term for each day in a given range from the BigQuery database.
+        Answer without the query of the shape, from the local mirror when it has the requested dates.
 
         :param request: The HTTP request object.
-        :param country_name: The country to get the top terms from.
-        :param init_date: The initial date to get the top terms from.
-        :param finish_date: The final date to get the top terms from.
+        :param kwargs: The arguments of the URL.
+        :return: The response, or None to run the query of the shape.
+        """
+        rows = self.query_mirror(**kwargs)
+        if rows is not None:
+            return rows_response(rows, request)
+        return None
 
-        :return: A JSON response.
-            - If the request is processed correctly, returns: 
-                a list of all the top terms for each day in the given range
-                with HTTP status 200 (OK).
-            - If the request data is invalid, returns:
-                the serializer errors
-                with HTTP status 400 (Bad Request).
+    @classmethod
+    def build_query(cls, **kwargs):
         """
-        # Define the parameters to use from the api request
-        query_params = [
-            bigquery.ScalarQueryParameter("init_date", "STRING", init_date),
-            bigquery.ScalarQueryParameter("finish_date", "STRING", finish_date),
-            bigquery.ScalarQueryParameter("country_name", "STRING", country_name),
-        ]
-        
-        # Query that selects the top term for each day in the given range
-        query = f"""
-            SELECT
-                refresh_date AS Day,
-                term AS Top_Term
-             FROM `{DATASET_ID}.{TOP_TERMS_ID}`
-            WHERE
-                rank = 1
-                AND 
-                refresh_date BETWEEN @init_date AND @finish_date
-                AND
-                country_name = @country_name
-            GROUP BY Day, Top_Term
-            ORDER BY Day DESC
+        Build the query of the endpoint.
+
+        :param kwargs: The arguments of the URL.
+        :return: The query, its parameters and the table it reads from.
+        :raises ValueError: If an argument is invalid.
         """
+        query, query_params = cls.shape.build(**kwargs)
+        return query, query_params, cls.shape.table
 
-        # Sends the query to the process_query function
-        return process_query(query, query_params)
+    @staticmethod
+    def query_mirror(**kwargs):
+        """
+        Get the rows of the endpoint from the local mirror of the table.
+
+        :return: The rows, or None if the mirror does not cover the request.
+        """
+        return None
+
+    @staticmethod
+    def mirror_dates(**kwargs):
+        """
+        Get the dates query_mirror reads from the local mirror of the table.
+
+        :return: The first and last dates, or None if the endpoint is not answered from the mirror.
+        """
+        return None
+
+class BigQueryTopTermsDay(BigQueryShapeView):
+    """
+    The top 25 terms of a country on a day.
+    """
+    shape = TOP_TERMS_DAY
+
+    @staticmethod
+    def query_mirror(country_name, date):
+        """
+        Get the rows of the endpoint from the local mirror of the table.
+
+        :return: The rows, or None if the mirror does not cover the requested day.
+        """
+        return trendsMirror.top_terms_day(TOP_TERMS_TABLE, country_name, date)
+
+    @staticmethod
+    def mirror_dates(country_name, date):
+        return date, date
+
+class BigQueryTopTermsDate(BigQueryShapeView):
+    """
+    The top term of a country on each day of a range, or with the granularity query parameter:
+        - day (default): the top term of each day.
+        - week or month: the terms at rank 1 in each week or month, with the days they were at rank 1.
+        - auto: the coarsest of day, week and month that fits the length of the range.
+    """
+    shape = TOP_TERMS_DATES
+
+    def local_response(self, request, country_name, init_date, finish_date):
+        # Answer long ranges from the weekly or monthly rollups when the client accepts them
+        response = rollup_response(request, TOP_TERMS_TABLE, False, country_name, init_date, finish_date)
+        if response is not None:
+            return response
+        return super().local_response(request, country_name=country_name, init_date=init_date, finish_date=finish_date)
+
+    @staticmethod
+    def query_mirror(country_name, init_date, finish_date):
+        """
+        Get the rows of the endpoint from the local mirror of the table.
+
+        :return: The rows, or None if the mirror does not cover the requested range.
+        """
+        return trendsMirror.top_terms_dates(TOP_TERMS_TABLE, country_name, init_date, finish_date)
+
+    @staticmethod
+    def mirror_dates(country_name, init_date, finish_date):
+        return init_date, finish_date
+
+class BigQueryTopRisingTermsDay(BigQueryShapeView):
+    """
+    The top 25 rising terms of a country on a day.
+    """
+    shape = TOP_RISING_TERMS_DAY
+
+    @staticmethod
+    def query_mirror(country_name, date):
+        """
+        Get the rows of the endpoint from the local mirror of the table.
+
+        :return: The rows, or None if the mirror does not cover the requested day.
+        """
+        return trendsMirror.top_rising_terms_day(TOP_RISING_TERMS_TABLE, country_name, date)
+
+    @staticmethod
+    def mirror_dates(country_name, date):
+        return date, date
+
+class BigQueryTopRisingTermsDates(BigQueryShapeView):
+    """
+    The top rising term of a country on each day of a range, or with the granularity query parameter:
+        - day (default): the top rising term of each day.
+        - week or month: the terms at rank 1 in each week or month, with the days they were at rank 1.
+        - auto: the coarsest of day, week and month that fits the length of the range.
+    """
+    shape = TOP_RISING_TERMS_DATES
+
+    def local_response(self, request, country_name, init_date, finish_date):
+        # Answer long ranges from the weekly or monthly rollups when the client accepts them
+        response = rollup_response(request, TOP_RISING_TERMS_TABLE, True, country_name, init_date, finish_date)
+        if response is not None:
+            return response
+        return super().local_response(request, country_name=country_name, init_date=init_date, finish_date=finish_date)
+
+    @staticmethod
+    def query_mirror(country_name, init_date, finish_date):
+        """
+        Get the rows of the endpoint from the local mirror of the table.
+
+        :return: The rows, or None if the mirror does not cover the requested range.
+        """
+        return trendsMirror.top_rising_terms_dates(TOP_RISING_TERMS_TABLE, country_name, init_date, finish_date)
+
+    @staticmethod
+    def mirror_dates(country_name, init_date, finish_date):
+        return init_date, finish_date
     
-class BigQueryTopRisingTermsDay(APIView):
-    def get(self, request, country_name, date):
+class BigQueryDateIntervalTopTerms(BigQueryView):
+    def get(self, request):
         """
-        Handle GET requests to get the top rising terms for a given day from the BigQuery database.
+        Handle GET requests to get the minimum and maximum date for which we have data for top terms from BigQuery.
+        The dates come from the table metadata kept in memory, read again once per refresh cycle.
 
         :param request: The HTTP request object.
-        :param country_name: The country to get the top rising terms from.
-        :param date: The date to get the top rising terms from.
 
         :return: A JSON response.
             - If the request is processed correctly, returns: 
-                a list of all the top 25 rising terms for the given day
+                the minimum and maximum date for which we have data for top terms,
+                when they were read and how old they are
                 with HTTP status 200 (OK).
-            - If the request data is invalid, returns:
-                the serializer errors
-                with HTTP status 400 (Bad Request).
+            - If the table metadata could not be read, returns:
+                the error
+                with HTTP status 500 (Internal Server Error).
         """
-        # Define the parameters to use from the api request
-        query_params = [
-            bigquery.ScalarQueryParameter("date", "STRING", date),
-            bigquery.ScalarQueryParameter("country_name", "STRING", country_name),
-        ]
-        
-        # Query that selects the top 25 rising terms for a given day
-        query = f"""
-            SELECT
-                term AS Top_Term,
-                rank,
-                percent_gain
-             FROM `{DATASET_ID}.{TOP_RISING_TERMS_ID}`
-            WHERE
-                refresh_date = @date
-                AND
-                country_name = @country_name
-            GROUP BY Top_Term, rank, percent_gain
-            ORDER BY rank ASC
-        """
-
-        # Sends the query to the process_query function
-        return process_query(query, query_params)
+        return date_interval_response(TOP_TERMS_TABLE)
     
-class BigQueryTopRisingTermsDates(APIView):
-    def get(self, request, country_name, init_date, finish_date):
+class BigQueryDateIntervalTopRisingTerms(BigQueryView):
+    def get(self, request):
         """
-        Handle GET requests to get the top rising term for each day in a given range from the BigQuery database.
+        Handle GET requests to get the minimum and maximum date for which we have data for top rising terms from BigQuery.
+        The dates come from the table metadata kept in memory, read again once per refresh cycle.
 
         :param request: The HTTP request object.
-        :param country_name: The country to get the top rising terms from.
-        :param init_date: The initial date to get the top rising terms from.
-        :param finish_date: The final date to get the top rising terms from.
 
         :return: A JSON response.
             - If the request is processed correctly, returns: 
-                a list of all the top rising terms for each day in the given range
+                the minimum and maximum date for which we have data for top rising terms,
+                when they were read and how old they are
                 with HTTP status 200 (OK).
-            - If the request data is invalid, returns:
-                the serializer errors
-                with HTTP status 400 (Bad Request).
+            - If the table metadata could not be read, returns:
+                the error
+                with HTTP status 500 (Internal Server Error).
         """
-        # Define the parameters to use from the api request
-        query_params = [
-            bigquery.ScalarQueryParameter("init_date", "STRING", init_date),
-            bigquery.ScalarQueryParameter("finish_date", "STRING", finish_date),
-            bigquery.ScalarQueryParameter("country_name", "STRING", country_name),
-        ]
-        
-        # Query that selects the top rising term for each day in the given range
-        query = f"""
-            SELECT
-                refresh_date AS Day,
-                term AS Top_Term,
-                percent_gain
-             FROM `{DATASET_ID}.{TOP_RISING_TERMS_ID}`
-            WHERE
-                rank = 1
-                AND 
-                refresh_date BETWEEN @init_date AND @finish_date
-                AND
-                country_name = @country_name
-            GROUP BY Day, Top_Term, percent_gain
-            ORDER BY Day DESC
-        """
-
-        # Return the results as JSON
-        return process_query(query, query_params)
-    
-class BigQueryDateIntervalTopTerms(APIView):
+        return date_interval_response(TOP_RISING_TERMS_TABLE)
+
+class BigQueryCountriesTopTerms(BigQueryView):
     def get(self, request):
         """
-        Handle GET requests to get the minimum and maximum date for which we have data for top terms from BigQuery.
+        Handle GET requests to get the countries with top terms on the latest refresh date.
 
         :param request: The HTTP request object.
 
         :return: A JSON response.
-            - If the request is processed correctly, returns: 
-                the minimum and maximum date for which we have data for top terms
+            - If the request is processed correctly, returns:
+                the sorted list of countries, the refresh date they are from and when it was read
                 with HTTP status 200 (OK).
-            - If the request data is invalid, returns:
-                the serializer errors
-                with HTTP status 400 (Bad Request).
+            - If the table metadata could not be read, returns:
+                the error
+                with HTTP status 500 (Internal Server Error).
         """
-        # Query that selects the minimum date for which we have data for top terms
-        query = f"""
-            SELECT
-                MIN(refresh_date) AS min_refresh_date,
-                MAX(refresh_date) AS max_refresh_date
-             FROM `{DATASET_ID}.{TOP_TERMS_ID}`
+        return countries_response(TOP_TERMS_TABLE)
+
+class BigQueryCountriesTopRisingTerms(BigQueryView):
+    def get(self, request):
         """
+        Handle GET requests to get the countries with top rising terms on the latest refresh date.
 
-        # Return the results as JSON
-        return process_query(query, [])
-    
-class BigQueryDateIntervalTopRisingTerms(APIView):
+        :param request: The HTTP request object.
+
+        :return: A JSON response.
+            - If the request is processed correctly, returns:
+                the sorted list of countries, the refresh date they are from and when it was read
+                with HTTP status 200 (OK).
+            - If the table metadata could not be read, returns:
+                the error
+                with HTTP status 500 (Internal Server Error).
+        """
+        return countries_response(TOP_RISING_TERMS_TABLE)
+
+class BigQueryClientStats(BigQueryView):
     def get(self, request):
         """
-        Handle GET requests to get the minimum and maximum date for which we have data for top rising terms from BigQuery.
+        Handle GET requests to get statistics about the shared BigQuery client and its connection pool.
 
         :param request: The HTTP request object.
 
+        :return: A JSON response with the statistics and the state of the circuit breaker
+            with HTTP status 200 (OK).
+        """
+        return JsonResponse({**get_client_manager().stats(), 'circuit_breaker': bigquery_breaker.to_dict()})
+
+class BigQueryBatchView(BigQueryView):
+    """
+    Base class of the batch endpoints, which answer several countries and dates with one query.
+    Subclasses set the shapes of the queries of a list of dates and of a range (see batch_shapes).
+    """
+    dates_shape = None
+    range_shape = None
+    # Limits on the size of a batch
+    max_countries = 50
+    max_days = 366
+
+    @property
+    def table(self):
+        # Both shapes read the same table
+        return self.dates_shape.table
+
+    def get(self, request):
+        """
+        Handle GET requests for several countries and dates at once.
+
+        :param request: The HTTP request object, with the query parameters:
+            - country: a country to get the terms from, can be repeated.
+            - date: a date to get the terms from, can be repeated.
+            - init_date and finish_date: a date range, instead of the date parameters.
+
         :return: A JSON response.
-            - If the request is processed correctly, returns: 
-                the minimum and maximum date for which we have data for top rising terms
+            - If the request is processed correctly, returns:
+                the rows grouped by country and date, {country: {date: [rows]}}
                 with HTTP status 200 (OK).
-            - If the request data is invalid, returns:
-                the serializer errors
+            - If the parameters are invalid, returns:
+                the error
                 with HTTP status 400 (Bad Request).
+            - If the client already has the current data (If-None-Match or If-Modified-Since), returns:
+                an empty response
+                with HTTP status 304 (Not Modified).
         """
-        # Query that selects the minimum date for which we have data for top rising terms
-        query = f"""
-            SELECT
-                MIN(refresh_date) AS min_refresh_date,
-                MAX(refresh_date) AS max_refresh_date
-             FROM `{DATASET_ID}.{TOP_RISING_TERMS_ID}`
+        try:
+            query, query_params = self.build_query(
+                request.query_params.getlist('country'),
+                request.query_params.getlist('date'),
+                request.query_params.get('init_date'),
+                request.query_params.get('finish_date'),
+            )
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+        def respond():
+            try:
+                # Only estimate the cost of the query when its results are not cached
+                estimated_bytes = None
+                rows = peek_cached_rows(query, query_params, self.table)
+                if rows is None:
+                    estimated_bytes = check_query_cost(query, query_params, self.table)
+                    rows = run_query(query, query_params, self.table)
+            except QueryOverBudget as e:
+                return JsonResponse(e.to_dict(), status=400)
+            # If there is an error, answer with the last good results or the error
+            except Exception as e:
+                return fallback_response(e, query, query_params, lambda rows: JsonResponse(group_batch_rows(rows)))
+            shape = self.dates_shape if request.query_params.getlist('date') else self.range_shape
+            shape.observe(QUERY, estimated_bytes)
+
+            # Check if the result set is empty
+            if not rows:
+                return JsonResponse({"error": "No data found"}, status=404)
+            response = JsonResponse(group_batch_rows(rows))
+            if estimated_bytes is not None:
+                response[ESTIMATE_HEADER] = str(estimated_bytes)
+            return response
+
+        # Answer with 304 Not Modified when the client already has the current data
+        return conditional_query_response(request, query, query_params, self.table, respond)
+
+    def build_query(self, countries, dates, init_date=None, finish_date=None):
         """
+        Build the batch query.
+
+        :param countries: The countries to get the terms from.
+        :param dates: The dates to get the terms from, as YYYY-MM-DD strings.
+        :param init_date: The initial date of a range, used when no dates are given.
+        :param finish_date: The final date of a range, used when no dates are given.
+        :return: The query and its parameters.
+        :raises ValueError: If the countries or dates are missing or invalid.
+        """
+        if not countries:
+            raise ValueError("At least one country is required")
+        if len(countries) > self.max_countries:
+            raise ValueError(f"At most {self.max_countries} countries can be requested at once")
+
+        if dates:
+            days = [parse_date(day) for day in dates]
+            if len(days) > self.max_days:
+                raise ValueError(f"At most {self.max_days} dates can be requested at once")
+            return self.dates_shape.build(countries=countries, dates=days)
+        if init_date and finish_date:
+            first_day, last_day = parse_date(init_date), parse_date(finish_date)
+            if (last_day - first_day).days >= self.max_days:
+                raise ValueError(f"At most {self.max_days} days can be requested at once")
+            return self.range_shape.build(countries=countries, init_date=first_day, finish_date=last_day)
+        raise ValueError("Either dates or init_date and finish_date are required")
+
+class BigQueryTopTermsBatch(BigQueryBatchView):
+    """
+    Top 25 terms of several countries and dates.
+    """
+    dates_shape = TOP_TERMS_BATCH_DATES
+    range_shape = TOP_TERMS_BATCH_RANGE
+
+class BigQueryTopRisingTermsBatch(BigQueryBatchView):
+    """
+    Top 25 rising terms of several countries and dates.
+    """
+    dates_shape = TOP_RISING_TERMS_BATCH_DATES
+    range_shape = TOP_RISING_TERMS_BATCH_RANGE
+
+class BigQueryJobSubmitView(BigQueryView):
+    """
+    Base class of the endpoints that queue the query of another endpoint as a background job.
+    Subclasses point query_view to the endpoint whose query they run.
+    """
+    query_view = None
+
+    def post(self, request, **kwargs):
+        """
+        Handle POST requests to queue the query of query_view with the parameters of the URL.
+        Queries answered by the mirror or the cache are recorded as finished jobs at once.
+
+        :param request: The HTTP request object.
+        :param kwargs: The parameters of the query, as in the URL of query_view.
+
+        :return: A JSON response.
+            - If the job is queued, returns:
+                the status of the job with its status_url and result_url
+                with HTTP status 202 (Accepted) and the status URL in the Location header.
+            - If the parameters are invalid or the query is over budget, returns:
+                the error
+                with HTTP status 400 (Bad Request).
+            - If the backlog of the queue is full, returns:
+                the error
+                with HTTP status 429 (Too Many Requests) and a Retry-After header.
+        """
+        queue = get_job_queue()
+        try:
+            query, query_params, table = self.query_view.build_query(**kwargs)
+            # Answer from the local mirror or the cache when they have the results
+            rows = self.query_view.query_mirror(**kwargs)
+            if rows is None:
+                _, rows = get_cached_rows(query, query_params, table)
+            if rows is not None:
+                job = queue.finished(request.path, rows)
+            else:
+                # Reject the queries that would scan too much before queuing them
+                check_query_cost(query, query_params, table)
+                job = queue.submit(request.path, lambda job: run_job_query(job, query, query_params, table))
+        except QueryOverBudget as e:
+            return JsonResponse(e.to_dict(), status=400)
+        except QueueFull as e:
+            response = JsonResponse({"error": str(e)}, status=429)
+            response['Retry-After'] = '5'
+            return response
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        # If there is an error, return a JSON response with the error
+        except Exception as e:
+            return error_response(e)
+
+        status_url = request.build_absolute_uri(reverse('bigquery-job-status-endpoint', args=[job.id]))
+        result_url = request.build_absolute_uri(reverse('bigquery-job-result-endpoint', args=[job.id]))
+        response = JsonResponse({**job.to_dict(), 'status_url': status_url, 'result_url': result_url}, status=202)
+        response['Location'] = status_url
+        return response
+
+class BigQueryTopTermsDateJob(BigQueryJobSubmitView):
+    query_view = BigQueryTopTermsDate
+
+class BigQueryTopRisingTermsDatesJob(BigQueryJobSubmitView):
+    query_view = BigQueryTopRisingTermsDates
+
+class BigQueryJobStatus(BigQueryView):
+    def get(self, request, job_id):
+        """
+        Handle GET requests to get the status and progress of a background job.
+
+        :param request: The HTTP request object.
+        :param job_id: The id of the job.
+
+        :return: A JSON response.
+            - If the job exists, returns:
+                its state (queued, running, done or failed), its timings, the rows fetched so far and its error
+                with HTTP status 200 (OK).
+            - If the job does not exist or expired, returns:
+                the error
+                with HTTP status 404 (Not Found).
+        """
+        job = get_job_queue().get(job_id)
+        if job is None:
+            return JsonResponse({"error": f"Job {job_id} not found"}, status=404)
+        return JsonResponse(job.to_dict())
+
+class BigQueryJobResult(BigQueryView):
+    # Longest wait a client can ask for with the wait query parameter, in seconds
+    max_wait = 30
+
+    def get(self, request, job_id):
+        """
+        Handle GET requests to get the rows of a background job.
+
+        :param request: The HTTP request object, with the optional query parameter wait, the number
+            of seconds to wait for the job to finish. The stream and format query parameters of the
+            BigQuery endpoints are supported.
+        :param job_id: The id of the job.
+
+        :return: A JSON response.
+            - If the job is done, returns:
+                the rows of the query
+                with HTTP status 200 (OK).
+            - If the job is not finished yet, returns:
+                the status of the job
+                with HTTP status 202 (Accepted).
+            - If the job failed, returns:
+                the error
+                with HTTP status 500 (Internal Server Error).
+            - If the job does not exist or expired, returns:
+                the error
+                with HTTP status 404 (Not Found).
+        """
+        job = get_job_queue().get(job_id)
+        if job is None:
+            return JsonResponse({"error": f"Job {job_id} not found"}, status=404)
+        try:
+            wait = min(float(request.GET.get('wait', 0)), self.max_wait)
+        except ValueError:
+            return JsonResponse({"error": f"Invalid wait: {request.GET['wait']}"}, status=400)
+        if wait > 0:
+            job.wait(wait)
+
+        if job.state == FAILED:
+            return JsonResponse({"error": job.error}, status=500)
+        if job.state != DONE:
+            return JsonResponse(job.to_dict(), status=202)
+        return rows_response(job.rows, request)
+
+class BigQueryAnalyticsView(BigQueryView):
+    """
+    Base class of the analytics endpoints, which compute metrics over the rows of a date range.
+    Every metric of a range is computed from the same query results, so a dashboard showing
+    several of them runs a single BigQuery job. Subclasses set the table to read from.
+    """
+    table = None
+    # Limits on the size of a range
+    max_countries = 50
+    max_days = 366
+
+    def get(self, request, metric):
+        """
+        Handle GET requests to compute a metric over the terms of some countries in a date range.
+
+        :param request: The HTTP request object, with the query parameters:
+            - country: a country to get the terms from, can be repeated.
+            - init_date: the first day of the range.
+            - finish_date: the last day of the range.
+        :param metric: The metric to compute:
+            - persistence: for each country and term, its days present, first and last day seen,
+                longest and current streak, and best, mean and standard deviation of rank.
+            - overlap: the terms each pair of countries shares and their Jaccard index.
+
+        :return: A JSON response.
+            - If the request is processed correctly, returns:
+                the metric
+                with HTTP status 200 (OK).
+            - If the parameters are invalid or the query is over budget, returns:
+                the error
+                with HTTP status 400 (Bad Request).
+            - If the metric does not exist or there is no data in the range, returns:
+                the error
+                with HTTP status 404 (Not Found).
+            - If the client already has the current data (If-None-Match or If-Modified-Since), returns:
+                an empty response
+                with HTTP status 304 (Not Modified).
+        """
+        compute = ANALYTICS_METRICS.get(metric)
+        if compute is None:
+            return JsonResponse({"error": f"Unknown metric: {metric}"}, status=404)
+        try:
+            countries = request.query_params.getlist('country')
+            init_date = parse_date(request.query_params.get('init_date'))
+            finish_date = parse_date(request.query_params.get('finish_date'))
+            if not countries:
+                raise ValueError("At least one country is required")
+            if len(countries) > self.max_countries:
+                raise ValueError(f"At most {self.max_countries} countries can be requested at once")
+            if not 0 <= (finish_date - init_date).days < self.max_days:
+                raise ValueError(f"The range must have between 1 and {self.max_days} days")
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+        query, query_params = build_range_query(self.table, sorted(set(countries)), init_date, finish_date)
+        def respond():
+            try:
+                # Only estimate the cost of the range query when neither the metric nor its results are cached
+                estimated_bytes = None
+                if not is_cached(query, query_params, self.table, ':arrow', ':' + metric):
+                    estimated_bytes = check_query_cost(query, query_params, self.table)
+                result = run_analytics(query, query_params, self.table, metric, compute, init_date, finish_date)
+            except QueryOverBudget as e:
+                return JsonResponse(e.to_dict(), status=400)
+            # If there is an error, return a JSON response with the error
+            except Exception as e:
+                return error_response(e)
+
+            if result is None:
+                return JsonResponse({"error": "No data found"}, status=404)
+            response = JsonResponse(result, safe=False)
+            if estimated_bytes is not None:
+                response[ESTIMATE_HEADER] = str(estimated_bytes)
+            return response
+
+        # Answer with 304 Not Modified when the client already has the current data
+        return conditional_query_response(request, query, query_params, self.table, respond)
+
+class BigQueryTopTermsAnalytics(BigQueryAnalyticsView):
+    table = TOP_TERMS_TABLE
+
+class BigQueryTopRisingTermsAnalytics(BigQueryAnalyticsView):
+    table = TOP_RISING_TERMS_TABLE
+
+def parse_date(value):
+    """
+    Parse a date received from the API.
+
+    :param value: The date as a YYYY-MM-DD string.
+    :return: The date.
+    :raises ValueError: If the date is not valid.
+    """
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid date: {value}")
+
+def group_batch_rows(rows):
+    """
+    Group the rows of a batch query by country and date.
+
+    :param rows: The rows of the query, with country_name and Day columns.
+    :return: A dictionary {country: {date: [rows without country_name and Day]}}.
+    """
+    grouped = {}
+    for row in rows:
+        row = dict(row)
+        country = row.pop('country_name')
+        day = row.pop('Day')
+        grouped.setdefault(country, {}).setdefault(str(day), []).append(row)
+    return grouped
+
+# Metadata of the tables (date bounds and countries), kept in memory for one refresh cycle
+table_metadata = TableMetadataService(lambda: get_client())
+
+# Dry-run estimates of the queries, used to reject the ones over budget
+cost_guard = QueryCostGuard(lambda: get_client())
+
+def rollup_response(request, table, with_percent_gain, country_name, init_date, finish_date):
+    """
+    Build the response of a range endpoint at the granularity requested with the granularity query parameter.
+    The rows come from the coarsest rollup that covers the range, or are summarized by BigQuery otherwise.
+
+    :param request: The HTTP request object.
+    :param table: The fully qualified table the endpoint reads from.
+    :param with_percent_gain: Whether the table has a percent_gain column.
+    :param country_name: The country to get the terms from.
+    :param init_date: The initial date of the range.
+    :param finish_date: The final date of the range.
+    :return: A JSON response with the granularity used in the X-Granularity header,
+        or None if the daily rows are requested.
+    """
+    requested = request.GET.get('granularity')
+    if requested in (None, '', 'day'):
+        return None
+    try:
+        first_day, last_day = parse_date(init_date), parse_date(finish_date)
+        granularity = trendsRollups.choose_granularity(requested, first_day, last_day)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    if granularity == 'day':
+        return None
+
+    if requested == 'auto':
+        granularity, rows = trendsRollups.coarsest_rollup_rows(
+            table, granularity, with_percent_gain, country_name, first_day, last_day,
+        )
+    else:
+        rows = trendsRollups.range_rows(table, granularity, with_percent_gain, country_name, first_day, last_day)
+    if rows is not None:
+        response = rows_response(rows, request)
+    else:
+        query, query_params = trendsRollups.build_range_query(
+            table, granularity, with_percent_gain, country_name, first_day, last_day,
+        )
+        response = process_query(query, query_params, table, request=request)
+    response['X-Granularity'] = granularity
+    return response
+
+def conditional_query_response(request, query, query_params, table, build_response, mirror_dates=None):
+    """
+    Build the response of a query with its ETag, Last-Modified and Cache-Control headers, or answer
+    with 304 Not Modified without running the query when the client already has the current data.
+
+    :param request: The HTTP request object.
+    :param query: The query of the endpoint.
+    :param query_params: The parameters of the query.
+    :param table: The fully qualified table the query reads from.
+    :param build_response: A function that runs the query and returns its response.
+    :param mirror_dates: The first and last dates the request reads from the local mirror, None if it does not.
+    :return: The HTTP response.
+    """
+    validator = response_validator(request, query, query_params, table, mirror_dates)
+    if validator is None:
+        return build_response()
+    cache_key, watermark = validator
+    return conditional_response(request, get_query_cache(), cache_key, watermark, build_response)
+
+def response_validator(request, query, query_params, table, mirror_dates=None):
+    """
+    Count a request and get what its response is validated against.
+
+    :param request: The HTTP request object.
+    :param query: The query of the endpoint.
+    :param query_params: The parameters of the query.
+    :param table: The fully qualified table the query reads from.
+    :param mirror_dates: The first and last dates the request reads from the local mirror, None if it does not.
+    :return: The cache key of the query at the watermark of the request and the watermark, or None if the
+        watermark is not known.
+    """
+    # Count the request, the most requested ones are warmed when the table is refreshed
+    cacheWarming.track_request(request)
+    try:
+        watermark = request_watermark(table, mirror_dates)
+    except Exception:
+        # Without the watermark there is nothing to validate against
+        return None
+    return make_cache_key(query, query_params, watermark), watermark
+
+def request_watermark(table, mirror_dates=None):
+    """
+    Get the watermark the data of a request changes with.
+
+    :param table: The fully qualified table the request reads from.
+    :param mirror_dates: The first and last dates the request reads from the local mirror, None if it does not.
+    :return: The watermark of the mirror when it covers the dates, since the data served changes when the
+        mirror is synced, the watermark of the BigQuery table otherwise.
+    """
+    if mirror_dates is not None:
+        first_date, last_date = (trendsMirror.parse_date(value) for value in mirror_dates)
+        if trendsMirror.covers(table, first_date, last_date):
+            return trendsMirror.watermark(table)
+    return fetch_watermark(table)
+
+def check_query_cost(query, query_params, table=None):
+    """
+    Estimate the bytes a query scans and reject it if it is over the per-request budget.
+
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :param table: The fully qualified table the query reads from.
+    :return: The estimated number of bytes processed, or None if dry runs are disabled.
+    :raises QueryOverBudget: If the query is over budget.
+    """
+    watermark = fetch_watermark(table) if table is not None else None
+    return cost_guard.check(query, query_params, watermark)
+
+def fetch_watermark(table):
+    """
+    Get the refresh watermark of a table, the latest refresh date it has data for.
+
+    :param table: The fully qualified table name.
+    :return: The MAX(refresh_date) of the table.
+    """
+    return table_metadata.get(table).max_refresh_date
+
+def date_interval_response(table):
+    """
+    Build the response of the date interval endpoints from the table metadata.
+
+    :param table: The fully qualified table name.
+    :return: A JSON response with the date bounds of the table and their freshness.
+    """
+    try:
+        metadata = table_metadata.get(table)
+        if metadata.max_refresh_date is None:
+            return JsonResponse({"error": "No data found"}, status=404)
+        response = JsonResponse([metadata.to_dict()], safe=False)
+        # Tell caches how old the values already are
+        response['Age'] = str(int(metadata.age()))
+        return response
+    # If there is an error, return a JSON response with the error
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
+
+def countries_response(table):
+    """
+    Build the response of the countries endpoints from the table metadata.
+
+    :param table: The fully qualified table name.
+    :return: A JSON response with the countries of the latest refresh date.
+    """
+    try:
+        metadata, countries = table_metadata.get_countries(table)
+        if not countries:
+            return JsonResponse({"error": "No data found"}, status=404)
+        response = JsonResponse({
+            "countries": countries,
+            "refresh_date": metadata.max_refresh_date,
+            "fetched_at": metadata.to_dict()['fetched_at'],
+        })
+        response['Age'] = str(int(metadata.age()))
+        return response
+    # If there is an error, return a JSON response with the error
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
+
+# Coalesces identical queries that run at the same time into a single job
+query_flights = SingleFlight()
+
+def submit_query(query, query_params):
+    """
+    Start a query job on BigQuery without waiting for it. Sending the job is bounded by the deadline.
+
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :return: The BigQuery query job.
+    """
+    # Get the current thread BigQuery client
+    client = get_client()
+    # Run the query
+    return client.query(
+        query,
+        job_config=bigquery.QueryJobConfig(
+            query_parameters=query_params,
+            # Let BigQuery fail jobs that would scan more than allowed
+            maximum_bytes_billed=get_maximum_bytes_billed(),
+        ),
+        timeout=remaining_time(),
+    )
+
+def fetch_rows(query_job):
+    """
+    Wait for a query job and return its rows.
+
+    :param query_job: The BigQuery query job.
+    :return: A list of dictionaries with the rows of the query.
+    """
+    started = time.perf_counter()
+    # Fetch and process the results, within the deadline of the request
+    rows = [dict(row.items()) for row in job_result(query_job)]
+    observe_query_job(query_job, len(rows), time.perf_counter() - started)
+    return rows
+
+def fetch_arrow_table(query_job):
+    """
+    Wait for a query job and return its rows as an Arrow table.
+
+    :param query_job: The BigQuery query job.
+    :return: A pyarrow Table.
+    """
+    started = time.perf_counter()
+    arrow_table = results_to_arrow(job_result(query_job))
+    observe_query_job(query_job, arrow_table.num_rows, time.perf_counter() - started)
+    return arrow_table
+
+def execute_query(query, query_params):
+    """
+    Run a query on BigQuery and return its rows, retrying it on retryable errors within the deadline.
+
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :return: A list of dictionaries with the rows of the query.
+    """
+    return call_with_retries(lambda: fetch_rows(submit_query(query, query_params)))
+
+def store_rows(cache_key, query, query_params, rows):
+    """
+    Cache the rows of a query, and keep them as its last good results.
+
+    :param cache_key: The cache key of the query.
+    :param query: The query.
+    :param query_params: The parameters of the query.
+    :param rows: A list of dictionaries with the rows of the query.
+    """
+    cache = get_query_cache()
+    cache.set(cache_key, rows)
+    # Kept past the next refresh of the table, to be served while the query fails
+    store_last_good(cache, query, query_params, rows)
+
+def get_cached_rows(query, query_params, table):
+    """
+    Look up the cached results of a query.
+
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :param table: The fully qualified table the query reads from.
+    :return: The cache key of the query and its cached rows, or None if they are not cached.
+    """
+    # The key changes when the table is refreshed, which invalidates older entries
+    cache_key = make_cache_key(query, query_params, fetch_watermark(table))
+    rows = get_query_cache().get(cache_key)
+    observe_cache_lookup(rows is not None)
+    return cache_key, rows
+
+def peek_cached_rows(query, query_params, table):
+    """
+    Look up the cached results of a query before deciding whether to estimate its cost and run it.
+    Only hits are counted in the cache metrics, misses are counted when run_query looks them up again.
+
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :param table: The fully qualified table the query reads from.
+    :return: The cached rows of the query, or None if they are not cached.
+    """
+    rows = get_query_cache().get(make_cache_key(query, query_params, fetch_watermark(table)))
+    if rows is not None:
+        observe_cache_lookup(True)
+    return rows
+
+def is_cached(query, query_params, table, *suffixes):
+    """
+    Check whether the results of a query, or the entries derived from them, are in the result cache.
+
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :param table: The fully qualified table the query reads from.
+    :param suffixes: The suffixes of the derived entries to look for, such as ':arrow'.
+    :return: True if any of them is cached.
+    """
+    cache_key = make_cache_key(query, query_params, fetch_watermark(table))
+    cache = get_query_cache()
+    return any(cache.get(cache_key + suffix) is not None for suffix in ('', *suffixes))
+
+def cached_response(query, query_params, table, request=None):
+    """
+    Build the response of a query from the result cache, without estimating its cost or running it.
+
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :param table: The fully qualified table the query reads from.
+    :param request: The HTTP request object, used to pick the response format.
+    :return: The response, or None if the results are not cached or the requested format is unknown.
+    """
+    # Unknown formats are rejected by query_response
+    stream_format = get_stream_format(request)
+    result_format = get_result_format(request)
+    if stream_format not in (None, *STREAM_FORMATS) or result_format not in (None, *RESULT_FORMATS):
+        return None
+
+    rows = peek_cached_rows(query, query_params, table)
+    if rows is not None:
+        return rows_response(rows, request)
+    # Columnar responses can also be built from the cached Arrow table of the query
+    if result_format in RESULT_FORMATS:
+        arrow_table = get_query_cache().get(make_cache_key(query, query_params, fetch_watermark(table)) + ':arrow')
+        if arrow_table is not None:
+            return columnar_response(arrow_table, result_format)
+    return None
+
+def run_query(query, query_params, table=None):
+    """
+    Run a query through the result cache and return its rows.
+    Concurrent calls with the same query and parameters share a single BigQuery job.
+
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :param table: The fully qualified table the query reads from, None to skip the cache.
+    :return: A list of dictionaries with the rows of the query.
+    """
+    if table is None:
+        return query_flights.do(
+            make_cache_key(query, query_params), lambda: execute_query(query, query_params), remaining_time(),
+        )
+
+    cache_key, rows = get_cached_rows(query, query_params, table)
+    if rows is not None:
+        return rows
+
+    def execute_and_store():
+        rows = execute_query(query, query_params)
+        # Store the results for the next requests
+        store_rows(cache_key, query, query_params, rows)
+        return rows
+
+    return query_flights.do(cache_key, execute_and_store, remaining_time())
+
+def run_job_query(job, query, query_params, table):
+    """
+    Run the query of a background job, reporting the rows fetched as they are read, and cache its rows.
+
+    :param job: The QueryJob, whose progress is updated.
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :param table: The fully qualified table the query reads from.
+    :return: A list of dictionaries with the rows of the query.
+    """
+    cache_key, rows = get_cached_rows(query, query_params, table)
+    if rows is not None:
+        job.total_rows = job.rows_fetched = len(rows)
+        return rows
+
+    def fetch_job_rows():
+        query_job = submit_query(query, query_params)
+        job.bigquery_job_id = getattr(query_job, 'job_id', None)
+        started = time.perf_counter()
+        results = job_result(query_job, page_size=get_stream_page_size())
+        job.total_rows = getattr(results, 'total_rows', None)
+        job.rows_fetched = 0
+        rows = []
+        for row in results:
+            rows.append(dict(row.items()))
+            job.rows_fetched += 1
+        observe_query_job(query_job, len(rows), time.perf_counter() - started)
+        return rows
+
+    # Run the query through the circuit breaker, retrying it on retryable errors
+    rows = call_with_retries(fetch_job_rows)
+    # Store the results for the next requests
+    store_rows(cache_key, query, query_params, rows)
+    return rows
+
+def fetch_arrow(query, query_params, table):
+    """
+    Get the results of a query as an Arrow table, from the cache or from BigQuery.
+    The Arrow table is cached next to the rows of the query, where columnar_query looks for it.
+
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :param table: The fully qualified table the query reads from.
+    :return: A pyarrow Table.
+    """
+    cache_key, rows = get_cached_rows(query, query_params, table)
+    if rows is not None:
+        return rows_to_arrow(rows)
+    arrow_key = cache_key + ':arrow'
+    arrow_table = get_query_cache().get(arrow_key)
+    if arrow_table is None:
+        arrow_table = query_flights.do(
+            arrow_key,
+            lambda: call_with_retries(lambda: fetch_arrow_table(submit_query(query, query_params))),
+            remaining_time(),
+        )
+        get_query_cache().set(arrow_key, arrow_table)
+    return arrow_table
+
+def run_analytics(query, query_params, table, metric, compute, init_date, finish_date):
+    """
+    Compute a metric over the results of a range query. The metric is cached per range.
+
+    :param query: The range query.
+    :param query_params: The parameters of the query.
+    :param table: The fully qualified table the query reads from.
+    :param metric: The name of the metric.
+    :param compute: The function that computes the metric from a DataFrame and the bounds of the range.
+    :param init_date: The first day of the range.
+    :param finish_date: The last day of the range.
+    :return: The metric, or None if the range has no rows.
+    """
+    metric_key = make_cache_key(query, query_params, fetch_watermark(table)) + ':' + metric
+    result = get_query_cache().get(metric_key)
+    if result is None:
+        arrow_table = fetch_arrow(query, query_params, table)
+        if arrow_table.num_rows == 0:
+            return None
+        result = compute(arrow_table.to_pandas(), init_date, finish_date)
+        get_query_cache().set(metric_key, result)
+    return result
 
-        # Return the results as JSON
-        return process_query(query, [])
-    
 @staticmethod
-def process_query(query, query_params):
+def process_query(query, query_params, table=None, request=None):
     """
     Process the BigQuery results into a list of dictionaries.
 
     :param query: The query to run.
     :param query_params: The parameters to use in the query.
+    :param table: The fully qualified table the query reads from, used to cache the results.
+    :param request: The HTTP request object, used to pick the response format.
     :return: A JSON response with the results of the query.
     """
     try:
-        # Get the current thread BigQuery client
-        client = get_client()
-        # Run the query
-        query_job = client.query(
-            query,
-            job_config=bigquery.QueryJobConfig(query_parameters=query_params),
-        )
+        # Answer from the result cache without a dry run when the results are cached
+        if table is not None:
+            response = cached_response(query, query_params, table, request)
+            if response is not None:
+                return response
+        # Reject the queries that would scan too much before running them
+        estimated_bytes = check_query_cost(query, query_params, table)
+        response = query_response(query, query_params, table, request)
+    except QueryOverBudget as e:
+        bigquery_errors.inc(error=type(e).__name__)
+        return JsonResponse(e.to_dict(), status=400)
+    # If there is an error, answer with the last good results or the error
+    except Exception as e:
+        bigquery_errors.inc(error=type(e).__name__)
+        return fallback_response(e, query, query_params, lambda rows: rows_response(rows, request))
 
-        # Fetch the results
-        results = query_job.result()
-        # Process the results
-        rows = [dict(row.items()) for row in results]
+    if estimated_bytes is not None:
+        response[ESTIMATE_HEADER] = str(estimated_bytes)
+    return response
 
-        # Check if the result set is empty
-        if not rows:
-            return JsonResponse({"error": "No data found"}, status=404)
+def query_response(query, query_params, table=None, request=None):
+    """
+    Run a query and build its response in the format the client asked for.
 
-        # Return the results as JSON
-        return JsonResponse(rows, safe=False)
-    # If there is an error, return a JSON response with the error
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :param table: The fully qualified table the query reads from, used to cache the results.
+    :param request: The HTTP request object, used to pick the response format.
+    :return: An HTTP response with the results of the query.
+    """
+    # Stream the rows as they are read when the client asks for it
+    stream_format = get_stream_format(request)
+    if stream_format is not None:
+        return stream_query(query, query_params, table, stream_format)
+
+    # Answer in a columnar format when the client asks for it
+    result_format = get_result_format(request)
+    if result_format is not None:
+        return columnar_query(query, query_params, table, result_format)
+
+    # Run the query or get its cached results
+    rows = run_query(query, query_params, table)
+    return rows_response(rows, request)
+
+def stream_query(query, query_params, table, stream_format):
+    """
+    Run a query and stream its rows page by page instead of loading them all in memory.
+    Cached results are streamed from the cache, new results are not cached. The first page is
+    fetched within the deadline of the endpoint, through the retries and the circuit breaker;
+    the next ones as the response is sent (see read_later_pages).
+
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :param table: The fully qualified table the query reads from, None to skip the cache.
+    :param stream_format: The streaming format, 'json' or 'ndjson'.
+    :return: A streaming response with the rows of the query.
+    """
+    if stream_format not in STREAM_FORMATS:
+        return JsonResponse({"error": f"Unknown stream format: {stream_format}"}, status=400)
+
+    rows = None
+    if table is not None:
+        _, rows = get_cached_rows(query, query_params, table)
+    if rows is None:
+        def first_page():
+            pages = job_result(submit_query(query, query_params), page_size=get_stream_page_size()).pages
+            return list(next(pages, [])), pages
+
+        # Read the results lazily, one page at a time
+        page, pages = call_with_retries(first_page)
+        rows = (dict(row.items()) for row in chain(page, read_later_pages(pages)))
+    return streaming_rows_response(rows, stream_format)
+
+def read_later_pages(pages):
+    """
+    Read the pages of query results after the first one, while their response is streamed.
+    Each fetch is bounded by the timeout the results were requested with. It cannot be retried,
+    since the rows before it are already sent, so a failure is recorded by the circuit breaker
+    and ends the stream.
+
+    :param pages: The iterator of the pages of a RowIterator, past its first page.
+    :return: A generator of the rows.
+    """
+    try:
+        for page in pages:
+            yield from page
     except Exception as e:
-        return JsonResponse({"error": str(e)}, status=500)
\ No newline at end of file
+        bigquery_breaker.record(e)
+        raise
+
+def columnar_query(query, query_params, table, result_format):
+    """
+    Run a query and answer in a columnar format, built from the Arrow table of the results.
+    The Arrow table is cached next to the rows of the query.
+
+    :param query: The query to run.
+    :param query_params: The parameters to use in the query.
+    :param table: The fully qualified table the query reads from, None to skip the cache.
+    :param result_format: The columnar format, 'arrow', 'columnar' or 'compact'.
+    :return: A response with the results of the query in the requested format.
+    """
+    if result_format not in RESULT_FORMATS:
+        return JsonResponse({"error": f"Unknown format: {result_format}"}, status=400)
+
+    arrow_key = None
+    if table is not None:
+        cache_key, rows = get_cached_rows(query, query_params, table)
+        if rows is not None:
+            return columnar_rows_response(rows, result_format)
+        arrow_key = cache_key + ':arrow'
+        arrow_table = get_query_cache().get(arrow_key)
+        if arrow_table is not None:
+            return columnar_response(arrow_table, result_format)
+
+    if import_pyarrow() is None:
+        if result_format == 'arrow':
+            return pyarrow_missing_response()
+        return columnar_rows_response(run_query(query, query_params, table), result_format)
+
+    # Download the results straight into Arrow, without building a dictionary per row
+    arrow_table = call_with_retries(lambda: fetch_arrow_table(submit_query(query, query_params)))
+    if arrow_key is not None:
+        get_query_cache().set(arrow_key, arrow_table)
+    return columnar_response(arrow_table, result_format)
+
+def rows_response(rows, request=None):
+    """
+    Build the JSON response for the rows of a query.
+
+    :param rows: A list of dictionaries with the rows of the query.
+    :param request: The HTTP request object, used to pick the response format.
+    :return: A JSON response with the rows, or a 404 response if there are none.
+    """
+    # Stream the rows when the client asks for it
+    stream_format = get_stream_format(request)
+    if stream_format in STREAM_FORMATS:
+        return streaming_rows_response(rows, stream_format)
+    # Answer in a columnar format when the client asks for it
+    result_format = get_result_format(request)
+    if result_format in RESULT_FORMATS:
+        return columnar_rows_response(rows, result_format)
+
+    # Check if the result set is empty
+    if not rows:
+        return JsonResponse({"error": "No data found"}, status=404)
+
+    # Return the results as JSON
+    return JsonResponse(rows, safe=False)
+
+def error_response(error):
+    """
+    Build the JSON response of a query that failed.
+
+    :param error: The exception raised by the query.
+    :return: A JSON response with the error
+        with HTTP status 503 (Service Unavailable) and a Retry-After header while the circuit breaker is open,
+        504 (Gateway Timeout) if the deadline of the endpoint passed, or 500 (Internal Server Error) otherwise.
+    """
+    if isinstance(error, CircuitOpen):
+        response = JsonResponse({"error": str(error)}, status=503)
+        response['Retry-After'] = str(math.ceil(error.retry_after))
+        return response
+    if isinstance(error, timeout_errors()):
+        return JsonResponse({"error": str(error) or "The query did not finish in time"}, status=504)
+    return JsonResponse({"error": str(error)}, status=500)
+
+def fallback_response(error, query, query_params, build_response):
+    """
+    Answer a query that failed with its last good results, marked stale, or with the error if there are none.
+
+    :param error: The exception raised by the query.
+    :param query: The query.
+    :param query_params: The parameters of the query.
+    :param build_response: A function that builds the response from the rows of the query.
+    :return: The HTTP response.
+    """
+    try:
+        rows = get_last_good(get_query_cache(), query, query_params)
+    except Exception:
+        rows = None
+    if rows is None:
+        return error_response(error)
+    return mark_stale(build_response(rows))
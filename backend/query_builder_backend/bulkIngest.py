@@ -0,0 +1,166 @@
+"""
+Bulk ingestion of saved queries and comments.
+
+A bulk request carries many items, as a JSON array or as NDJSON (one JSON
+object per line). Every item is validated with the serializer of the single
+item endpoint, and the valid ones are written with bulk_create in batches, one
+transaction per batch, instead of one INSERT and one transaction per request.
+Invalid items are reported by their index and do not stop the others.
+"""
+import json
+from django.conf import settings
+from django.db import transaction
+from rest_framework import serializers
+from .querySearch import update_search_vectors
+
+# Default configuration of the bulk endpoints, overridable with settings.BULK_INGEST
+DEFAULT_BULK_SETTINGS = {
+    'BATCH_SIZE': 500,
+    'MAX_ITEMS': 50000,
+    'MAX_BODY_SIZE': 32 * 1024 * 1024,
+}
+
+# Content types of an NDJSON body
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+
+class BodyTooLarge(Exception):
+    """
+    Raised when the body of a bulk request is larger than BULK_INGEST['MAX_BODY_SIZE'].
+    """
+
+
+def get_bulk_settings():
+    """
+    Get the bulk ingestion settings merged over the defaults.
+
+    :return: A dictionary with the bulk ingestion settings.
+    """
+    return {**DEFAULT_BULK_SETTINGS, **getattr(settings, 'BULK_INGEST', {})}
+
+
+def read_bulk_body(request):
+    """
+    Read the body of a bulk request. The bulk endpoints accept larger bodies than
+    DATA_UPLOAD_MAX_MEMORY_SIZE, up to their own limit, so the body is read from the stream.
+
+    :param request: The HTTP request object.
+    :return: The body, as bytes.
+    :raises BodyTooLarge: If the body is larger than BULK_INGEST['MAX_BODY_SIZE'].
+    """
+    max_body_size = get_bulk_settings()['MAX_BODY_SIZE']
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+    if content_length > max_body_size:
+        raise BodyTooLarge(f"The body has {content_length} bytes, the maximum is {max_body_size}")
+    # Read one byte more than allowed to catch bodies sent without a Content-Length
+    body = request.read(max_body_size + 1)
+    if len(body) > max_body_size:
+        raise BodyTooLarge(f"The body is larger than the maximum of {max_body_size} bytes")
+    return body
+
+
+def parse_bulk_body(request):
+    """
+    Read the items of a bulk request.
+
+    :param request: The HTTP request object, with a JSON array body or, with an NDJSON content type, one object per line.
+    :return: A list of items. An NDJSON line that is not valid JSON is returned as a ValueError, to be reported as
+        the error of that item. Blank lines are skipped.
+    :raises BodyTooLarge: If the body is larger than BULK_INGEST['MAX_BODY_SIZE'].
+    :raises serializers.ValidationError: If the body is not a JSON array or has more items than allowed.
+    """
+    content_type = request.content_type.split(';')[0].strip()
+    try:
+        body = read_bulk_body(request).decode('utf-8')
+    except UnicodeDecodeError:
+        raise serializers.ValidationError("The body is not valid UTF-8")
+
+    if content_type in NDJSON_CONTENT_TYPES:
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                items.append(ValueError(f"Invalid JSON: {e}"))
+    else:
+        try:
+            items = json.loads(body)
+        except ValueError as e:
+            raise serializers.ValidationError(f"Invalid JSON: {e}")
+        if not isinstance(items, list):
+            raise serializers.ValidationError("The body must be a JSON array of objects, or NDJSON")
+
+    max_items = get_bulk_settings()['MAX_ITEMS']
+    if len(items) > max_items:
+        raise serializers.ValidationError(f"Too many items: {len(items)}, the maximum is {max_items}")
+    return items
+
+
+def validate_items(items, serializer_class, context=None):
+    """
+    Validate every item with a serializer.
+
+    :param items: The items of the request.
+    :param serializer_class: The serializer of a single item.
+    :param context: The context shared by the serializers of all the items.
+    :return: The validated data of the valid items, as (index, data) pairs, and the errors of the invalid ones.
+    """
+    valid, errors = [], []
+    for index, item in enumerate(items):
+        if isinstance(item, ValueError):
+            errors.append({'index': index, 'errors': {'non_field_errors': [str(item)]}})
+            continue
+        if not isinstance(item, dict):
+            errors.append({'index': index, 'errors': {'non_field_errors': ["The item must be a JSON object"]}})
+            continue
+        serializer = serializer_class(data=item, context=context or {})
+        if serializer.is_valid():
+            valid.append((index, serializer.validated_data))
+        else:
+            errors.append({'index': index, 'errors': serializer.errors})
+    return valid, errors
+
+
+def bulk_insert(model, validated, search_query_ids, batch_size=None):
+    """
+    Insert validated items with bulk_create, one transaction per batch.
+    bulk_create does not send the post_save signals, so the search vectors of the affected queries are
+    updated in the same transaction.
+
+    :param model: The model of the items.
+    :param validated: The (index, data) pairs of the valid items.
+    :param search_query_ids: A function that returns the ids of the queries whose search vector changes
+        with a list of created objects.
+    :param batch_size: The number of items per transaction, BULK_INGEST['BATCH_SIZE'] by default.
+    :return: The (index, id) pairs of the created items.
+    """
+    batch_size = batch_size or get_bulk_settings()['BATCH_SIZE']
+    created = []
+    for start in range(0, len(validated), batch_size):
+        batch = validated[start:start + batch_size]
+        with transaction.atomic():
+            objects = model.objects.bulk_create([model(**data) for _, data in batch])
+            update_search_vectors(search_query_ids(objects))
+        created += [(index, obj.id) for (index, _), obj in zip(batch, objects)]
+    return created
+
+
+def bulk_result(created, errors):
+    """
+    Build the body of the response of a bulk request.
+
+    :param created: The (index, id) pairs of the created items.
+    :param errors: The errors of the invalid items.
+    :return: A JSON-serializable dictionary.
+    """
+    return {
+        'created': len(created),
+        'failed': len(errors),
+        'ids': [{'index': index, 'id': id} for index, id in created],
+        'errors': errors,
+    }
@@ -0,0 +1,345 @@
+"""
+Warming of the BigQuery result cache after the Google Trends tables are refreshed.
+
+The cache keys of the results include the refresh watermark of their table, so
+every cached result goes cold when Google Trends publishes a new refresh_date.
+To spare the users the cold BigQuery latency, the requests of the single query
+endpoints are counted per URL (endpoint, country and dates). The counts are
+kept in memory and added to the count of the day of their URL (HotQueryDay)
+every FLUSH_INTERVAL seconds. The days older than WINDOW_DAYS are dropped.
+
+When the watermark of a table moves forward, the most requested URLs that read
+from it in the last WINDOW_DAYS are run again on a bounded thread pool, so that
+their results are cached under the new watermark before anyone asks for them.
+URLs that ended on the previous watermark, which follow the latest data, are
+also warmed for the new one (a range keeps its length).
+
+Warming runs in-process, checking the watermarks every CHECK_INTERVAL seconds
+(settings.BIGQUERY_CACHE_WARMING['SCHEDULER']), or with the warm_trends_cache
+management command, which only helps when the result cache is shared between
+processes.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F, Q, Sum
+from django.urls import NoReverseMatch, reverse
+from django.utils import timezone
+from .models import HotQuery, HotQueryDay
+from .queryExecution import resolve_saved_query
+from .queryMetrics import Counter, registry
+from . import bigQueryQueries
+
+# Default configuration of the cache warming, overridable with settings.BIGQUERY_CACHE_WARMING
+DEFAULT_WARMING_SETTINGS = {
+    'TRACK': True,
+    'SCHEDULER': False,
+    'ENDPOINTS': [
+        'bigquery-top-terms-dates-endpoint',
+        'bigquery-top-terms-day-endpoint',
+        'bigquery-top-rising-terms-day-endpoint',
+        'bigquery-top-rising-terms-date-endpoint',
+    ],
+    'TOP_N': 50,
+    'WINDOW_DAYS': 7,
+    'MAX_CONCURRENCY': 4,
+    'CHECK_INTERVAL': 5 * 60,
+    'FLUSH_INTERVAL': 60,
+}
+
+# Outcomes of the warmed queries
+WARMED = 'warmed'
+CACHED = 'cached'
+FAILED = 'failed'
+
+warmed_queries = registry.register(Counter(
+    'cache_warming_queries', 'Queries run by the cache warming, by result.', ['result'],
+))
+
+
+def get_warming_settings():
+    """
+    Get the cache warming settings merged over the defaults.
+
+    :return: A dictionary with the cache warming settings.
+    """
+    return {**DEFAULT_WARMING_SETTINGS, **getattr(settings, 'BIGQUERY_CACHE_WARMING', {})}
+
+
+class HitTracker:
+    """
+    Counts the requests of each URL in memory and adds the counts to HotQueryDay from time to time.
+    """
+
+    def __init__(self, flush_interval):
+        """
+        :param flush_interval: The minimum number of seconds between two writes to the database.
+        """
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def track(self, path, endpoint, params):
+        """
+        Count a request, and write the counts if the last write is older than the flush interval.
+
+        :param path: The path of the request.
+        :param endpoint: The name of its URL pattern.
+        :param params: The arguments of its URL pattern.
+        """
+        with self._lock:
+            _, _, hits, _ = self._pending.get(path, (endpoint, params, 0, None))
+            self._pending[path] = (endpoint, params, hits + 1, timezone.now())
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+            if due:
+                self._last_flush = time.monotonic()
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Add the pending counts to the count of the day of each URL, and forget the counts of the days
+        and the URLs older than the window.
+
+        :return: The number of URLs written.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        try:
+            for path, (endpoint, params, hits, last_requested) in pending.items():
+                hot_query, created = HotQuery.objects.get_or_create(
+                    path=path, defaults={'endpoint': endpoint, 'params': params, 'last_requested': last_requested},
+                )
+                if not created:
+                    HotQuery.objects.filter(pk=hot_query.pk).update(last_requested=last_requested)
+                add_hits(hot_query, timezone.localdate(last_requested), hits)
+            since = timezone.now() - timedelta(days=get_warming_settings()['WINDOW_DAYS'])
+            HotQueryDay.objects.filter(day__lt=timezone.localdate(since)).delete()
+            HotQuery.objects.filter(last_requested__lt=since).delete()
+        except DatabaseError:
+            # The counts only guide the warming, losing some of them is harmless
+            return 0
+        return len(pending)
+
+
+def add_hits(hot_query, day, hits):
+    """
+    Add requests to the count of a URL on a day.
+
+    :param hot_query: The HotQuery of the URL.
+    :param day: The day of the requests.
+    :param hits: The number of requests.
+    """
+    updated = HotQueryDay.objects.filter(hot_query=hot_query, day=day).update(hits=F('hits') + hits)
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            HotQueryDay.objects.create(hot_query=hot_query, day=day, hits=hits)
+    except IntegrityError:
+        # Another process created it in the meantime
+        HotQueryDay.objects.filter(hot_query=hot_query, day=day).update(hits=F('hits') + hits)
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_tracker():
+    """
+    Get the process-wide hit tracker, creating it on first use.
+
+    :return: The HitTracker.
+    """
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = HitTracker(get_warming_settings()['FLUSH_INTERVAL'])
+    return _tracker
+
+
+def track_request(request):
+    """
+    Count a request of one of the warmed endpoints.
+
+    :param request: The HTTP request object.
+    """
+    warming_settings = get_warming_settings()
+    match = getattr(request, 'resolver_match', None)
+    if not warming_settings['TRACK'] or match is None or match.url_name not in warming_settings['ENDPOINTS']:
+        return
+    get_tracker().track(request.path, match.url_name, dict(match.kwargs))
+
+
+def hot_queries(top_n=None):
+    """
+    :param top_n: The number of URLs, TOP_N by default.
+    :return: The most requested URLs of the last WINDOW_DAYS, as HotQuery objects with their hits in the window.
+    """
+    warming_settings = get_warming_settings()
+    since = timezone.now() - timedelta(days=warming_settings['WINDOW_DAYS'])
+    return list(
+        HotQuery.objects
+        .filter(last_requested__gte=since)
+        .annotate(hits=Sum('days__hits', filter=Q(days__day__gte=timezone.localdate(since))))
+        .filter(hits__gt=0)
+        .order_by('-hits', '-last_requested')
+        [:top_n or warming_settings['TOP_N']]
+    )
+
+
+def advance_params(params, previous_watermark, current_watermark):
+    """
+    Move the dates of a URL that ends on the previous watermark to the current one.
+
+    :param params: The arguments of the URL pattern, with a date or an init_date and a finish_date.
+    :param previous_watermark: The watermark the table had, or None.
+    :param current_watermark: The watermark the table has now.
+    :return: The arguments ending on the current watermark, or None if the URL does not end on the previous one.
+    """
+    if previous_watermark is None or current_watermark is None or current_watermark <= previous_watermark:
+        return None
+    last_key = 'finish_date' if 'finish_date' in params else 'date'
+    if params.get(last_key) != previous_watermark.isoformat():
+        return None
+    advanced = {**params, last_key: current_watermark.isoformat()}
+    if 'init_date' in params:
+        try:
+            init_date = date.fromisoformat(params['init_date'])
+        except ValueError:
+            return None
+        advanced['init_date'] = (init_date + (current_watermark - previous_watermark)).isoformat()
+    return advanced
+
+
+def warm_path(path):
+    """
+    Run the query of a URL through the result cache, unless its results are already cached.
+
+    :param path: The path of a BigQuery endpoint.
+    :return: WARMED, CACHED or FAILED.
+    """
+    try:
+        query, query_params, table = resolve_saved_query(path)
+        _, rows = bigQueryQueries.get_cached_rows(query, query_params, table)
+        if rows is not None:
+            result = CACHED
+        else:
+            bigQueryQueries.check_query_cost(query, query_params, table)
+            bigQueryQueries.run_query(query, query_params, table)
+            result = WARMED
+    except Exception:
+        result = FAILED
+    warmed_queries.inc(result=result)
+    return result
+
+
+def check_and_warm(watermarks, force=False, top_n=None):
+    """
+    Warm the hot URLs of the tables whose watermark moved since they were last warmed.
+
+    :param watermarks: The watermark each table was last warmed at, by table. Updated in place, except for
+        the tables none of whose URLs could be warmed, so that they are tried again on the next check.
+    :param force: Warm the hot URLs even if the watermark of their table did not move.
+    :param top_n: The number of most requested URLs to warm, TOP_N by default.
+    :return: The number of URLs with each outcome.
+    """
+    get_tracker().flush()
+
+    current_watermarks = {}
+    # Table of each URL to warm, in order of hits
+    paths = {}
+    for hot_query in hot_queries(top_n):
+        try:
+            _, _, table = resolve_saved_query(hot_query.path)
+            if table not in current_watermarks:
+                current_watermarks[table] = bigQueryQueries.fetch_watermark(table)
+        except Exception:
+            continue
+        previous, current = watermarks.get(table), current_watermarks[table]
+        if previous == current and not force:
+            continue
+        paths.setdefault(hot_query.path, table)
+        # Users following the latest data will ask for it at the new watermark
+        advanced = advance_params(hot_query.params, previous, current)
+        if advanced is not None:
+            try:
+                paths.setdefault(reverse(hot_query.endpoint, kwargs=advanced), table)
+            except NoReverseMatch:
+                pass
+
+    outcomes = {WARMED: 0, CACHED: 0, FAILED: 0}
+    warmed_tables = set()
+    if paths:
+        # Run the queries with bounded concurrency
+        with ThreadPoolExecutor(
+            max_workers=get_warming_settings()['MAX_CONCURRENCY'], thread_name_prefix='cache-warming',
+        ) as executor:
+            for table, result in zip(paths.values(), executor.map(warm_path, paths)):
+                outcomes[result] += 1
+                if result != FAILED:
+                    warmed_tables.add(table)
+    # Keep the old watermark of the tables whose URLs all failed, so that they are warmed again
+    failed_tables = set(paths.values()) - warmed_tables
+    watermarks.update(
+        (table, watermark) for table, watermark in current_watermarks.items() if table not in failed_tables
+    )
+    return outcomes
+
+
+class WarmingScheduler:
+    """
+    Checks the watermarks in a background thread and warms the cache when they move.
+    """
+
+    def __init__(self, interval):
+        """
+        :param interval: The number of seconds between two checks.
+        """
+        self.interval = interval
+        self.watermarks = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start the background thread. The first check runs at once, since the cache of a new process is cold.
+        """
+        self._thread = threading.Thread(target=self._run, name='cache-warming-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            try:
+                check_and_warm(self.watermarks)
+            except Exception:
+                # Try again on the next check
+                pass
+            if self._stop.wait(self.interval):
+                return
+
+
+_scheduler = None
+
+
+def start_scheduler():
+    """
+    Start the in-process warming scheduler if BIGQUERY_CACHE_WARMING['SCHEDULER'] is set.
+    Called by the WSGI and ASGI entry points so that only serving processes warm their cache.
+
+    :return: The WarmingScheduler, or None if it is disabled.
+    """
+    global _scheduler
+    warming_settings = get_warming_settings()
+    if warming_settings['SCHEDULER'] and _scheduler is None:
+        _scheduler = WarmingScheduler(warming_settings['CHECK_INTERVAL'])
+        _scheduler.start()
+    return _scheduler
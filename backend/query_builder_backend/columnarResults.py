@@ -0,0 +1,134 @@
+"""
+Columnar result formats for the BigQuery endpoints.
+
+Instead of one JSON object per row, results can be returned as an Apache Arrow
+IPC stream, as columnar JSON ({column: [values]}) or as compact rows
+({"columns": [names], "rows": [[values]]}), which keep the order of the rows
+without repeating the column names in each one. They are built from the Arrow
+table of the query results, which skips the per-row dictionaries, and can
+optionally be downloaded with the BigQuery Storage Read API.
+
+pyarrow is only needed for these formats and is imported on first use.
+"""
+from django.conf import settings
+from django.http import HttpResponse
+from .fastJson import JsonResponse
+
+# Media type of the Arrow IPC stream format
+ARROW_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+
+# Columnar formats that can be requested
+RESULT_FORMATS = ('arrow', 'columnar', 'compact')
+
+
+def get_result_format(request):
+    """
+    Get the columnar format requested, from the format query parameter or the Accept header.
+
+    :param request: The HTTP request object.
+    :return: 'arrow', 'columnar', 'compact', None if no columnar format was requested, or the unknown requested value.
+    """
+    if request is None:
+        return None
+    result_format = request.GET.get('format')
+    if result_format is None and ARROW_MEDIA_TYPE in request.headers.get('Accept', ''):
+        result_format = 'arrow'
+    # json is the default format of the endpoints
+    return None if result_format == 'json' else result_format
+
+
+def use_storage_api():
+    """
+    Check whether large results should be downloaded with the BigQuery Storage Read API.
+
+    :return: settings.BIGQUERY_STORAGE_API, False by default.
+    """
+    return getattr(settings, 'BIGQUERY_STORAGE_API', False)
+
+
+def import_pyarrow():
+    """
+    Import pyarrow, which is only needed by the columnar formats.
+
+    :return: The pyarrow module, or None if it is not installed.
+    """
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def rows_to_arrow(rows):
+    """
+    Build an Arrow table from rows already loaded as dictionaries, such as cached ones.
+
+    :param rows: A list of dictionaries.
+    :return: A pyarrow Table.
+    """
+    return import_pyarrow().Table.from_pylist(rows)
+
+
+def results_to_arrow(results):
+    """
+    Download the results of a query job as an Arrow table.
+
+    :param results: The RowIterator of the query job.
+    :return: A pyarrow Table.
+    """
+    return results.to_arrow(create_bqstorage_client=use_storage_api())
+
+
+def columnar_response(arrow_table, result_format):
+    """
+    Build the response for an Arrow table in the requested format.
+
+    :param arrow_table: A pyarrow Table.
+    :param result_format: 'arrow', 'columnar' or 'compact'.
+    :return: An HTTP response, or a 404 response if the table has no rows.
+    """
+    if arrow_table.num_rows == 0:
+        return JsonResponse({"error": "No data found"}, status=404)
+
+    if result_format == 'columnar':
+        return JsonResponse(arrow_table.to_pydict())
+    if result_format == 'compact':
+        columns = arrow_table.to_pydict()
+        return JsonResponse({"columns": list(columns), "rows": [list(row) for row in zip(*columns.values())]})
+
+    # Write the table as an Arrow IPC stream
+    pyarrow = import_pyarrow()
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, arrow_table.schema) as writer:
+        writer.write_table(arrow_table)
+    return HttpResponse(sink.getvalue().to_pybytes(), content_type=ARROW_MEDIA_TYPE)
+
+
+def columnar_rows_response(rows, result_format):
+    """
+    Build the response for rows loaded as dictionaries in the requested columnar format.
+
+    :param rows: A list of dictionaries.
+    :param result_format: 'arrow', 'columnar' or 'compact'.
+    :return: An HTTP response.
+    """
+    if not rows:
+        return JsonResponse({"error": "No data found"}, status=404)
+    if import_pyarrow() is None:
+        if result_format == 'arrow':
+            return pyarrow_missing_response()
+        # Columnar JSON and compact rows do not need pyarrow for rows that are already loaded
+        if result_format == 'compact':
+            return JsonResponse({"columns": list(rows[0]), "rows": [list(row.values()) for row in rows]})
+        return JsonResponse({column: [row[column] for row in rows] for column in rows[0]})
+    return columnar_response(rows_to_arrow(rows), result_format)
+
+
+def pyarrow_missing_response():
+    """
+    Build the response for a columnar format requested while pyarrow is not installed.
+
+    :return: A JSON response with HTTP status 406 (Not Acceptable).
+    """
+    return JsonResponse({"error": "The arrow format requires pyarrow to be installed"}, status=406)
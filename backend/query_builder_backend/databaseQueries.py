@@ -2,6 +2,35 @@ from rest_framework.response import Response
 from rest_framework import status
 from .serializers import *
 from rest_framework.views import APIView
+from datetime import date
+from django.db.models import Q
+from .keysetPagination import decode_cursor, get_page_size, paginate, paginated_response
+from .querySearch import search_queries
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from .fastJson import JsonResponse
+from .bigQueryQueries import BigQueryView, rows_response
+from .columnarResults import get_result_format
+from .queryCost import QueryOverBudget
+from .queryExecution import SNAPSHOT_STATUS_HEADER, SavedQueryError, decompress_rows, get_snapshot, invalidate_snapshot
+from .queryStreaming import get_stream_format
+from .responseCompression import choose_encoding
+from .bulkIngest import BodyTooLarge, bulk_insert, bulk_result, parse_bulk_body, validate_items
+
+
+def bulk_status(created, errors):
+    """
+    Get the HTTP status of a bulk request.
+
+    :param created: The created items.
+    :param errors: The errors of the invalid items.
+    :return: 201 if every item was created, 207 if only some were, 400 if none were.
+    """
+    if not errors:
+        return status.HTTP_201_CREATED
+    if created:
+        return status.HTTP_207_MULTI_STATUS
+    return status.HTTP_400_BAD_REQUEST
 
 
 class QueryAdderEndpoint(APIView):
@@ -50,31 +79,160 @@ class CommentAdderEndpoint(APIView):
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class QueryBulkAdderEndpoint(APIView):
+    def post(self, request):
+        """
+        Handle POST requests to add many queries to the PostgreSQL database at once.
+
+        :param request: The HTTP request object, with a JSON array of queries as body, or one query per line
+            with the application/x-ndjson content type. Each query has the fields of QueryAdderEndpoint.
+
+        :return: A JSON response.
+            - If the request is processed, returns:
+                {"created": <count>, "failed": <count>, "ids": [{"index": <index>, "id": <id>}, ...],
+                 "errors": [{"index": <index>, "errors": <serializer errors>}, ...]}
+                with HTTP status 201 (Created) if every query was saved, 207 (Multi-Status) if only some were,
+                or 400 (Bad Request) if none were.
+            - If the body cannot be read, returns:
+                {"error": "<error message>"}
+                with HTTP status 400 (Bad Request).
+            - If the body is larger than BULK_INGEST['MAX_BODY_SIZE'], returns:
+                {"error": "<error message>"}
+                with HTTP status 413 (Request Entity Too Large).
+        """
+        try:
+            items = parse_bulk_body(request)
+        except BodyTooLarge as e:
+            return Response({"error": str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        except serializers.ValidationError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        # Validate every query with the serializer of the single query endpoint
+        validated, errors = validate_items(items, QueryPostSerializer)
+        # Save the valid queries in batches
+        created = bulk_insert(Query, validated, lambda queries: [query.id for query in queries])
+        return Response(bulk_result(created, errors), status=bulk_status(created, errors))
+
+class CommentBulkAdderEndpoint(APIView):
+    def post(self, request):
+        """
+        Handle POST requests to add many comments to the PostgreSQL database at once.
+
+        :param request: The HTTP request object, with a JSON array of comments as body, or one comment per line
+            with the application/x-ndjson content type. Each comment has the fields query (the id of the query),
+            username and comment_text.
+
+        :return: A JSON response.
+            - If the request is processed, returns:
+                {"created": <count>, "failed": <count>, "ids": [{"index": <index>, "id": <id>}, ...],
+                 "errors": [{"index": <index>, "errors": <serializer errors>}, ...]}
+                with HTTP status 201 (Created) if every comment was saved, 207 (Multi-Status) if only some were,
+                or 400 (Bad Request) if none were.
+            - If the body cannot be read, returns:
+                {"error": "<error message>"}
+                with HTTP status 400 (Bad Request).
+            - If the body is larger than BULK_INGEST['MAX_BODY_SIZE'], returns:
+                {"error": "<error message>"}
+                with HTTP status 413 (Request Entity Too Large).
+        """
+        try:
+            items = parse_bulk_body(request)
+        except BodyTooLarge as e:
+            return Response({"error": str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        except serializers.ValidationError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        # Get every query the comments refer to with a single query
+        query_ids = set()
+        for item in items:
+            if isinstance(item, dict):
+                try:
+                    query_ids.add(int(item.get('query')))
+                except (TypeError, ValueError):
+                    pass
+        prefetched = Query.objects.in_bulk(query_ids)
+        # Validate every comment with the serializer of the single comment endpoint
+        validated, errors = validate_items(items, CommentBulkSerializer, context={'prefetched': prefetched})
+        # Save the valid comments in batches
+        created = bulk_insert(Comment, validated, lambda comments: {comment.query_id for comment in comments})
+        return Response(bulk_result(created, errors), status=bulk_status(created, errors))
+
 class QueriesGetterEndpoint(APIView):
     def get(self, request):
         """
-        Handle GET requests to get all the queries from the PostgreSQL database.
+        Handle GET requests to get the queries from the PostgreSQL database, newest first, one page at a time.
 
-        :param request: The HTTP request object.
+        :param request: The HTTP request object, with the optional query parameters:
+            - limit: the number of queries per page.
+            - cursor: the cursor of the page, from the X-Next-Cursor header of the previous page.
+            - username: only get the queries of this user.
 
         :return: A JSON response.
             - If the request is processed correctly, returns: 
-                a list of all the queries
+                a list of the queries of the page, with the cursor of the next page
+                in the X-Next-Cursor and Link headers
                 with HTTP status 200 (OK).
             - If the request data is invalid, returns:
                 the serializer errors
                 with HTTP status 400 (Bad Request).
         """
         try:
-            # Get all the queries
-            queryset = Query.objects.all()
-            # Serialize the data from the queryset
-            serializer = QueriesGetterSerializer(queryset, many=True)
+            page_size = get_page_size(request)
+            cursor = decode_cursor(request, [date.fromisoformat, int])
+            # Get the queries, newest first
+            queryset = Query.objects.order_by('-date', '-id')
+            if request.query_params.get('username'):
+                queryset = queryset.filter(username=request.query_params['username'])
+            # Continue after the last query of the previous page
+            if cursor is not None:
+                last_date, last_id = cursor
+                queryset = queryset.filter(Q(date__lt=last_date) | Q(date=last_date, id__lt=last_id))
+            queries, next_cursor = paginate(queryset, page_size, lambda query: [query.date.isoformat(), query.id])
+            # Serialize the data from the page
+            serializer = QueriesGetterSerializer(queries, many=True)
             serialized_data = serializer.data
-            return Response(serialized_data, status=status.HTTP_200_OK)
+            return paginated_response(request, serialized_data, next_cursor)
         except serializers.ValidationError as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
+class QuerySearchEndpoint(APIView):
+    def get(self, request):
+        """
+        Handle GET requests to search the queries of the PostgreSQL database by their name, description,
+        query and comments, best matches first, one page at a time.
+
+        :param request: The HTTP request object, with the query parameters:
+            - q: the search, in web search syntax ("quoted phrases", or, -excluded words).
+            - limit: the number of queries per page (optional).
+            - cursor: the cursor of the page, from the X-Next-Cursor header of the previous page (optional).
+
+        :return: A JSON response.
+            - If the request is processed correctly, returns:
+                a list of the matching queries of the page with their rank, with the cursor of the next page
+                in the X-Next-Cursor and Link headers
+                with HTTP status 200 (OK).
+            - If the search is missing or the request data is invalid, returns:
+                {"error": "<error message>"}
+                with HTTP status 400 (Bad Request).
+        """
+        try:
+            text = request.query_params.get('q', '').strip()
+            if not text:
+                raise serializers.ValidationError("The q query parameter is required")
+            page_size = get_page_size(request)
+            cursor = decode_cursor(request, [float, int])
+            # Get the matching queries, best matches first
+            queryset = search_queries(text)
+            # Continue after the last query of the previous page
+            if cursor is not None:
+                last_rank, last_id = cursor
+                queryset = queryset.filter(Q(rank__lt=last_rank) | Q(rank=last_rank, id__lt=last_id))
+            queries, next_cursor = paginate(queryset, page_size, lambda query: [query.rank, query.id])
+            # Serialize the data from the page
+            serializer = QuerySearchSerializer(queries, many=True)
+            serialized_data = serializer.data
+            return paginated_response(request, serialized_data, next_cursor)
+        except serializers.ValidationError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
 class QueryGetterEndpoint(APIView):
     def get(self, request, query_id):
         """
@@ -105,25 +263,104 @@ class QueryGetterEndpoint(APIView):
 class CommentGetterEndpoint(APIView):
     def get(self, request, query_id):
         """
-        Handle GET requests to get all the comments for a given query from the PostgreSQL database.
+        Handle GET requests to get the comments for a given query from the PostgreSQL database, newest first, one page at a time.
 
-        :param request: The HTTP request object.
+        :param request: The HTTP request object, with the optional query parameters:
+            - limit: the number of comments per page.
+            - cursor: the cursor of the page, from the X-Next-Cursor header of the previous page.
         :param query_id: The id of the query to get the comments from.
 
         :return: A JSON response.
             - If the request is processed correctly, returns: 
-                a list of all the comments for the given query
+                a list of the comments of the page, with the cursor of the next page
+                in the X-Next-Cursor and Link headers
                 with HTTP status 200 (OK).
             - If the request data is invalid, returns:
                 the serializer errors
                 with HTTP status 400 (Bad Request).
         """
         try:
-            # Get all the comments for the given query ordered by id
+            page_size = get_page_size(request)
+            cursor = decode_cursor(request, [int])
+            # Get the comments for the given query ordered by id
             queryset = Comment.objects.filter(query=query_id).order_by('-id')
-            # Serialize the data from the queryset
-            serializer = CommentGetterSerializer(queryset, many=True)
+            # Continue after the last comment of the previous page
+            if cursor is not None:
+                queryset = queryset.filter(id__lt=cursor[0])
+            comments, next_cursor = paginate(queryset, page_size, lambda comment: [comment.id])
+            # Serialize the data from the page
+            serializer = CommentGetterSerializer(comments, many=True)
             serialized_data = serializer.data
-            return Response(serialized_data, status=status.HTTP_200_OK)
+            return paginated_response(request, serialized_data, next_cursor)
         except serializers.ValidationError as e:
-            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class SavedQueryResultsEndpoint(BigQueryView):
+    def get(self, request, query_id):
+        """
+        Handle GET requests to get the results of a saved query, from its snapshot if it is still fresh,
+        running it on BigQuery otherwise.
+
+        :param request: The HTTP request object. The stream and format query parameters of the BigQuery
+            endpoints are supported, and ?refresh=true runs the query even if the snapshot is fresh.
+        :param query_id: The id of the saved query.
+
+        :return: A JSON response.
+            - If the request is processed correctly, returns:
+                the rows of the results, with the X-Snapshot-Status (hit or miss), X-Snapshot-Executed-At,
+                X-Snapshot-Row-Count, X-Snapshot-Execution-Seconds and X-BigQuery-Bytes-Processed headers
+                with HTTP status 200 (OK).
+            - If the saved query does not exist or has no results, returns:
+                {"error": "<error message>"}
+                with HTTP status 404 (Not Found).
+            - If the saved query cannot be run on the server or is over budget, returns:
+                {"error": "<error message>"}
+                with HTTP status 400 (Bad Request).
+            - If there is an error running the query, returns:
+                {"error": "<error message>"}
+                with HTTP status 500 (Internal Server Error).
+        """
+        try:
+            saved_query = Query.objects.get(id=query_id)
+        except Query.DoesNotExist:
+            return JsonResponse({"error": f"Query {query_id} not found"}, status=404)
+        try:
+            refresh = request.GET.get('refresh', '').lower() in ('1', 'true', 'yes')
+            snapshot, hit = get_snapshot(saved_query, refresh=refresh)
+        except SavedQueryError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        except QueryOverBudget as e:
+            return JsonResponse(e.to_dict(), status=400)
+        # If there is an error, return a JSON response with the error
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=500)
+
+        if snapshot.row_count and get_stream_format(request) is None and get_result_format(request) is None \
+                and choose_encoding(request.headers.get('Accept-Encoding', ''), ['gzip']) == 'gzip':
+            # Send the snapshot as it is stored, without decompressing it
+            response = HttpResponse(bytes(snapshot.data), content_type='application/json')
+            response['Content-Encoding'] = 'gzip'
+            patch_vary_headers(response, ['Accept-Encoding'])
+        else:
+            response = rows_response(decompress_rows(snapshot.data), request)
+        response[SNAPSHOT_STATUS_HEADER] = 'hit' if hit else 'miss'
+        response['X-Snapshot-Executed-At'] = snapshot.executed_at.isoformat()
+        response['X-Snapshot-Row-Count'] = str(snapshot.row_count)
+        response['X-Snapshot-Execution-Seconds'] = f"{snapshot.execution_seconds:.3f}"
+        if snapshot.bytes_processed is not None:
+            response['X-BigQuery-Bytes-Processed'] = str(snapshot.bytes_processed)
+        return response
+
+    def delete(self, request, query_id):
+        """
+        Handle DELETE requests to invalidate the snapshot of a saved query, so that the next view runs it again.
+
+        :param request: The HTTP request object.
+        :param query_id: The id of the saved query.
+
+        :return: A JSON response.
+            - Returns {"invalidated": <true if there was a snapshot>}
+                with HTTP status 200 (OK).
+        """
+        return JsonResponse({"invalidated": invalidate_snapshot(query_id)})
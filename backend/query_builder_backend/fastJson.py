@@ -0,0 +1,88 @@
+"""
+Fast JSON encoding of the API responses.
+
+The responses are encoded with orjson when it is installed, which is several
+times faster than the json module and writes compact JSON without spaces after
+the separators. Values orjson does not know natively (such as Decimal) are
+encoded the way DjangoJSONEncoder encodes them. Without orjson, the json module
+is used with compact separators.
+
+JsonResponse is a drop-in replacement of django.http.JsonResponse for the
+BigQuery views, and FastJSONRenderer replaces the JSON renderer of the DRF
+views (see REST_FRAMEWORK in settings.py).
+"""
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse as DjangoJsonResponse
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder as DRFJSONEncoder
+from .queryMetrics import serialization_duration, timed
+
+
+def import_orjson():
+    """
+    Import orjson, which is optional.
+
+    :return: The orjson module, or None if it is not installed.
+    """
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
+
+
+def dumps(data, encoder=DjangoJSONEncoder):
+    """
+    Encode data as compact JSON.
+
+    :param data: The data to encode.
+    :param encoder: The json.JSONEncoder class whose default method encodes the values orjson does not know.
+    :return: The UTF-8 encoded JSON, as bytes.
+    """
+    orjson = import_orjson()
+    if orjson is None:
+        return json.dumps(data, cls=encoder, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return orjson.dumps(
+        data,
+        default=encoder().default,
+        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z,
+    )
+
+
+class JsonResponse(DjangoJsonResponse):
+    """
+    A django.http.JsonResponse whose body is encoded with dumps.
+    """
+
+    def __init__(self, data, encoder=DjangoJSONEncoder, safe=True, json_dumps_params=None, **kwargs):
+        """
+        :param data: The data of the response.
+        :param encoder: The encoder of the values orjson does not know.
+        :param safe: Only accept dictionaries, as django.http.JsonResponse does.
+        :param json_dumps_params: Ignored, kept for compatibility with django.http.JsonResponse.
+        """
+        if safe and not isinstance(data, dict):
+            raise TypeError(
+                "In order to allow non-dict objects to be serialized set the safe parameter to False."
+            )
+        kwargs.setdefault('content_type', 'application/json')
+        with timed(serialization_duration, 'serialize'):
+            content = dumps(data, encoder)
+        # Skip the encoding of django.http.JsonResponse
+        super(DjangoJsonResponse, self).__init__(content=content, **kwargs)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    The JSON renderer of DRF, encoding with dumps unless an indented response is requested.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        # The browsable API and ?indent requests keep the indented output of DRF
+        if self.get_indent(accepted_media_type or '', renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        with timed(serialization_duration, 'serialize'):
+            return dumps(data, DRFJSONEncoder)
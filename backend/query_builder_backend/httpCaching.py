@@ -0,0 +1,192 @@
+"""
+HTTP caching of the BigQuery endpoints.
+
+Responses carry an ETag (a hash of their content, made weak when the response
+is compressed), a Last-Modified date (the refresh_date watermark of the table
+they read from) and a Cache-Control header with a max-age and a
+stale-while-revalidate window, so browsers and CDNs can reuse them and
+revalidate them cheaply.
+
+The ETag of each representation is remembered in the query cache under the
+cache key of its query, which already changes with the watermark. A request
+whose If-None-Match has that ETag, or whose If-Modified-Since is not older
+than the watermark, gets a 304 Not Modified without running the query.
+"""
+import hashlib
+from datetime import datetime, time, timezone
+from django.conf import settings
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from .queryResilience import STALE_HEADER
+
+# Default configuration of the HTTP caching, overridable with settings.BIGQUERY_HTTP_CACHE
+DEFAULT_HTTP_CACHE_SETTINGS = {
+    'MAX_AGE': 60 * 5,
+    'STALE_WHILE_REVALIDATE': 60 * 60 * 24,
+}
+
+
+def get_http_cache_settings():
+    """
+    Get the HTTP caching settings merged over the defaults.
+
+    :return: A dictionary with the HTTP caching settings.
+    """
+    return {**DEFAULT_HTTP_CACHE_SETTINGS, **getattr(settings, 'BIGQUERY_HTTP_CACHE', {})}
+
+
+def watermark_timestamp(watermark):
+    """
+    :param watermark: The refresh watermark of a table, a date.
+    :return: The start of the watermark day in UTC as a timestamp, or None.
+    """
+    if watermark is None:
+        return None
+    return int(datetime.combine(watermark, time.min, tzinfo=timezone.utc).timestamp())
+
+
+def etag_key(cache_key, request):
+    """
+    Get the key the ETag of a representation of a query is stored under.
+    The representation depends on the URL (path and format parameters) and the Accept header.
+
+    :param cache_key: The cache key of the query.
+    :param request: The HTTP request object.
+    :return: The key.
+    """
+    representation = f"{request.get_full_path()}|{request.headers.get('Accept', '')}"
+    return f"{cache_key}:etag:{hashlib.sha256(representation.encode('utf-8')).hexdigest()}"
+
+
+def content_etag(content):
+    """
+    :param content: The body of a response.
+    :return: A strong ETag, quoted, with the hash of the body.
+    """
+    return quote_etag(hashlib.sha256(content).hexdigest()[:32])
+
+
+def strip_weakness(etag):
+    """
+    :param etag: A quoted ETag, weak or strong.
+    :return: The ETag without the weakness indicator.
+    """
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def is_not_modified(request, etag, last_modified):
+    """
+    Check whether the client already has the current representation.
+
+    :param request: The HTTP request object.
+    :param etag: The current ETag, or None if it is not known.
+    :param last_modified: The current Last-Modified timestamp, or None.
+    :return: True if the client can reuse its copy.
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # If-Modified-Since is ignored when If-None-Match is sent
+        etags = parse_etags(if_none_match)
+        if etag is None:
+            return False
+        # The weak comparison: a compressed response has the weak form of the ETag of its body
+        return '*' in etags or strip_weakness(etag) in {strip_weakness(other) for other in etags}
+    if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    return last_modified is not None and if_modified_since is not None and last_modified <= if_modified_since
+
+
+def add_cache_headers(response, etag, last_modified):
+    """
+    Add the validators and the caching policy to a response.
+
+    :param response: The HTTP response.
+    :param etag: The ETag of the response, or None.
+    :param last_modified: The Last-Modified timestamp of the response, or None.
+    """
+    http_cache_settings = get_http_cache_settings()
+    if etag is not None:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(
+        response,
+        public=True,
+        max_age=http_cache_settings['MAX_AGE'],
+        stale_while_revalidate=http_cache_settings['STALE_WHILE_REVALIDATE'],
+    )
+    # The format of the response can be picked with the Accept header
+    patch_vary_headers(response, ['Accept'])
+
+
+def not_modified_response(etag, last_modified):
+    """
+    :return: A 304 Not Modified response with the validators and the caching policy.
+    """
+    response = HttpResponseNotModified()
+    add_cache_headers(response, etag, last_modified)
+    return response
+
+
+def check_not_modified(request, cache, cache_key, watermark):
+    """
+    Answer with 304 Not Modified when the client already has the current data.
+
+    :param request: The HTTP request object.
+    :param cache: The query cache, where the ETags are stored.
+    :param cache_key: The cache key of the query, which changes with the watermark.
+    :param watermark: The refresh watermark of the table the query reads from.
+    :return: The 304 response, or None to build the response.
+    """
+    last_modified = watermark_timestamp(watermark)
+    etag = cache.get(etag_key(cache_key, request))
+    if is_not_modified(request, etag, last_modified):
+        return not_modified_response(etag, last_modified)
+    return None
+
+
+def validate_response(request, cache, cache_key, watermark, response):
+    """
+    Add the validators to a response built for a request, and remember its ETag.
+
+    :param request: The HTTP request object.
+    :param cache: The query cache, where the ETags are stored.
+    :param cache_key: The cache key of the query, which changes with the watermark.
+    :param watermark: The refresh watermark of the table the query reads from.
+    :param response: The HTTP response.
+    :return: The response, or a 304 Not Modified response if the client has the same one.
+    """
+    last_modified = watermark_timestamp(watermark)
+    # Errors and stale results get no validators
+    if response.status_code != 200 or response.has_header(STALE_HEADER):
+        return response
+    if response.streaming:
+        # The body of a streaming response is not known in advance
+        add_cache_headers(response, None, last_modified)
+        return response
+
+    etag = content_etag(response.content)
+    cache.set(etag_key(cache_key, request), etag)
+    add_cache_headers(response, etag, last_modified)
+    if request.headers.get('If-None-Match') is not None and is_not_modified(request, etag, last_modified):
+        # The data did not change although the ETag had been forgotten
+        return not_modified_response(etag, last_modified)
+    return response
+
+
+def conditional_response(request, cache, cache_key, watermark, build_response):
+    """
+    Answer a request with 304 Not Modified when the client has the current data, and build the
+    response with its validators otherwise.
+
+    :param request: The HTTP request object.
+    :param cache: The query cache, where the ETags are stored.
+    :param cache_key: The cache key of the query, which changes with the watermark.
+    :param watermark: The refresh watermark of the table the query reads from.
+    :param build_response: A function that runs the query and returns its response.
+    :return: The HTTP response.
+    """
+    response = check_not_modified(request, cache, cache_key, watermark)
+    if response is not None:
+        return response
+    return validate_response(request, cache, cache_key, watermark, build_response())
@@ -0,0 +1,105 @@
+"""
+Keyset (cursor) pagination for the database endpoints.
+
+A page is read with a WHERE on the ordering columns of the last row of the
+previous page instead of an OFFSET, so every page costs the same index range
+scan however deep it is. The body of a page is still a plain list. The cursor of
+the next page is sent in the X-Next-Cursor header and in a Link header.
+"""
+import base64
+import json
+from django.conf import settings
+from rest_framework import serializers
+from rest_framework.response import Response
+
+# Header with the cursor of the next page
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+
+def get_page_size(request):
+    """
+    Get the number of rows per page requested with the limit query parameter.
+
+    :param request: The HTTP request object.
+    :return: The page size, between 1 and settings.DB_MAX_PAGE_SIZE.
+    :raises serializers.ValidationError: If the limit is not a positive number.
+    """
+    default_size = getattr(settings, 'DB_PAGE_SIZE', 100)
+    max_size = getattr(settings, 'DB_MAX_PAGE_SIZE', 500)
+    limit = request.query_params.get('limit')
+    if limit is None:
+        return default_size
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise serializers.ValidationError(f"Invalid limit: {limit}")
+    if limit < 1:
+        raise serializers.ValidationError(f"Invalid limit: {limit}")
+    return min(limit, max_size)
+
+
+def encode_cursor(values):
+    """
+    Encode the ordering values of the last row of a page into an opaque cursor.
+
+    :param values: A list of JSON-serializable values.
+    :return: The cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(request, converters):
+    """
+    Decode the cursor query parameter of a request.
+
+    :param request: The HTTP request object.
+    :param converters: One function per value of the cursor, turning it back into its type.
+    :return: The list of converted values, or None if no cursor was given.
+    :raises serializers.ValidationError: If the cursor is not valid.
+    """
+    cursor = request.query_params.get('cursor')
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if not isinstance(values, list) or len(values) != len(converters):
+            raise ValueError
+        return [convert(value) for convert, value in zip(converters, values)]
+    except (TypeError, ValueError, UnicodeError):
+        raise serializers.ValidationError("Invalid cursor")
+
+
+def paginate(queryset, page_size, cursor_values):
+    """
+    Read one page of an ordered queryset.
+
+    :param queryset: The queryset, already filtered after the cursor and ordered.
+    :param page_size: The number of rows per page.
+    :param cursor_values: A function that returns the cursor values of a row.
+    :return: The rows of the page and the cursor of the next page, or None if it is the last page.
+    """
+    # Read one extra row to know if there is a next page
+    rows = list(queryset[:page_size + 1])
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    return rows, encode_cursor(cursor_values(rows[-1]))
+
+
+def paginated_response(request, data, next_cursor):
+    """
+    Build the response of a page.
+
+    :param request: The HTTP request object.
+    :param data: The serialized rows of the page.
+    :param next_cursor: The cursor of the next page, or None if it is the last page.
+    :return: A Response with the rows and the headers pointing to the next page.
+    """
+    response = Response(data)
+    if next_cursor is not None:
+        query_params = request.query_params.copy()
+        query_params['cursor'] = next_cursor
+        next_url = request.build_absolute_uri(f"{request.path}?{query_params.urlencode()}")
+        response[NEXT_CURSOR_HEADER] = next_cursor
+        response['Link'] = f'<{next_url}>; rel="next"'
+    return response
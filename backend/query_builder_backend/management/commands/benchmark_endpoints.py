@@ -0,0 +1,131 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from query_builder_backend import bigQueryQueries
+from query_builder_backend.benchmarks import SCENARIOS, compare_reports, missing_scenarios, run_benchmark, url_routes
+from query_builder_backend.bigQueryClient import BigQueryClientManager, get_client_manager, get_client_settings
+from query_builder_backend.queryCache import get_cache_settings, reset_query_cache
+from query_builder_backend.replayClient import RecordingClient, ReplayClient, load_recordings, save_recordings
+
+
+class Command(BaseCommand):
+    help = ("Benchmark every endpoint of urls.py on a test database, with BigQuery replaced by a client that "
+            "replays recorded or synthetic rows after a configurable latency, and write the latency "
+            "percentiles, throughput and memory per request of each endpoint as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help="Number of requests of each endpoint.")
+        parser.add_argument('--concurrency', type=int, default=8, help="Number of threads sending them.")
+        parser.add_argument(
+            '--latency', type=float, default=50, help="Milliseconds every replayed BigQuery job takes.",
+        )
+        parser.add_argument(
+            '--jitter', type=float, default=0, help="Random milliseconds, up to this many, added to each job.",
+        )
+        parser.add_argument('--seed', type=int, help="Seed of the jitter, for repeatable runs.")
+        parser.add_argument(
+            '--memory-requests', type=int, default=10,
+            help="Number of requests of each endpoint measured with tracemalloc, 0 to skip the memory pass.",
+        )
+        parser.add_argument(
+            '--endpoint', action='append', default=[],
+            help="Only benchmark the routes containing this text. Can be repeated.",
+        )
+        parser.add_argument(
+            '--cold', action='store_true',
+            help="Disable the result cache, so that every request runs its BigQuery job.",
+        )
+        parser.add_argument('--recordings', help="JSON file of recorded rows to replay, written by --record.")
+        parser.add_argument(
+            '--record',
+            help="Run every endpoint once against the real BigQuery and write the rows of its queries to this file.",
+        )
+        parser.add_argument('--output', help="File to write the report to, instead of the standard output.")
+        parser.add_argument('--baseline', help="Report of another run to compare this one with.")
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError("--requests and --concurrency must be at least 1")
+        missing = missing_scenarios()
+        if missing:
+            raise CommandError(f"Routes without a benchmark scenario: {', '.join(missing)}")
+        routes = [
+            route for route in url_routes()
+            if not options['endpoint'] or any(text in route for text in options['endpoint'])
+        ]
+        if not routes:
+            raise CommandError("No route matches --endpoint")
+
+        if options['record']:
+            # A client of its own, since the shared one is reset during the run
+            recorder = RecordingClient(BigQueryClientManager(get_client_manager().credentials_path).get_client())
+            factory = lambda: recorder
+            requests, concurrency, memory_requests = 1, 1, 0
+        else:
+            recordings = load_recordings(options['recordings']) if options['recordings'] else None
+            replay_client = ReplayClient(
+                latency=options['latency'] / 1000,
+                jitter=options['jitter'] / 1000,
+                recordings=recordings,
+                seed=options['seed'],
+            )
+            factory = lambda: replay_client
+            requests, concurrency, memory_requests = (
+                options['requests'], options['concurrency'], options['memory_requests'],
+            )
+
+        cache_settings = get_cache_settings()
+        if options['cold']:
+            cache_settings['TIMEOUT'] = 0
+        overrides = override_settings(
+            BIGQUERY_CLIENT={**get_client_settings(), 'FACTORY': factory},
+            BIGQUERY_CACHE=cache_settings,
+            BIGQUERY_CACHE_WARMING={'SCHEDULER': False, 'TRACK': False},
+        )
+
+        # The scenarios write to the database, so they run on a test database
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with overrides:
+                self.reset_state()
+                try:
+                    report = run_benchmark(routes, requests, concurrency, memory_requests, options={
+                        'latency_ms': options['latency'],
+                        'jitter_ms': options['jitter'],
+                        'cold': options['cold'],
+                        'recordings': options['recordings'],
+                    })
+                finally:
+                    self.reset_state()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        if options['record']:
+            save_recordings(recorder.recordings, options['record'])
+            self.stdout.write(f"Recorded {len(recorder.recordings)} queries to {options['record']}")
+            return
+
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                report['comparison'] = compare_reports(report, json.load(file))
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output)
+            self.stdout.write(f"Benchmarked {len(routes)} of {len(SCENARIOS)} scenarios, report written to "
+                              f"{options['output']}")
+        else:
+            self.stdout.write(output)
+
+    def reset_state(self):
+        """
+        Forget the client, cached results and table metadata, so that the run starts and ends with the
+        configured client and nothing cached.
+        """
+        get_client_manager().reset()
+        reset_query_cache()
+        bigQueryQueries.table_metadata.clear()
+        bigQueryQueries.cost_guard.estimates.clear()
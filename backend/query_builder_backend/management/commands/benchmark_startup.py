@@ -0,0 +1,39 @@
+import json
+import subprocess
+from django.core.management.base import BaseCommand, CommandError
+from query_builder_backend.benchmarks import STARTUP_PHASES, compare_startup_reports, run_startup_benchmark
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the startup of a process: run django.setup(), the import of the URLconf and the preloading "
+            "of the heavy modules in new interpreters, and write their time, peak memory and the heavy modules "
+            "they imported as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help="Number of new interpreters each phase runs in.")
+        parser.add_argument(
+            '--phase', action='append', choices=list(STARTUP_PHASES), default=[],
+            help="Only benchmark this phase. Can be repeated.",
+        )
+        parser.add_argument('--output', help="File to write the report to, instead of the standard output.")
+        parser.add_argument('--baseline', help="Report of another run to compare this one with.")
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError("--repeat must be at least 1")
+        try:
+            report = run_startup_benchmark(options['phase'] or None, options['repeat'])
+        except subprocess.CalledProcessError as e:
+            raise CommandError(f"A startup phase failed:\n{e.stderr}")
+
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                report['comparison'] = compare_startup_reports(report, json.load(file))
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output)
+            self.stdout.write(f"Benchmarked {len(report['phases'])} startup phases, report written to "
+                              f"{options['output']}")
+        else:
+            self.stdout.write(output)
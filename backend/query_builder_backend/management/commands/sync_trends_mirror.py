@@ -0,0 +1,41 @@
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from query_builder_backend.bigQueryQueries import TOP_RISING_TERMS_TABLE, TOP_TERMS_TABLE, get_client
+from query_builder_backend.models import TopRisingTermMirror, TopTermMirror
+from query_builder_backend.trendsMirror import sync_table
+
+# Tables that can be mirrored, by the name used on the command line
+MIRRORED_TABLES = {
+    'top_terms': (TOP_TERMS_TABLE, TopTermMirror),
+    'top_rising_terms': (TOP_RISING_TERMS_TABLE, TopRisingTermMirror),
+}
+
+
+class Command(BaseCommand):
+    help = "Copy the new refresh_date partitions of the Google Trends tables into the local mirror."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--table',
+            choices=sorted(MIRRORED_TABLES),
+            action='append',
+            help="Table to sync, can be repeated. Defaults to every table.",
+        )
+        parser.add_argument(
+            '--since',
+            help="Re-sync every partition from this date (YYYY-MM-DD) on.",
+        )
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = date.fromisoformat(options['since'])
+            except ValueError:
+                raise CommandError(f"Invalid date: {options['since']}")
+
+        client = get_client()
+        for name in options['table'] or sorted(MIRRORED_TABLES):
+            table, model = MIRRORED_TABLES[name]
+            copied = sync_table(client, table, model, since=since)
+            self.stdout.write(f"{name}: copied {copied} rows")
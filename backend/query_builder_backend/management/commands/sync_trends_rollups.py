@@ -0,0 +1,47 @@
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from query_builder_backend.bigQueryQueries import TOP_RISING_TERMS_TABLE, TOP_TERMS_TABLE, get_client
+from query_builder_backend.trendsRollups import GRANULARITIES, sync_rollup
+
+# Tables that can be summarized, by the name used on the command line, and whether they have a percent gain
+ROLLUP_TABLES = {
+    'top_terms': (TOP_TERMS_TABLE, False),
+    'top_rising_terms': (TOP_RISING_TERMS_TABLE, True),
+}
+
+
+class Command(BaseCommand):
+    help = "Summarize the new days of the Google Trends tables into the weekly and monthly rollups."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--table',
+            choices=sorted(ROLLUP_TABLES),
+            action='append',
+            help="Table to summarize, can be repeated. Defaults to every table.",
+        )
+        parser.add_argument(
+            '--granularity',
+            choices=list(GRANULARITIES),
+            action='append',
+            help="Rollup to build, can be repeated. Defaults to every granularity.",
+        )
+        parser.add_argument(
+            '--since',
+            help="Summarize every period from the one of this date (YYYY-MM-DD) on again.",
+        )
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = date.fromisoformat(options['since'])
+            except ValueError:
+                raise CommandError(f"Invalid date: {options['since']}")
+
+        client = get_client()
+        for name in options['table'] or sorted(ROLLUP_TABLES):
+            table, with_percent_gain = ROLLUP_TABLES[name]
+            for granularity in options['granularity'] or list(GRANULARITIES):
+                written = sync_rollup(client, table, granularity, with_percent_gain, since=since)
+                self.stdout.write(f"{name} {granularity}: wrote {written} rows")
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from query_builder_backend.cacheWarming import check_and_warm
+from query_builder_backend.models import WarmedWatermark
+
+
+class Command(BaseCommand):
+    help = ("Run the most requested BigQuery queries of the tables whose watermark moved since they were "
+            "last warmed, so that their results are cached. Only useful with a result cache shared between "
+            "processes, such as BIGQUERY_CACHE['BACKEND'] = 'django'.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help="Warm the most requested queries even if the watermarks did not move.",
+        )
+        parser.add_argument(
+            '--top',
+            type=int,
+            help="Number of most requested queries to warm. Defaults to BIGQUERY_CACHE_WARMING['TOP_N'].",
+        )
+
+    def handle(self, *args, **options):
+        if options['top'] is not None and options['top'] < 1:
+            raise CommandError("--top must be at least 1")
+
+        watermarks = {warmed.table: warmed.watermark for warmed in WarmedWatermark.objects.all()}
+
+        outcomes = check_and_warm(watermarks, force=options['force'], top_n=options['top'])
+
+        # Remember the watermarks the tables were warmed at
+        for table, watermark in watermarks.items():
+            WarmedWatermark.objects.update_or_create(table=table, defaults={'watermark': watermark})
+        self.stdout.write(", ".join(f"{outcome}: {count}" for outcome, count in outcomes.items()))
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Query',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=50)),
+                ('query', models.TextField()),
+                ('username', models.CharField(max_length=50)),
+                ('date', models.DateField(auto_now_add=True)),
+                ('query_comment', models.TextField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Comment',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('username', models.CharField(max_length=50)),
+                ('comment_text', models.TextField()),
+                ('query', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='query_builder_backend.query')),
+            ],
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_builder_backend', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MirrorSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(max_length=255, unique=True)),
+                ('min_refresh_date', models.DateField(null=True)),
+                ('max_refresh_date', models.DateField(null=True)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TopTermMirror',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('refresh_date', models.DateField()),
+                ('country_name', models.CharField(max_length=100)),
+                ('term', models.TextField()),
+                ('rank', models.IntegerField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['country_name', 'refresh_date'], name='query_build_country_7a4360_idx'), models.Index(fields=['refresh_date'], name='query_build_refresh_8f5636_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TopRisingTermMirror',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('refresh_date', models.DateField()),
+                ('country_name', models.CharField(max_length=100)),
+                ('term', models.TextField()),
+                ('rank', models.IntegerField()),
+                ('percent_gain', models.BigIntegerField(null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['country_name', 'refresh_date'], name='query_build_country_429c45_idx'), models.Index(fields=['refresh_date'], name='query_build_refresh_fcb8a9_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_builder_backend', '0002_trends_mirror'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['query', '-id'], name='query_build_query_i_ca8a76_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='query',
+            index=models.Index(fields=['date', 'id'], name='query_build_date_926722_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='query',
+            index=models.Index(fields=['username'], name='query_build_usernam_52e61f_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:18
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+from django.db.models import F, Func, OuterRef, Subquery, TextField, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_search_vectors(apps, schema_editor):
+    # Compute the search vector of the queries saved before the column existed
+    Query = apps.get_model('query_builder_backend', 'Query')
+    Comment = apps.get_model('query_builder_backend', 'Comment')
+    config = getattr(settings, 'SEARCH_CONFIG', 'simple')
+    comments = Comment.objects.filter(query=OuterRef('pk')).values('query').annotate(
+        text=StringAgg('comment_text', delimiter=' '),
+    ).values('text')
+    Query.objects.update(search_vector=(
+        SearchVector('name', weight='A', config=config)
+        + SearchVector('query_comment', weight='B', config=config)
+        + SearchVector(Func(F('query'), Value('/_'), Value('  '), function='translate', output_field=TextField()), weight='C', config=config)
+        + SearchVector(Coalesce(Subquery(comments), Value(''), output_field=TextField()), weight='D', config=config)
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_builder_backend', '0003_query_comment_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='query',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='query',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='query_build_search__05368e_gin'),
+        ),
+        migrations.RunPython(fill_search_vectors, migrations.RunPython.noop),
+    ]
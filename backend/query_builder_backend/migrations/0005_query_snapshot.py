@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_builder_backend', '0004_query_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuerySnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.TextField()),
+                ('table', models.CharField(max_length=255)),
+                ('watermark', models.DateField(null=True)),
+                ('data', models.BinaryField()),
+                ('row_count', models.IntegerField()),
+                ('bytes_processed', models.BigIntegerField(null=True)),
+                ('execution_seconds', models.FloatField()),
+                ('executed_at', models.DateTimeField(auto_now=True)),
+                ('query', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='snapshot', to='query_builder_backend.query')),
+            ],
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_builder_backend', '0005_query_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TermRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(max_length=255)),
+                ('granularity', models.CharField(max_length=5)),
+                ('period_start', models.DateField()),
+                ('country_name', models.CharField(max_length=100)),
+                ('term', models.TextField()),
+                ('days_present', models.IntegerField()),
+                ('days_at_rank_1', models.IntegerField()),
+                ('best_rank', models.IntegerField()),
+                ('mean_rank', models.FloatField()),
+                ('max_percent_gain', models.BigIntegerField(null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['table', 'granularity', 'country_name', 'period_start'], name='query_build_table_692adb_idx'), models.Index(fields=['table', 'granularity', 'period_start'], name='query_build_table_19d3b9_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='RollupSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(max_length=255)),
+                ('granularity', models.CharField(max_length=5)),
+                ('first_period_start', models.DateField(null=True)),
+                ('last_refresh_date', models.DateField(null=True)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('table', 'granularity')},
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('query_builder_backend', '0006_term_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HotQuery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=500, unique=True)),
+                ('endpoint', models.CharField(max_length=100)),
+                ('params', models.JSONField(default=dict)),
+                ('last_requested', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['last_requested'], name='query_build_last_re_5b908a_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='WarmedWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(max_length=255, unique=True)),
+                ('watermark', models.DateField(null=True)),
+                ('warmed_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HotQueryDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('hot_query', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='days', to='query_builder_backend.hotquery')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['day'], name='query_build_day_018af9_idx')],
+                'unique_together': {('hot_query', 'day')},
+            },
+        ),
+    ]
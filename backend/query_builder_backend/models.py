@@ -1,4 +1,6 @@
 from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 
 class Query(models.Model):
     id = models.AutoField(primary_key=True)
@@ -7,6 +9,16 @@ class Query(models.Model):
     username = models.CharField(max_length=50)
     date = models.DateField(auto_now_add=True)
     query_comment = models.TextField()
+    # Full-text search document of the query and its comments, kept up to date by querySearch
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the saved queries, newest first
+            models.Index(fields=['date', 'id']),
+            models.Index(fields=['username']),
+            GinIndex(fields=['search_vector']),
+        ]
 
     def __str__(self):
         return f"Query {self.id} - {self.username}"
@@ -17,5 +29,144 @@ class Comment(models.Model):
     username = models.CharField(max_length=50)
     comment_text = models.TextField()
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of the comments of a query, newest first
+            models.Index(fields=['query', '-id']),
+        ]
+
     def __str__(self):
         return f"Comment {self.id} on Query {self.query.id} - {self.username}"
+
+
+class TopTermMirror(models.Model):
+    refresh_date = models.DateField()
+    country_name = models.CharField(max_length=100)
+    term = models.TextField()
+    rank = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['country_name', 'refresh_date']),
+            models.Index(fields=['refresh_date']),
+        ]
+
+    def __str__(self):
+        return f"Top term {self.rank} on {self.refresh_date} in {self.country_name} - {self.term}"
+
+class TopRisingTermMirror(models.Model):
+    refresh_date = models.DateField()
+    country_name = models.CharField(max_length=100)
+    term = models.TextField()
+    rank = models.IntegerField()
+    percent_gain = models.BigIntegerField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['country_name', 'refresh_date']),
+            models.Index(fields=['refresh_date']),
+        ]
+
+    def __str__(self):
+        return f"Top rising term {self.rank} on {self.refresh_date} in {self.country_name} - {self.term}"
+
+class MirrorSyncState(models.Model):
+    table = models.CharField(max_length=255, unique=True)
+    min_refresh_date = models.DateField(null=True)
+    max_refresh_date = models.DateField(null=True)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Mirror of {self.table} from {self.min_refresh_date} to {self.max_refresh_date}"
+
+class QuerySnapshot(models.Model):
+    query = models.OneToOneField(Query, on_delete=models.CASCADE, related_name='snapshot')
+    # The saved query URL that was run, the snapshot is stale once the query is edited
+    source = models.TextField()
+    table = models.CharField(max_length=255)
+    # Refresh watermark of the table when the query ran, the snapshot is stale once it moves
+    watermark = models.DateField(null=True)
+    # The rows of the results as gzip compressed JSON
+    data = models.BinaryField()
+    row_count = models.IntegerField()
+    bytes_processed = models.BigIntegerField(null=True)
+    execution_seconds = models.FloatField()
+    executed_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Snapshot of Query {self.query_id} on {self.watermark} - {self.row_count} rows"
+
+class TermRollup(models.Model):
+    # Weekly or monthly summary of a term in a country, built from the daily rows by trendsRollups
+    table = models.CharField(max_length=255)
+    granularity = models.CharField(max_length=5)
+    period_start = models.DateField()
+    country_name = models.CharField(max_length=100)
+    term = models.TextField()
+    days_present = models.IntegerField()
+    days_at_rank_1 = models.IntegerField()
+    best_rank = models.IntegerField()
+    mean_rank = models.FloatField()
+    max_percent_gain = models.BigIntegerField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['table', 'granularity', 'country_name', 'period_start']),
+            models.Index(fields=['table', 'granularity', 'period_start']),
+        ]
+
+    def __str__(self):
+        return f"{self.granularity} of {self.period_start} in {self.country_name} - {self.term}"
+
+class RollupSyncState(models.Model):
+    # How far the TermRollup rows of a table and granularity reach, kept by trendsRollups
+    table = models.CharField(max_length=255)
+    granularity = models.CharField(max_length=5)
+    first_period_start = models.DateField(null=True)
+    last_refresh_date = models.DateField(null=True)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('table', 'granularity')
+
+    def __str__(self):
+        return f"{self.granularity} rollup of {self.table} from {self.first_period_start} to {self.last_refresh_date}"
+
+class HotQuery(models.Model):
+    # A BigQuery endpoint URL requested within the warming window, read by cacheWarming
+    path = models.CharField(max_length=500, unique=True)
+    endpoint = models.CharField(max_length=100)
+    params = models.JSONField(default=dict)
+    last_requested = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['last_requested']),
+        ]
+
+    def __str__(self):
+        return f"{self.path} - last requested {self.last_requested}"
+
+class HotQueryDay(models.Model):
+    # How often a HotQuery was requested on a day, summed over the warming window by cacheWarming
+    hot_query = models.ForeignKey(HotQuery, on_delete=models.CASCADE, related_name='days')
+    day = models.DateField()
+    hits = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('hot_query', 'day')
+        indexes = [
+            models.Index(fields=['day']),
+        ]
+
+    def __str__(self):
+        return f"{self.hot_query.path} on {self.day} - {self.hits} hits"
+
+class WarmedWatermark(models.Model):
+    # The watermark a table was last warmed at by the warm_trends_cache command
+    table = models.CharField(max_length=255, unique=True)
+    watermark = models.DateField(null=True)
+    warmed_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.table} warmed at {self.watermark}"
@@ -0,0 +1,30 @@
+"""
+The project configuration file (config.json).
+
+It holds the Django secret key, the service account credentials and the names
+of the BigQuery dataset and tables. The settings and the BigQuery endpoints
+both need it, so it is read once per process, from settings.CONFIG_PATH
+rather than from the working directory, and the parsed copy is shared.
+"""
+import json
+from functools import lru_cache
+from django.conf import settings
+
+
+@lru_cache(maxsize=None)
+def read_config(path):
+    """
+    Read a configuration file, once per path.
+
+    :param path: The path of the JSON file.
+    :return: A dictionary with its contents. Callers must not modify it.
+    """
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def get_config():
+    """
+    :return: The contents of settings.CONFIG_PATH.
+    """
+    return read_config(str(settings.CONFIG_PATH))
@@ -0,0 +1,221 @@
+"""
+Result cache for the BigQuery queries.
+
+The Google Trends tables only change once a day, so query results are cached
+under a key made of the normalized SQL, its parameters and the table's current
+MAX(refresh_date), as reported by the table metadata. When the table is refreshed
+the watermark moves forward and every older entry stops being reachable.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Default configuration of the result cache, overridable with settings.BIGQUERY_CACHE
+DEFAULT_CACHE_SETTINGS = {
+    'BACKEND': 'lru',
+    'MAX_ENTRIES': 1024,
+    'TIMEOUT': 60 * 60 * 24,
+    'ALIAS': 'default',
+}
+
+
+def get_cache_settings():
+    """
+    Get the result cache settings merged over the defaults.
+
+    :return: A dictionary with the cache settings.
+    """
+    return {**DEFAULT_CACHE_SETTINGS, **getattr(settings, 'BIGQUERY_CACHE', {})}
+
+
+class LRUCacheBackend:
+    """
+    Thread-safe in-process LRU cache with a per-entry time to live.
+    """
+
+    def __init__(self, max_entries=1024, timeout=None):
+        """
+        :param max_entries: The maximum number of entries to keep.
+        :param timeout: The default time to live of an entry in seconds, None to keep entries until evicted.
+        """
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get a value from the cache.
+
+        :param key: The key of the entry.
+        :return: The cached value, or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            # Drop the entry if it expired
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            # Mark the entry as the most recently used
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        """
+        Store a value in the cache, evicting the least recently used entries if needed.
+
+        :param key: The key of the entry.
+        :param value: The value to store.
+        :param timeout: The time to live of the entry in seconds, defaults to the backend timeout.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        expires_at = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            # Evict the least recently used entries
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Remove an entry from the cache.
+
+        :param key: The key of the entry.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove every entry from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DjangoCacheBackend:
+    """
+    Cache backed by one of the caches configured in settings.CACHES.
+    """
+
+    def __init__(self, alias='default', timeout=None):
+        """
+        :param alias: The alias of the Django cache to use.
+        :param timeout: The default time to live of an entry in seconds.
+        """
+        from django.core.cache import caches
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.cache.set(key, value, self.timeout if timeout is None else timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+
+# Short names for the bundled backends
+CACHE_BACKENDS = {
+    'lru': LRUCacheBackend,
+    'django': DjangoCacheBackend,
+}
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def create_cache(cache_settings=None):
+    """
+    Build a cache backend from the given settings.
+
+    :param cache_settings: The cache settings, defaults to settings.BIGQUERY_CACHE.
+    :return: A cache backend instance.
+    """
+    cache_settings = cache_settings or get_cache_settings()
+    backend = cache_settings['BACKEND']
+    # Resolve short names and dotted paths to a backend class
+    backend_class = CACHE_BACKENDS.get(backend) or import_string(backend)
+    if backend_class is DjangoCacheBackend:
+        return DjangoCacheBackend(alias=cache_settings['ALIAS'], timeout=cache_settings['TIMEOUT'])
+    return backend_class(max_entries=cache_settings['MAX_ENTRIES'], timeout=cache_settings['TIMEOUT'])
+
+
+def get_query_cache():
+    """
+    Get the process-wide result cache, creating it on first use.
+
+    :return: The configured cache backend.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = create_cache()
+    return _cache
+
+
+def reset_query_cache():
+    """
+    Drop the process-wide result cache so it is rebuilt from the settings on next use.
+    """
+    global _cache
+    with _cache_lock:
+        _cache = None
+
+
+def normalize_query(query):
+    """
+    Collapse the whitespace of a query so that formatting does not change its cache key.
+
+    :param query: The SQL query.
+    :return: The normalized query.
+    """
+    return " ".join(query.split())
+
+
+def serialize_query_params(query_params):
+    """
+    Turn BigQuery query parameters into a JSON-serializable list sorted by name.
+
+    :param query_params: The ScalarQueryParameter or ArrayQueryParameter objects of the query.
+    :return: A list with the API representation of each parameter.
+    """
+    return sorted(
+        (param.to_api_repr() for param in query_params),
+        key=lambda param: param.get('name') or '',
+    )
+
+
+def make_cache_key(query, query_params, watermark=None):
+    """
+    Build the cache key of a query.
+
+    :param query: The SQL query.
+    :param query_params: The parameters of the query.
+    :param watermark: The refresh watermark of the table the query reads from.
+    :return: The cache key.
+    """
+    payload = json.dumps(
+        [normalize_query(query), serialize_query_params(query_params), str(watermark)],
+        separators=(',', ':'),
+        sort_keys=True,
+        default=str,
+    )
+    return "bigquery:" + hashlib.sha256(payload.encode('utf-8')).hexdigest()
@@ -0,0 +1,132 @@
+"""
+Cost guardrails for the BigQuery queries.
+
+Before a query runs, a dry run estimates how many bytes it will scan. Queries
+over the per-request budget are rejected before they start. Estimates are cached
+per query shape (the normalized SQL, its parameters and the table watermark).
+Every job is also capped with maximum_bytes_billed, so BigQuery itself fails a
+job that would scan more than allowed.
+
+Dry runs go through the circuit breaker and the retries of queryResilience,
+within the deadline of the request, like the queries themselves.
+"""
+from django.conf import settings
+from .bigQueryClient import bigquery
+from .queryCache import LRUCacheBackend, make_cache_key
+from .queryResilience import call_with_retries, remaining_time
+
+# Default configuration of the guardrails, overridable with settings.BIGQUERY_COST
+DEFAULT_COST_SETTINGS = {
+    'DRY_RUN': True,
+    'MAX_BYTES_PER_REQUEST': None,
+    'MAXIMUM_BYTES_BILLED': None,
+    'ESTIMATE_CACHE_SIZE': 1024,
+    'ESTIMATE_TIMEOUT': 60 * 60 * 24,
+}
+
+# Response header with the estimated bytes of the query
+ESTIMATE_HEADER = 'X-BigQuery-Estimated-Bytes'
+
+
+def get_cost_settings():
+    """
+    Get the cost settings merged over the defaults.
+
+    :return: A dictionary with the cost settings.
+    """
+    return {**DEFAULT_COST_SETTINGS, **getattr(settings, 'BIGQUERY_COST', {})}
+
+
+class QueryOverBudget(Exception):
+    """
+    Raised when the dry run of a query estimates more bytes than a request may scan.
+    """
+
+    def __init__(self, estimated_bytes, max_bytes):
+        """
+        :param estimated_bytes: The bytes the query would scan.
+        :param max_bytes: The bytes a request may scan.
+        """
+        super().__init__(
+            f"The query would scan {estimated_bytes} bytes, over the limit of {max_bytes} bytes per request. "
+            f"Narrow the date range or the countries requested."
+        )
+        self.estimated_bytes = estimated_bytes
+        self.max_bytes = max_bytes
+
+    def to_dict(self):
+        """
+        :return: The error as a JSON-serializable dictionary.
+        """
+        return {"error": str(self), "estimated_bytes": self.estimated_bytes, "max_bytes": self.max_bytes}
+
+
+class QueryCostGuard:
+    """
+    Estimates the bytes a query scans with dry runs and rejects queries over the budget.
+    """
+
+    def __init__(self, client_getter):
+        """
+        :param client_getter: A callable that returns the BigQuery client.
+        """
+        self.client_getter = client_getter
+        cost_settings = get_cost_settings()
+        self.estimates = LRUCacheBackend(
+            max_entries=cost_settings['ESTIMATE_CACHE_SIZE'],
+            timeout=cost_settings['ESTIMATE_TIMEOUT'],
+        )
+
+    def estimate(self, query, query_params, watermark=None):
+        """
+        Get the bytes a query would scan, from the estimate cache or a dry run.
+
+        :param query: The query to run.
+        :param query_params: The parameters to use in the query.
+        :param watermark: The refresh watermark of the table, since the estimate grows with it.
+        :return: The estimated number of bytes processed.
+        :raises CircuitOpen: If the dry run is needed while the circuit breaker is open.
+        """
+        key = make_cache_key(query, query_params, watermark)
+        estimated_bytes = self.estimates.get(key)
+        if estimated_bytes is None:
+            query_job = call_with_retries(lambda: self.client_getter().query(
+                query,
+                job_config=bigquery.QueryJobConfig(
+                    query_parameters=query_params,
+                    dry_run=True,
+                    use_query_cache=False,
+                ),
+                timeout=remaining_time(),
+            ))
+            estimated_bytes = query_job.total_bytes_processed or 0
+            self.estimates.set(key, estimated_bytes)
+        return estimated_bytes
+
+    def check(self, query, query_params, watermark=None):
+        """
+        Estimate a query and reject it if it is over the per-request budget.
+
+        :param query: The query to run.
+        :param query_params: The parameters to use in the query.
+        :param watermark: The refresh watermark of the table the query reads from.
+        :return: The estimated number of bytes processed, or None if dry runs are disabled.
+        :raises QueryOverBudget: If the estimate is over BIGQUERY_COST['MAX_BYTES_PER_REQUEST'].
+        """
+        cost_settings = get_cost_settings()
+        if not cost_settings['DRY_RUN']:
+            return None
+        estimated_bytes = self.estimate(query, query_params, watermark)
+        max_bytes = cost_settings['MAX_BYTES_PER_REQUEST']
+        if max_bytes is not None and estimated_bytes > max_bytes:
+            raise QueryOverBudget(estimated_bytes, max_bytes)
+        return estimated_bytes
+
+
+def get_maximum_bytes_billed():
+    """
+    Get the cap set on every query job.
+
+    :return: BIGQUERY_COST['MAXIMUM_BYTES_BILLED'], or None for no cap.
+    """
+    return get_cost_settings()['MAXIMUM_BYTES_BILLED']
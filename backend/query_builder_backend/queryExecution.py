@@ -0,0 +1,152 @@
+"""
+Server-side execution of the saved queries.
+
+A saved query stores the URL of the BigQuery endpoint it was built with. The
+URL is resolved to its view, whose build_query gives the SQL, and the query is
+run once on BigQuery. Its rows are kept as a gzip compressed snapshot linked to
+the saved query, with the execution time, bytes processed and row count, and
+every later view is served from the snapshot. A snapshot is invalidated when
+the table it reads from is refreshed, when the saved query is edited, or on
+demand.
+"""
+import gzip
+import json
+import time
+from urllib.parse import unquote, urlparse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.urls import Resolver404, resolve
+from .models import QuerySnapshot
+from .queryResilience import call_with_retries
+from .singleFlight import SingleFlight
+from . import bigQueryQueries
+
+# Header telling whether the results came from the snapshot ('hit') or a new execution ('miss')
+SNAPSHOT_STATUS_HEADER = 'X-Snapshot-Status'
+
+# Coalesces the executions of the same saved query that start at the same time
+snapshot_flights = SingleFlight()
+
+
+class SavedQueryError(ValueError):
+    """
+    Raised when a saved query does not point to a BigQuery endpoint that can be run on the server.
+    """
+
+
+def resolve_saved_query(url):
+    """
+    Turn the URL of a saved query into the query of its endpoint.
+
+    :param url: The URL saved in Query.query, such as http://host/api/bigquery/get/top_terms_day/Colombia/2023-11-01.
+    :return: The query, its parameters and the table it reads from.
+    :raises SavedQueryError: If the URL is not one of the endpoints of a single query.
+    """
+    path = unquote(urlparse(url).path)
+    try:
+        match = resolve(path)
+    except Resolver404:
+        raise SavedQueryError(f"The saved query does not point to an endpoint: {url}")
+    view_class = getattr(match.func, 'view_class', None)
+    # The async endpoints run the query of their synchronous view
+    view_class = getattr(view_class, 'query_view', None) or view_class
+    build_query = getattr(view_class, 'build_query', None)
+    if build_query is None:
+        raise SavedQueryError(f"The saved query cannot be run on the server: {url}")
+    try:
+        return build_query(**match.kwargs)
+    except (TypeError, ValueError):
+        raise SavedQueryError(f"The saved query cannot be run on the server: {url}")
+
+
+def compress_rows(rows):
+    """
+    :param rows: A list of dictionaries.
+    :return: The rows as gzip compressed JSON.
+    """
+    return gzip.compress(json.dumps(rows, cls=DjangoJSONEncoder).encode('utf-8'))
+
+
+def decompress_rows(data):
+    """
+    :param data: The gzip compressed JSON of a snapshot.
+    :return: The list of dictionaries.
+    """
+    return json.loads(gzip.decompress(bytes(data)))
+
+
+def execute_saved_query(saved_query):
+    """
+    Run a saved query on BigQuery and replace its snapshot with the results.
+
+    :param saved_query: The Query to run.
+    :return: The new QuerySnapshot.
+    :raises SavedQueryError: If the saved query cannot be run on the server.
+    :raises QueryOverBudget: If the query would scan more than a request may.
+    """
+    query, query_params, table = resolve_saved_query(saved_query.query)
+    watermark = bigQueryQueries.fetch_watermark(table)
+    bigQueryQueries.check_query_cost(query, query_params, table)
+
+    def run():
+        query_job = bigQueryQueries.submit_query(query, query_params)
+        return query_job, bigQueryQueries.fetch_rows(query_job)
+
+    started = time.perf_counter()
+    # Run the query through the circuit breaker, retrying it on retryable errors
+    query_job, rows = call_with_retries(run)
+    execution_seconds = time.perf_counter() - started
+
+    snapshot, _ = QuerySnapshot.objects.update_or_create(
+        query=saved_query,
+        defaults={
+            'source': saved_query.query,
+            'table': table,
+            'watermark': watermark,
+            'data': compress_rows(rows),
+            'row_count': len(rows),
+            'bytes_processed': query_job.total_bytes_processed,
+            'execution_seconds': execution_seconds,
+        },
+    )
+    return snapshot
+
+
+def is_fresh(snapshot, saved_query):
+    """
+    Check whether a snapshot still has the results of a saved query.
+
+    :param snapshot: The QuerySnapshot.
+    :param saved_query: The Query.
+    :return: True if the query was not edited and its table was not refreshed since the snapshot was taken.
+    """
+    if snapshot.source != saved_query.query:
+        return False
+    return snapshot.watermark == bigQueryQueries.fetch_watermark(snapshot.table)
+
+
+def get_snapshot(saved_query, refresh=False):
+    """
+    Get the snapshot of a saved query, running the query if it has none or it is stale.
+    Concurrent calls for the same saved query share a single execution.
+
+    :param saved_query: The Query.
+    :param refresh: Run the query again even if the snapshot is fresh.
+    :return: The QuerySnapshot and whether it was served without running the query.
+    """
+    if not refresh:
+        snapshot = QuerySnapshot.objects.filter(query=saved_query).first()
+        if snapshot is not None and is_fresh(snapshot, saved_query):
+            return snapshot, True
+    return snapshot_flights.do(saved_query.id, lambda: execute_saved_query(saved_query)), False
+
+
+def invalidate_snapshot(query_id):
+    """
+    Forget the snapshot of a saved query so that the next view runs it again.
+
+    :param query_id: The id of the Query.
+    :return: True if there was a snapshot.
+    """
+    deleted, _ = QuerySnapshot.objects.filter(query_id=query_id).delete()
+    return deleted > 0
+
@@ -0,0 +1,231 @@
+"""
+In-process queue of BigQuery jobs for long running requests.
+
+Submitting a query returns a job id at once and the query runs on a bounded
+thread pool, so the web worker is free as soon as the job is queued. Clients
+poll the status of the job, which reports its progress, and read its rows once
+it is done. The number of queries running at the same time is capped by the
+size of the pool, and the number of queries waiting for a worker by the
+backlog cap. Finished jobs are kept in memory for a while and then forgotten.
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .queryMetrics import background_job_wait
+
+# Default configuration of the job queue, overridable with settings.BIGQUERY_JOBS
+DEFAULT_JOB_SETTINGS = {
+    'MAX_WORKERS': 4,
+    'MAX_QUEUED': 100,
+    'RESULT_TTL': 60 * 60,
+}
+
+# States of a job
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def get_job_settings():
+    """
+    Get the job queue settings merged over the defaults.
+
+    :return: A dictionary with the job queue settings.
+    """
+    return {**DEFAULT_JOB_SETTINGS, **getattr(settings, 'BIGQUERY_JOBS', {})}
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job is submitted while the backlog of the queue is full.
+    """
+
+
+class QueryJob:
+    """
+    A query submitted to the queue, its progress and its results.
+    """
+
+    def __init__(self, description):
+        """
+        :param description: What the job runs, shown in its status.
+        """
+        self.id = uuid.uuid4().hex
+        self.description = description
+        self.state = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.bigquery_job_id = None
+        self.total_rows = None
+        self.rows_fetched = 0
+        self.rows = None
+        self.error = None
+        self._finished = threading.Event()
+
+    def is_finished(self):
+        return self.state in (DONE, FAILED)
+
+    def finish(self, state, rows=None, error=None):
+        """
+        Record the outcome of the job and wake up the callers waiting for it.
+
+        :param state: DONE or FAILED.
+        :param rows: The rows of a job that is done.
+        :param error: The error message of a job that failed.
+        """
+        self.rows = rows
+        self.error = error
+        self.finished_at = time.time()
+        self.state = state
+        self._finished.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the job to finish.
+
+        :param timeout: The maximum number of seconds to wait, None to wait forever.
+        :return: True if the job is finished.
+        """
+        return self._finished.wait(timeout)
+
+    def to_dict(self):
+        """
+        :return: The status of the job as a JSON-serializable dictionary.
+        """
+        return {
+            'job_id': self.id,
+            'description': self.description,
+            'state': self.state,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'bigquery_job_id': self.bigquery_job_id,
+            'total_rows': self.total_rows,
+            'rows_fetched': self.rows_fetched,
+            'error': self.error,
+        }
+
+
+class QueryJobQueue:
+    """
+    Runs the submitted jobs on a bounded thread pool and keeps their state.
+    """
+
+    def __init__(self, max_workers, max_queued, result_ttl):
+        """
+        :param max_workers: The number of jobs that run at the same time.
+        :param max_queued: The number of jobs that may wait for a worker.
+        :param result_ttl: How long a finished job is kept, in seconds.
+        """
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bigquery-jobs')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, description, work):
+        """
+        Queue a job.
+
+        :param description: What the job runs, shown in its status.
+        :param work: A function called with the QueryJob that returns its rows. It may update the
+            progress attributes of the job while it runs.
+        :return: The QueryJob.
+        :raises QueueFull: If as many jobs as the workers and the backlog allow are already waiting or running.
+        """
+        job = QueryJob(description)
+        with self._lock:
+            self._prune()
+            unfinished = sum(1 for other in self._jobs.values() if not other.is_finished())
+            if unfinished >= self.max_workers + self.max_queued:
+                raise QueueFull(f"Too many queued jobs ({unfinished}), try again later")
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, work)
+        return job
+
+    def finished(self, description, rows):
+        """
+        Record a job whose rows are already known, such as cached ones, without using a worker.
+
+        :param description: What the job runs, shown in its status.
+        :param rows: The rows of the job.
+        :return: The finished QueryJob.
+        """
+        job = QueryJob(description)
+        job.started_at = job.created_at
+        job.total_rows = job.rows_fetched = len(rows)
+        job.finish(DONE, rows=rows)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        return job
+
+    def _run(self, job, work):
+        """
+        Run a job on a worker thread and record its outcome.
+        """
+        job.state = RUNNING
+        job.started_at = time.time()
+        background_job_wait.observe(job.started_at - job.created_at)
+        try:
+            rows = work(job)
+        except Exception as e:
+            job.finish(FAILED, error=str(e))
+        else:
+            job.finish(DONE, rows=rows)
+
+    def _prune(self):
+        """
+        Forget the jobs that finished more than result_ttl seconds ago. Called with the lock held.
+        """
+        expired_before = time.time() - self.result_ttl
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.is_finished() and job.finished_at < expired_before]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """
+        :param job_id: The id of the job.
+        :return: The QueryJob, or None if it does not exist or expired.
+        """
+        with self._lock:
+            self._prune()
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        """
+        :return: The number of jobs in each state and the limits of the queue.
+        """
+        with self._lock:
+            counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+            for job in self._jobs.values():
+                counts[job.state] += 1
+        return {**counts, 'max_workers': self.max_workers, 'max_queued': self.max_queued}
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """
+    Get the process-wide job queue, creating it on first use.
+
+    :return: The QueryJobQueue.
+    """
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                job_settings = get_job_settings()
+                _queue = QueryJobQueue(
+                    max_workers=job_settings['MAX_WORKERS'],
+                    max_queued=job_settings['MAX_QUEUED'],
+                    result_ttl=job_settings['RESULT_TTL'],
+                )
+    return _queue
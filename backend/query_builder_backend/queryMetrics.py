@@ -0,0 +1,379 @@
+"""
+Latency and BigQuery cost instrumentation.
+
+Every request is timed per endpoint, and every BigQuery job records its queue
+and execution time on BigQuery, the rows it returned and the bytes it processed
+and billed. Result cache lookups are counted as hits or misses, and the time
+spent encoding JSON responses is measured.
+
+The measurements are kept in memory as Prometheus counters and histograms and
+exported in the Prometheus text format by the metrics endpoint. The timings of
+the current request are also sent back in its Server-Timing header, so they can
+be read in the network panel of the browser.
+
+Each process keeps its own metrics: with several workers, every worker is a
+separate Prometheus target.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+from django.views import View
+
+# Default configuration of the instrumentation, overridable with settings.METRICS
+DEFAULT_METRICS_SETTINGS = {
+    'ENABLED': True,
+    'SERVER_TIMING': True,
+}
+
+# Media type of the Prometheus text format
+PROMETHEUS_MEDIA_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+ROW_BUCKETS = (0, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = (1e6, 1e7, 1e8, 1e9, 1e10, 1e11, 1e12)
+
+
+def get_metrics_settings():
+    """
+    Get the instrumentation settings merged over the defaults.
+
+    :return: A dictionary with the instrumentation settings.
+    """
+    return {**DEFAULT_METRICS_SETTINGS, **getattr(settings, 'METRICS', {})}
+
+
+def format_value(value):
+    """
+    :return: A sample value in the Prometheus text format.
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    """
+    :param labels: A list of (name, value) pairs.
+    :return: The labels of a sample in the Prometheus text format.
+    """
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Counter:
+    """
+    A counter, one value per combination of labels.
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """
+        :param amount: How much to add to the counter.
+        :param labels: The value of each label of the counter.
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """
+        :return: The current value of the counter for some labels.
+        """
+        with self._lock:
+            return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def samples(self):
+        """
+        :return: The samples of the counter, as (name, labels, value) tuples.
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(f'{self.name}_total', list(zip(self.labelnames, key)), value) for key, value in values]
+
+
+class Histogram:
+    """
+    A histogram with cumulative buckets, one per combination of labels.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """
+        :param value: The observed value.
+        :param labels: The value of each label of the histogram.
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        """
+        :return: The number of observations for some labels.
+        """
+        with self._lock:
+            counts, _ = self._values.get(tuple(str(labels[name]) for name in self.labelnames), ([0], 0))
+        return counts[-1]
+
+    def samples(self):
+        """
+        :return: The samples of the histogram, as (name, labels, value) tuples.
+        """
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        samples = []
+        for key, (counts, total) in values:
+            labels = list(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, counts):
+                samples.append((f'{self.name}_bucket', labels + [('le', format_value(bound))], count))
+            samples.append((f'{self.name}_count', labels, counts[-1]))
+            samples.append((f'{self.name}_sum', labels, total))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    The metrics of the process, rendered together in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """
+        :param metric: A Counter or a Histogram.
+        :return: The metric.
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        :return: Every metric in the Prometheus text format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+http_requests = registry.register(Counter(
+    'http_requests', 'HTTP requests answered, by endpoint, method and status.', ['endpoint', 'method', 'status'],
+))
+http_request_duration = registry.register(Histogram(
+    'http_request_duration_seconds', 'Time to build the response of a request, by endpoint.', ['endpoint', 'method'],
+))
+bigquery_jobs = registry.register(Counter(
+    'bigquery_jobs', 'BigQuery jobs whose results were read, by whether BigQuery answered from its cache.',
+    ['cache_hit'],
+))
+bigquery_queue_duration = registry.register(Histogram(
+    'bigquery_job_queue_seconds', 'Time BigQuery jobs waited between their creation and their start.',
+))
+bigquery_execution_duration = registry.register(Histogram(
+    'bigquery_job_execution_seconds', 'Time BigQuery jobs ran on BigQuery.',
+))
+bigquery_fetch_duration = registry.register(Histogram(
+    'bigquery_fetch_seconds', 'Time spent waiting for the results of BigQuery jobs and reading them.',
+))
+bigquery_rows = registry.register(Histogram(
+    'bigquery_job_rows', 'Rows returned by BigQuery jobs.', buckets=ROW_BUCKETS,
+))
+bigquery_bytes_processed = registry.register(Counter(
+    'bigquery_bytes_processed', 'Bytes processed by BigQuery jobs.',
+))
+bigquery_bytes_billed = registry.register(Counter(
+    'bigquery_bytes_billed', 'Bytes billed for BigQuery jobs.',
+))
+bigquery_job_bytes = registry.register(Histogram(
+    'bigquery_job_bytes_processed', 'Bytes processed by each BigQuery job.', buckets=BYTE_BUCKETS,
+))
+bigquery_errors = registry.register(Counter(
+    'bigquery_query_errors', 'Queries that failed, by error type.', ['error'],
+))
+result_cache_lookups = registry.register(Counter(
+    'bigquery_result_cache_lookups', 'Lookups of the BigQuery result cache, by result.', ['result'],
+))
+serialization_duration = registry.register(Histogram(
+    'response_serialization_seconds', 'Time spent encoding JSON responses.',
+))
+background_job_wait = registry.register(Histogram(
+    'background_job_wait_seconds', 'Time background jobs waited for a worker of the job queue.',
+))
+
+# Timings of the current request, read by MetricsMiddleware for the Server-Timing header
+request_timings = ContextVar('request_timings', default=None)
+
+
+def record_timing(name, seconds=None, description=None):
+    """
+    Add a timing to the Server-Timing header of the current request, if there is one.
+    Timings with the same name are added up.
+
+    :param name: The name of the timing.
+    :param seconds: The duration, or None for a timing with only a description.
+    :param description: A description, such as 'hit' or 'miss'.
+    """
+    timings = request_timings.get()
+    if timings is None:
+        return
+    duration, previous_description = timings.get(name, (None, None))
+    if seconds is not None:
+        duration = (duration or 0) + seconds
+    timings[name] = (duration, description if description is not None else previous_description)
+
+
+@contextmanager
+def timed(histogram, timing_name):
+    """
+    Measure a block of code into a histogram and the Server-Timing header.
+
+    :param histogram: The Histogram to observe the duration in.
+    :param timing_name: The name of the timing in the Server-Timing header.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.observe(elapsed)
+        record_timing(timing_name, elapsed)
+
+
+def observe_query_job(query_job, rows, fetch_seconds):
+    """
+    Record the statistics of a BigQuery job whose results were read.
+
+    :param query_job: The BigQuery query job.
+    :param rows: The number of rows it returned.
+    :param fetch_seconds: The time spent waiting for its results and reading them.
+    """
+    bigquery_jobs.inc(cache_hit=bool(getattr(query_job, 'cache_hit', False)))
+    bigquery_fetch_duration.observe(fetch_seconds)
+    bigquery_rows.observe(rows)
+    record_timing('bq-fetch', fetch_seconds)
+
+    created, started, ended = (getattr(query_job, name, None) for name in ('created', 'started', 'ended'))
+    if created is not None and started is not None:
+        queue_seconds = max((started - created).total_seconds(), 0)
+        bigquery_queue_duration.observe(queue_seconds)
+        record_timing('bq-queue', queue_seconds)
+    if started is not None and ended is not None:
+        execution_seconds = max((ended - started).total_seconds(), 0)
+        bigquery_execution_duration.observe(execution_seconds)
+        record_timing('bq-exec', execution_seconds)
+
+    bytes_processed = getattr(query_job, 'total_bytes_processed', None)
+    if bytes_processed is not None:
+        bigquery_bytes_processed.inc(bytes_processed)
+        bigquery_job_bytes.observe(bytes_processed)
+    bytes_billed = getattr(query_job, 'total_bytes_billed', None)
+    if bytes_billed is not None:
+        bigquery_bytes_billed.inc(bytes_billed)
+
+
+def observe_cache_lookup(hit):
+    """
+    :param hit: Whether the results were found in the result cache.
+    """
+    result = 'hit' if hit else 'miss'
+    result_cache_lookups.inc(result=result)
+    record_timing('cache', description=result)
+
+
+def server_timing(timings):
+    """
+    :param timings: The timings of a request, by name, as (seconds, description) pairs.
+    :return: The value of the Server-Timing header.
+    """
+    entries = []
+    for name, (seconds, description) in timings.items():
+        entry = name
+        if seconds is not None:
+            entry += f';dur={seconds * 1000:.1f}'
+        if description is not None:
+            entry += f';desc="{description}"'
+        entries.append(entry)
+    return ', '.join(entries)
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    Time every request per endpoint and send its timings in the Server-Timing header.
+    """
+
+    def process_request(self, request):
+        request._metrics_started = time.perf_counter()
+        request._metrics_timings = {}
+        request_timings.set(request._metrics_timings)
+
+    def process_response(self, request, response):
+        started = getattr(request, '_metrics_started', None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        match = getattr(request, 'resolver_match', None)
+        # Label by the name of the URL pattern, not by the path, to keep the number of series bounded
+        endpoint = (match.url_name or match.view_name) if match is not None else 'unmatched'
+
+        metrics_settings = get_metrics_settings()
+        if metrics_settings['ENABLED']:
+            http_requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+            http_request_duration.observe(elapsed, endpoint=endpoint, method=request.method)
+        if metrics_settings['SERVER_TIMING']:
+            timings = {**request._metrics_timings, 'total': (elapsed, None)}
+            response['Server-Timing'] = server_timing(timings)
+        return response
+
+
+class MetricsEndpoint(View):
+    def get(self, request):
+        """
+        Handle GET requests to get the metrics of the process in the Prometheus text format.
+
+        :param request: The HTTP request object.
+
+        :return: A text response.
+            - If the metrics are enabled, returns:
+                the counters and histograms
+                with HTTP status 200 (OK).
+            - If the metrics are disabled, returns:
+                an error message
+                with HTTP status 404 (Not Found).
+        """
+        if not get_metrics_settings()['ENABLED']:
+            return HttpResponse("Metrics are disabled", status=404, content_type='text/plain')
+        return HttpResponse(registry.render(), content_type=PROMETHEUS_MEDIA_TYPE)
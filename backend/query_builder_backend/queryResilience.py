@@ -0,0 +1,483 @@
+"""
+Bounded latency for the BigQuery endpoints while BigQuery is slow or failing.
+
+Deadlines: every BigQuery endpoint has a time budget, DEADLINE seconds or the
+one of its URL name in DEADLINES. The deadline of the current request is kept
+in a context variable, so every wait on BigQuery (query results, retries,
+single-flight followers) is bounded by what is left of it. A job whose results
+are abandoned, because the deadline passed or the async request was cancelled,
+is cancelled on BigQuery.
+
+Retries: queries failing with a retryable error (rate limits, backend errors,
+5xx, connection errors) are run again up to RETRIES times, after a delay drawn
+at random between 0 and an exponential backoff ("full jitter"). A retry is
+skipped when its delay would not fit in the deadline.
+
+Circuit breaker: after BREAKER_FAILURES consecutive timeouts or retryable
+errors, queries are failed at once for BREAKER_RESET seconds, then a single
+trial query decides whether to close it again.
+
+Stale results: the last rows of every query are kept STALE_TIMEOUT seconds
+under a key without the table watermark. When a query fails, they are served
+instead, marked with the X-BigQuery-Stale and Warning headers.
+"""
+import asyncio
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from django.conf import settings
+from django.utils.cache import patch_cache_control
+from .queryCache import make_cache_key
+from .queryMetrics import Counter, record_timing, registry
+
+# Default configuration of the deadlines, retries and circuit breaker, overridable with settings.BIGQUERY_RESILIENCE
+DEFAULT_RESILIENCE_SETTINGS = {
+    'DEADLINE': 30,
+    'DEADLINES': {},
+    'RETRIES': 2,
+    'RETRY_BASE_DELAY': 0.2,
+    'RETRY_MAX_DELAY': 2.0,
+    'BREAKER_FAILURES': 5,
+    'BREAKER_RESET': 30,
+    'STALE_TIMEOUT': 60 * 60 * 24 * 7,
+}
+
+# Header of the responses built from stale results
+STALE_HEADER = 'X-BigQuery-Stale'
+
+# Reasons of the BigQuery errors worth retrying
+RETRYABLE_REASONS = ('backendError', 'internalError', 'rateLimitExceeded', 'jobRateLimitExceeded')
+
+# States of the circuit breaker
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+bigquery_retries = registry.register(Counter(
+    'bigquery_retries', 'Queries run again after a retryable error, by error type.', ['error'],
+))
+bigquery_cancelled_jobs = registry.register(Counter(
+    'bigquery_cancelled_jobs', 'BigQuery jobs cancelled because their results were abandoned, by reason.', ['reason'],
+))
+breaker_transitions = registry.register(Counter(
+    'bigquery_circuit_breaker_transitions', 'Changes of state of the BigQuery circuit breaker, by new state.', ['state'],
+))
+stale_responses = registry.register(Counter(
+    'bigquery_stale_responses', 'Responses built from the last good results of a failing query.',
+))
+
+
+def get_resilience_settings():
+    """
+    Get the resilience settings merged over the defaults.
+
+    :return: A dictionary with the resilience settings.
+    """
+    return {**DEFAULT_RESILIENCE_SETTINGS, **getattr(settings, 'BIGQUERY_RESILIENCE', {})}
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised when the deadline of the request passed before BigQuery answered.
+    """
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of running a query while the circuit breaker is open.
+    """
+
+    def __init__(self, retry_after):
+        """
+        :param retry_after: The number of seconds until the breaker lets a trial query through.
+        """
+        super().__init__("BigQuery is unavailable, try again later")
+        self.retry_after = retry_after
+
+
+# Deadline of the current request, as a time.monotonic() value
+request_deadline = ContextVar('request_deadline', default=None)
+
+
+def get_endpoint_deadline(request):
+    """
+    :param request: The HTTP request object.
+    :return: The number of seconds the endpoint of the request may wait on BigQuery, or None for no limit.
+    """
+    resilience_settings = get_resilience_settings()
+    match = getattr(request, 'resolver_match', None)
+    url_name = match.url_name if match is not None else None
+    return resilience_settings['DEADLINES'].get(url_name, resilience_settings['DEADLINE'])
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Bound the waits on BigQuery of a block of code. An enclosing deadline that is sooner still applies.
+
+    :param seconds: The number of seconds from now, or None for no limit.
+    """
+    if seconds is None:
+        yield
+        return
+    current = request_deadline.get()
+    limit = time.monotonic() + seconds
+    token = request_deadline.set(limit if current is None else min(current, limit))
+    try:
+        yield
+    finally:
+        request_deadline.reset(token)
+
+
+def remaining_time():
+    """
+    :return: The number of seconds left before the deadline, 0 if it passed, or None without a deadline.
+    """
+    limit = request_deadline.get()
+    if limit is None:
+        return None
+    return max(limit - time.monotonic(), 0)
+
+
+def check_deadline():
+    """
+    :raises DeadlineExceeded: If the deadline of the request passed.
+    """
+    if remaining_time() == 0:
+        raise DeadlineExceeded("The query did not finish within the deadline of the endpoint")
+
+
+@lru_cache(maxsize=None)
+def retryable_errors():
+    """
+    The exception classes are imported on first use, like google.cloud.bigquery (see bigQueryClient).
+
+    :return: The exception classes of the errors worth retrying.
+    """
+    import requests
+    from google.api_core import exceptions as google_exceptions
+    return (
+        google_exceptions.TooManyRequests,
+        google_exceptions.InternalServerError,
+        google_exceptions.BadGateway,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.GatewayTimeout,
+        requests.exceptions.ConnectionError,
+        ConnectionError,
+    )
+
+
+@lru_cache(maxsize=None)
+def timeout_errors():
+    """
+    :return: The exception classes raised when waiting on BigQuery times out.
+    """
+    import requests
+    return TimeoutError, requests.exceptions.Timeout
+
+
+def is_retryable(error):
+    """
+    :param error: An exception raised by a query.
+    :return: Whether running the query again may succeed.
+    """
+    from google.api_core import exceptions as google_exceptions
+
+    if isinstance(error, retryable_errors()):
+        return True
+    if isinstance(error, google_exceptions.GoogleAPICallError):
+        # Job failures carry the reason of the error, such as backendError on a 400 or rateLimitExceeded on a 403
+        errors = getattr(error, 'errors', None) or []
+        return bool(errors) and isinstance(errors[0], dict) and errors[0].get('reason') in RETRYABLE_REASONS
+    return False
+
+
+def is_upstream_failure(error):
+    """
+    :param error: An exception raised by a query.
+    :return: Whether it shows BigQuery is failing or slow, which the circuit breaker counts.
+    """
+    return is_retryable(error) or isinstance(error, timeout_errors())
+
+
+def retry_delay(attempt, resilience_settings=None):
+    """
+    :param attempt: The number of the retry, from 0.
+    :param resilience_settings: The resilience settings, read from settings.BIGQUERY_RESILIENCE by default.
+    :return: A random delay between 0 and the exponential backoff of the attempt, in seconds.
+    """
+    resilience_settings = resilience_settings or get_resilience_settings()
+    backoff = min(resilience_settings['RETRY_BASE_DELAY'] * 2 ** attempt, resilience_settings['RETRY_MAX_DELAY'])
+    return random.uniform(0, backoff)
+
+
+class CircuitBreaker:
+    """
+    Fails the queries at once while BigQuery keeps failing, and lets one trial query through from time to time.
+    """
+
+    def __init__(self, failure_threshold=None, reset_timeout=None):
+        """
+        :param failure_threshold: The number of consecutive failures that opens the breaker.
+        :param reset_timeout: The number of seconds the breaker stays open before a trial query.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._state = CLOSED
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def get_failure_threshold(self):
+        if self.failure_threshold is not None:
+            return self.failure_threshold
+        return get_resilience_settings()['BREAKER_FAILURES']
+
+    def get_reset_timeout(self):
+        if self.reset_timeout is not None:
+            return self.reset_timeout
+        return get_resilience_settings()['BREAKER_RESET']
+
+    def _set_state(self, state):
+        if state != self._state:
+            self._state = state
+            breaker_transitions.inc(state=state)
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.get_reset_timeout():
+            self._set_state(HALF_OPEN)
+        return self._state
+
+    def before_call(self):
+        """
+        Check that a query may run.
+
+        :raises CircuitOpen: If the breaker is open, or half open with its trial query already running.
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+            elapsed = time.monotonic() - self._opened_at
+            raise CircuitOpen(max(self.get_reset_timeout() - elapsed, 1))
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial_running = False
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self._state == HALF_OPEN or self.failures >= self.get_failure_threshold():
+                self._opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def record(self, error):
+        """
+        Record the outcome of a query that raised an exception. Errors that do not come from an
+        unavailable BigQuery, such as invalid queries, show it is answering.
+
+        :param error: The exception.
+        """
+        if is_upstream_failure(error):
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def abandon(self):
+        """
+        Forget a query whose outcome is unknown, such as a cancelled one.
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def reset(self):
+        with self._lock:
+            self.failures = 0
+            self._trial_running = False
+            self._set_state(CLOSED)
+
+    def to_dict(self):
+        """
+        :return: The state of the breaker as a JSON-serializable dictionary.
+        """
+        return {'state': self.state, 'consecutive_failures': self.failures}
+
+
+# Breaker shared by every query of the process
+bigquery_breaker = CircuitBreaker()
+
+
+def call_with_retries(fn, breaker=None):
+    """
+    Run a query through the circuit breaker, retrying it on retryable errors within the deadline.
+
+    :param fn: A callable without arguments that runs the query.
+    :param breaker: The CircuitBreaker, the shared one by default.
+    :return: The result of fn.
+    :raises CircuitOpen: If the breaker is open.
+    :raises DeadlineExceeded: If the deadline passed.
+    """
+    breaker = breaker or bigquery_breaker
+    resilience_settings = get_resilience_settings()
+    attempt = 0
+    while True:
+        check_deadline()
+        breaker.before_call()
+        try:
+            result = fn()
+        except Exception as e:
+            breaker.record(e)
+            delay = retry_delay(attempt, resilience_settings)
+            if not should_retry(e, attempt, delay, resilience_settings):
+                raise
+        else:
+            breaker.record_success()
+            return result
+        time.sleep(delay)
+        attempt += 1
+
+
+async def async_call_with_retries(fn, breaker=None):
+    """
+    Async counterpart of call_with_retries.
+
+    :param fn: A callable without arguments that returns an awaitable running the query.
+    :param breaker: The CircuitBreaker, the shared one by default.
+    :return: The result of the awaitable.
+    """
+    breaker = breaker or bigquery_breaker
+    resilience_settings = get_resilience_settings()
+    attempt = 0
+    while True:
+        check_deadline()
+        breaker.before_call()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            # The outcome is unknown, let a later query be the trial of a half open breaker
+            breaker.abandon()
+            raise
+        except Exception as e:
+            breaker.record(e)
+            delay = retry_delay(attempt, resilience_settings)
+            if not should_retry(e, attempt, delay, resilience_settings):
+                raise
+        else:
+            breaker.record_success()
+            return result
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+def should_retry(error, attempt, delay, resilience_settings):
+    """
+    :param error: The exception raised by the query.
+    :param attempt: The number of retries already done.
+    :param delay: The delay before the next retry.
+    :param resilience_settings: The resilience settings.
+    :return: Whether to run the query again after the delay, which is counted if so.
+    """
+    if isinstance(error, DeadlineExceeded) or not is_retryable(error):
+        return False
+    if attempt >= resilience_settings['RETRIES']:
+        return False
+    remaining = remaining_time()
+    if remaining is not None and delay >= remaining:
+        return False
+    bigquery_retries.inc(error=type(error).__name__)
+    record_timing('bq-retry', delay)
+    return True
+
+
+def cancel_job(query_job, reason):
+    """
+    Cancel a job whose results nobody will read. Failures are ignored, the job then runs to completion.
+
+    :param query_job: The BigQuery query job.
+    :param reason: Why the job is cancelled, 'deadline' or 'abandoned'.
+    """
+    cancel = getattr(query_job, 'cancel', None)
+    if cancel is None:
+        return
+    try:
+        cancel()
+    except Exception:
+        return
+    bigquery_cancelled_jobs.inc(reason=reason)
+
+
+def job_result(query_job, **kwargs):
+    """
+    Wait for the results of a job until the deadline, cancelling the job if it passes.
+
+    :param query_job: The BigQuery query job.
+    :param kwargs: The other arguments of QueryJob.result, such as page_size.
+    :return: The RowIterator of the results.
+    :raises DeadlineExceeded: If the job did not finish within the deadline.
+    """
+    timeout = remaining_time()
+    if timeout is None:
+        return query_job.result(**kwargs)
+    try:
+        if timeout == 0:
+            raise TimeoutError()
+        return query_job.result(timeout=timeout, **kwargs)
+    except timeout_errors():
+        cancel_job(query_job, 'deadline')
+        raise DeadlineExceeded("The query did not finish within the deadline of the endpoint")
+
+
+def stale_key(query, query_params):
+    """
+    :return: The key of the last good results of a query, the same across refreshes of its table.
+    """
+    return make_cache_key(query, query_params) + ':stale'
+
+
+def store_last_good(cache, query, query_params, rows):
+    """
+    Keep the rows of a query to serve them while the query fails.
+
+    :param cache: The result cache.
+    :param query: The query.
+    :param query_params: The parameters of the query.
+    :param rows: Its rows.
+    """
+    cache.set(stale_key(query, query_params), rows, get_resilience_settings()['STALE_TIMEOUT'])
+
+
+def get_last_good(cache, query, query_params):
+    """
+    :return: The last rows stored for a query, or None.
+    """
+    return cache.get(stale_key(query, query_params))
+
+
+def mark_stale(response):
+    """
+    Mark a response built from stale results, so that clients can tell and caches do not keep it.
+
+    :param response: The HTTP response.
+    :return: The response.
+    """
+    stale_responses.inc()
+    response[STALE_HEADER] = 'true'
+    response['Warning'] = '110 - "Response is Stale"'
+    patch_cache_control(response, no_cache=True, max_age=0)
+    return response
@@ -0,0 +1,90 @@
+"""
+Full-text search over the saved queries.
+
+Every query keeps a precomputed tsvector of its name, description, query URL
+and the text of its comments, indexed with a GIN index, so a search is a single
+index lookup instead of a LIKE scan of every text column. The vector is weighted
+so that matches in the name rank above matches in the comments. It is updated
+whenever a query or one of its comments is saved or deleted.
+"""
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db.models import F, FloatField, Func, OuterRef, Subquery, TextField, Value
+from django.db.models.functions import Cast, Coalesce
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import Comment, Query
+
+
+def get_search_config():
+    """
+    Get the text search configuration used to build the vectors and the search queries.
+
+    :return: settings.SEARCH_CONFIG, 'simple' by default.
+    """
+    return getattr(settings, 'SEARCH_CONFIG', 'simple')
+
+
+def search_vector_expression():
+    """
+    Build the expression that computes the search vector of a query.
+
+    :return: A SearchVector expression to use in an update of the queries.
+    """
+    config = get_search_config()
+    # All the comments of the query joined into one text
+    comments = Comment.objects.filter(query=OuterRef('pk')).values('query').annotate(
+        text=StringAgg('comment_text', delimiter=' '),
+    ).values('text')
+    # Split the query URL into words, /api/bigquery/get/top_terms_day/Colombia -> api bigquery get top terms day Colombia
+    query_words = Func(F('query'), Value('/_'), Value('  '), function='translate', output_field=TextField())
+    return (
+        SearchVector('name', weight='A', config=config)
+        + SearchVector('query_comment', weight='B', config=config)
+        + SearchVector(query_words, weight='C', config=config)
+        + SearchVector(Coalesce(Subquery(comments), Value(''), output_field=TextField()), weight='D', config=config)
+    )
+
+
+def update_search_vectors(query_ids):
+    """
+    Compute again the search vector of some queries.
+    The update does not send signals, so it does not trigger itself.
+
+    :param query_ids: The ids of the queries.
+    """
+    Query.objects.filter(id__in=query_ids).update(search_vector=search_vector_expression())
+
+
+def search_queries(text):
+    """
+    Get the queries that match a search, best matches first.
+
+    :param text: The search, in web search syntax ("quoted phrases", or, -excluded words).
+    :return: A queryset of the matching queries annotated with their rank, ordered by rank and id.
+    """
+    search_query = SearchQuery(text, search_type='websearch', config=get_search_config())
+    return Query.objects.filter(search_vector=search_query).annotate(
+        # Rank as a double precision number so that it can be compared exactly with a cursor
+        rank=Cast(SearchRank(F('search_vector'), search_query), FloatField()),
+    ).order_by('-rank', '-id')
+
+
+@receiver(post_save, sender=Query)
+def query_saved(sender, instance, raw=False, **kwargs):
+    """
+    Update the search vector of a query when it is saved.
+    """
+    if not raw:
+        update_search_vectors([instance.id])
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def comment_changed(sender, instance, raw=False, **kwargs):
+    """
+    Update the search vector of the query of a comment when the comment is saved or deleted.
+    """
+    if not raw:
+        update_search_vectors([instance.query_id])
@@ -0,0 +1,260 @@
+"""
+Declared shapes of the BigQuery endpoint queries.
+
+A QueryShape declares what the query of an endpoint reads: the table, the
+columns it selects, the filters the parameters of the request fill in and the
+order of the rows. The SQL is generated once from the declaration, and each
+request only converts its values into typed query parameters:
+
+- Dates are sent as DATE parameters and compared with refresh_date, the
+  partitioning column of the tables, as they are, so BigQuery only scans the
+  partitions of the requested days. Invalid dates are rejected before any query
+  runs, instead of failing on BigQuery.
+- The tables have one row per region for every country, day and term, so shapes
+  that read them declare distinct=True and select DISTINCT rows. Nothing is
+  aggregated or grouped.
+
+Shapes are registered by name. BigQueryShapeView (in bigQueryQueries) answers
+an endpoint from the shape it points to, with the HTTP caching, the result
+cache, the cost guardrails and the per-shape metrics of this module, so a new
+endpoint is a shape declaration and a view class with a single attribute.
+"""
+from datetime import date
+from .bigQueryClient import bigquery
+from .queryCost import ESTIMATE_HEADER
+from .queryMetrics import BYTE_BUCKETS, Counter, Histogram, registry
+
+# What answered the requests of a shape: its query (from the result cache or BigQuery),
+# or something else such as the local mirror or the rollups
+QUERY = 'query'
+OTHER = 'other'
+
+shape_requests = registry.register(Counter(
+    'bigquery_shape_requests', 'Requests of the declared query shapes, by shape and by what answered them.',
+    ['shape', 'source'],
+))
+shape_estimated_bytes = registry.register(Histogram(
+    'bigquery_shape_estimated_bytes', 'Bytes the dry runs estimate the queries of each shape scan.',
+    ['shape'], buckets=BYTE_BUCKETS,
+))
+
+
+def to_parameter_value(param_type, value):
+    """
+    Convert a value received from the API to the type of a query parameter.
+
+    :param param_type: The BigQuery type of the parameter: 'STRING', 'DATE' or 'INT64'.
+    :param value: The value, usually a string.
+    :return: The converted value.
+    :raises ValueError: If the value is not valid for the type.
+    """
+    if param_type == 'DATE':
+        if isinstance(value, date):
+            return value
+        try:
+            return date.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid date: {value}")
+    if param_type == 'INT64':
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid integer: {value}")
+    if value is None:
+        raise ValueError("Missing value")
+    return str(value)
+
+
+class Filter:
+    """
+    A condition of the WHERE clause of a shape, filled in with named parameters.
+    """
+    # The SQL of the condition, formatted with the column and the parameter names
+    template = None
+
+    def __init__(self, column, *params, param_type='STRING'):
+        """
+        :param column: The column the condition is on.
+        :param params: The names of its parameters, which are also the names of the request values.
+        :param param_type: The BigQuery type of the parameters.
+        """
+        self.column = column
+        self.params = params
+        self.param_type = param_type
+
+    def sql(self):
+        """
+        :return: The SQL of the condition.
+        """
+        return self.template.format(self.column, *self.params)
+
+    def query_parameters(self, values):
+        """
+        :param values: The values of the request, by parameter name.
+        :return: The query parameters of the condition.
+        :raises ValueError: If a value is missing or invalid.
+        """
+        return [
+            bigquery.ScalarQueryParameter(name, self.param_type, to_parameter_value(self.param_type, values.get(name)))
+            for name in self.params
+        ]
+
+
+class Equals(Filter):
+    """
+    The column equals a parameter.
+    """
+    template = "{0} = @{1}"
+
+
+class Between(Filter):
+    """
+    The column is between two parameters, both included.
+    """
+    template = "{0} BETWEEN @{1} AND @{2}"
+
+
+class InList(Filter):
+    """
+    The column is one of the values of an array parameter.
+    """
+    template = "{0} IN UNNEST(@{1})"
+
+    def query_parameters(self, values):
+        name, = self.params
+        items = values.get(name)
+        if not items:
+            raise ValueError(f"Missing value: {name}")
+        return [bigquery.ArrayQueryParameter(
+            name, self.param_type, [to_parameter_value(self.param_type, item) for item in items],
+        )]
+
+
+class Constant(Filter):
+    """
+    The column equals a value fixed by the shape, written in the SQL.
+    """
+
+    def __init__(self, column, value):
+        """
+        :param column: The column the condition is on.
+        :param value: An integer, the same for every request.
+        """
+        super().__init__(column)
+        self.value = int(value)
+
+    def sql(self):
+        return f"{self.column} = {self.value}"
+
+    def query_parameters(self, values):
+        return []
+
+
+class QueryShape:
+    """
+    The declared query of an endpoint, from which its SQL and query parameters are built.
+    """
+
+    def __init__(self, name, table, columns, filters, order_by=(), distinct=False):
+        """
+        :param name: The name of the shape, unique, used in the metrics.
+        :param table: The fully qualified table it reads from.
+        :param columns: The selected columns, as column names or (column, output name) pairs.
+        :param filters: The Filters of the WHERE clause, all of which the rows match.
+        :param order_by: The ORDER BY terms, such as 'rank ASC'.
+        :param distinct: Whether to return the distinct rows, for tables that repeat them.
+        """
+        self.name = name
+        self.table = table
+        self.columns = [column if isinstance(column, str) else f"{column[0]} AS {column[1]}" for column in columns]
+        self.filters = list(filters)
+        self.order_by = list(order_by)
+        self.distinct = distinct
+        self.sql = self.build_sql()
+
+    @property
+    def params(self):
+        """
+        :return: The names of the parameters of the shape.
+        """
+        return [name for query_filter in self.filters for name in query_filter.params]
+
+    def build_sql(self):
+        """
+        :return: The SQL of the shape, with a named parameter for each request value.
+        """
+        select = "SELECT DISTINCT" if self.distinct else "SELECT"
+        columns = ",\n                ".join(self.columns)
+        conditions = "\n                AND\n                ".join(query_filter.sql() for query_filter in self.filters)
+        query = f"""
+            {select}
+                {columns}
+             FROM `{self.table}`"""
+        if conditions:
+            query += f"""
+            WHERE
+                {conditions}"""
+        if self.order_by:
+            query += f"""
+            ORDER BY {", ".join(self.order_by)}"""
+        return query + "\n        "
+
+    def build(self, **values):
+        """
+        Build the query of a request.
+
+        :param values: The values of the request, by parameter name, such as the arguments of its URL.
+        :return: The query and its parameters.
+        :raises ValueError: If a value is missing or invalid.
+        """
+        query_params = []
+        for query_filter in self.filters:
+            query_params += query_filter.query_parameters(values)
+        return self.sql, query_params
+
+    def observe(self, source, estimated_bytes=None):
+        """
+        Record a request of the shape.
+
+        :param source: QUERY if it was answered by the query of the shape, OTHER otherwise.
+        :param estimated_bytes: The bytes the dry run of its query estimated, if any.
+        """
+        shape_requests.inc(shape=self.name, source=source)
+        if estimated_bytes is not None:
+            shape_estimated_bytes.observe(estimated_bytes, shape=self.name)
+
+    def observe_response(self, response):
+        """
+        Record a request of the shape answered by its query.
+
+        :param response: The response of the query, with the estimated bytes in its ESTIMATE_HEADER if any.
+        """
+        estimated_bytes = response.get(ESTIMATE_HEADER)
+        self.observe(QUERY, int(estimated_bytes) if estimated_bytes is not None else None)
+
+
+# The declared shapes, by name
+shapes = {}
+
+
+def register(shape):
+    """
+    Add a shape to the registry.
+
+    :param shape: The QueryShape.
+    :return: The shape.
+    :raises ValueError: If another shape has the same name.
+    """
+    if shapes.get(shape.name, shape) is not shape:
+        raise ValueError(f"A query shape is already registered as {shape.name}")
+    shapes[shape.name] = shape
+    return shape
+
+
+def get_shape(name):
+    """
+    :param name: The name of a registered shape.
+    :return: The QueryShape.
+    :raises KeyError: If no shape has this name.
+    """
+    return shapes[name]
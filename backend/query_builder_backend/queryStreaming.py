@@ -0,0 +1,139 @@
+"""
+Streaming responses for the BigQuery endpoints.
+
+Rows are encoded and sent as they are read from the query results, page by
+page, instead of building the whole result in memory first. Two formats are
+supported: a JSON array (the same body as the regular responses) and NDJSON,
+one JSON object per line.
+
+The status of a streamed response is sent before all its rows are read, so an
+error while reading them cannot change it. It is reported in the body instead,
+in a way no row can be mistaken for:
+
+- A JSON array is cut short without its closing bracket, so the body is not
+  valid JSON.
+- NDJSON ends with a trailer line that is a JSON array instead of an object,
+  ["error", "<message>"]. Every row is an object.
+"""
+from itertools import chain
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from .fastJson import JsonResponse, dumps
+
+# Content type of each streaming format
+STREAM_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Rows encoded together into one chunk of the response
+CHUNK_ROWS = 500
+
+
+def get_stream_page_size():
+    """
+    Get the number of rows requested from BigQuery per page when streaming.
+
+    :return: The page size from settings.BIGQUERY_STREAM_PAGE_SIZE.
+    """
+    return getattr(settings, 'BIGQUERY_STREAM_PAGE_SIZE', 10000)
+
+
+def get_stream_format(request):
+    """
+    Get the streaming format requested, from the stream query parameter or the Accept header.
+
+    :param request: The HTTP request object.
+    :return: 'json', 'ndjson', None if no streaming was requested, or the unknown requested value.
+    """
+    if request is None:
+        return None
+    stream_format = request.GET.get('stream')
+    if stream_format is None and STREAM_FORMATS['ndjson'] in request.headers.get('Accept', ''):
+        stream_format = 'ndjson'
+    return stream_format
+
+
+def error_trailer(error):
+    """
+    :param error: The exception that ended an NDJSON stream.
+    :return: The last line of the stream, a list so that it is not taken for a row.
+    """
+    return ["error", str(error)]
+
+
+def encode_json_array(rows):
+    """
+    Encode rows as the chunks of a JSON array, left unclosed if reading the rows fails.
+
+    :param rows: An iterable of dictionaries.
+    :return: A generator of bytes.
+    """
+    yield b"["
+    separator = b""
+    chunk = []
+    error = None
+    try:
+        for row in rows:
+            chunk.append(dumps(row))
+            if len(chunk) == CHUNK_ROWS:
+                yield separator + b",".join(chunk)
+                separator, chunk = b",", []
+    except Exception as e:
+        error = e
+    if chunk:
+        yield separator + b",".join(chunk)
+    # The status is already sent, leave the array unclosed on errors so that the body is not valid JSON
+    if error is None:
+        yield b"]"
+
+
+def encode_ndjson(rows):
+    """
+    Encode rows as NDJSON chunks, one JSON object per line, and an error trailer if reading the rows fails.
+
+    :param rows: An iterable of dictionaries.
+    :return: A generator of bytes.
+    """
+    chunk = []
+    error = None
+    try:
+        for row in rows:
+            chunk.append(dumps(row) + b"\n")
+            if len(chunk) == CHUNK_ROWS:
+                yield b"".join(chunk)
+                chunk = []
+    except Exception as e:
+        error = e
+    if chunk:
+        yield b"".join(chunk)
+    # The status is already sent, report the error in a trailer line that is not an object
+    if error is not None:
+        yield dumps(error_trailer(error)) + b"\n"
+
+
+# Encoder of each streaming format
+STREAM_ENCODERS = {
+    'json': encode_json_array,
+    'ndjson': encode_ndjson,
+}
+
+
+def streaming_rows_response(rows, stream_format):
+    """
+    Build a streaming response for the rows of a query.
+
+    :param rows: An iterable of dictionaries, read lazily.
+    :param stream_format: 'json' or 'ndjson'.
+    :return: A StreamingHttpResponse, or a 404 response if there are no rows.
+    """
+    rows = iter(rows)
+    # Read the first row to answer 404 before anything is sent
+    first_row = next(rows, None)
+    if first_row is None:
+        return JsonResponse({"error": "No data found"}, status=404)
+
+    return StreamingHttpResponse(
+        STREAM_ENCODERS[stream_format](chain([first_row], rows)),
+        content_type=STREAM_FORMATS[stream_format],
+    )
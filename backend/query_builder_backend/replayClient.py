@@ -0,0 +1,307 @@
+"""
+Offline stand-in for the BigQuery client.
+
+ReplayClient answers every query without the network: with the rows recorded
+for that query and its parameters when there are some, and otherwise with
+synthetic rows shaped like the ones each endpoint reads (25 terms per country
+and day, one term per day for the ranges, the partition metadata, ...). Each
+job takes a configurable latency, with optional jitter, to finish, so that it
+behaves like a remote job: the async endpoints poll it and blocking calls wait
+for it.
+
+Recordings are JSON files written by RecordingClient, which wraps the real
+client and keeps the rows of every query it runs. They let benchmarks replay
+real row sets without credentials.
+
+Set BIGQUERY_CLIENT['FACTORY'] to a function returning a ReplayClient to serve
+every endpoint with it.
+"""
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from django.core.serializers.json import DjangoJSONEncoder
+from .queryCache import make_cache_key
+
+# Countries and history of the synthetic tables
+DEFAULT_COUNTRIES = ['Argentina', 'Brazil', 'Chile', 'Colombia', 'Mexico', 'Peru', 'Spain', 'United States']
+DEFAULT_WATERMARK = date(2023, 11, 20)
+DEFAULT_HISTORY_DAYS = 365
+TERMS_PER_DAY = 25
+
+date_re = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def to_date(value):
+    """
+    :param value: A date, or an ISO formatted date string.
+    :return: The date, or None if the value is not a date.
+    """
+    if isinstance(value, date):
+        return value
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def query_parameters(job_config):
+    """
+    :param job_config: The QueryJobConfig of a query, or None.
+    :return: The values of its parameters, by name.
+    """
+    params = getattr(job_config, 'query_parameters', None) or []
+    return {param.name: getattr(param, 'values', getattr(param, 'value', None)) for param in params}
+
+
+def days_between(first, last):
+    """
+    :return: The days from first to last, both included.
+    """
+    return [first + timedelta(days=offset) for offset in range((last - first).days + 1)]
+
+
+def term(day, rank):
+    """
+    :return: The synthetic term at a rank on a day. Terms stay around for a few days, like real ones.
+    """
+    return f"term {(day.toordinal() // 3 + rank) % 200}"
+
+
+class ReplayRows(list):
+    """
+    The rows of a replayed job, with the parts of the RowIterator interface the endpoints use.
+    """
+
+    @property
+    def total_rows(self):
+        return len(self)
+
+    @property
+    def pages(self):
+        # A single page with every row
+        return iter([list(self)])
+
+    def to_arrow(self, *args, **kwargs):
+        import pyarrow
+        return pyarrow.Table.from_pylist(list(self))
+
+
+class ReplayJob:
+    """
+    A replayed query job, done once its latency has elapsed.
+    """
+
+    def __init__(self, rows, latency, total_bytes_processed):
+        """
+        :param rows: The rows of the job.
+        :param latency: The number of seconds the job takes to finish.
+        :param total_bytes_processed: The bytes the job reports to have processed and billed.
+        """
+        self.rows = rows
+        self.job_id = f"replay_{uuid.uuid4().hex}"
+        self.total_bytes_processed = total_bytes_processed
+        self.total_bytes_billed = total_bytes_processed
+        self.cache_hit = False
+        self.cancelled = False
+        self.created = self.started = datetime.now(timezone.utc)
+        self.ended = self.started + timedelta(seconds=latency)
+        self._ready_at = time.monotonic() + latency
+
+    def done(self, *args, **kwargs):
+        return time.monotonic() >= self._ready_at
+
+    def result(self, *args, timeout=None, **kwargs):
+        # Wait for the job like the real client does
+        remaining = self._ready_at - time.monotonic()
+        if timeout is not None and remaining > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("The replayed job did not finish within the timeout")
+        if remaining > 0:
+            time.sleep(remaining)
+        return ReplayRows(self.rows)
+
+    def cancel(self):
+        self.cancelled = True
+        return True
+
+
+class ReplayClient:
+    """
+    Answers the queries of the endpoints with recorded or synthetic rows after a latency.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, recordings=None, countries=None,
+                 watermark=DEFAULT_WATERMARK, history_days=DEFAULT_HISTORY_DAYS, bytes_processed=10 * 1024 * 1024,
+                 seed=None):
+        """
+        :param latency: The number of seconds every job takes to finish.
+        :param jitter: A random number of seconds, up to this one, added to the latency of each job.
+        :param recordings: The recorded rows, by recording key (see load_recordings).
+        :param countries: The countries of the synthetic tables.
+        :param watermark: The last refresh date of the synthetic tables.
+        :param history_days: The number of days of the synthetic tables.
+        :param bytes_processed: The bytes every job and dry run reports.
+        :param seed: The seed of the jitter, for repeatable runs.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.recordings = recordings or {}
+        self.countries = countries or DEFAULT_COUNTRIES
+        self.watermark = watermark
+        self.history_days = history_days
+        self.bytes_processed = bytes_processed
+        self.project = 'replay'
+        self.queries = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def query(self, query, job_config=None, **kwargs):
+        """
+        Start a replayed job.
+
+        :param query: The SQL query.
+        :param job_config: The QueryJobConfig, with the parameters of the query.
+        :return: A ReplayJob.
+        """
+        if job_config is not None and getattr(job_config, 'dry_run', False):
+            # Dry runs are answered at once
+            return ReplayJob([], 0, self.bytes_processed)
+        with self._lock:
+            self.queries += 1
+            latency = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        params = getattr(job_config, 'query_parameters', None) or []
+        rows = self.recordings.get(make_cache_key(query, params))
+        if rows is None:
+            rows = self.synthetic_rows(query, query_parameters(job_config))
+        return ReplayJob(rows, latency, self.bytes_processed)
+
+    def synthetic_rows(self, query, params):
+        """
+        Build rows shaped like the ones a query reads.
+
+        :param query: The SQL query.
+        :param params: The values of its parameters, by name.
+        :return: A list of dictionaries.
+        """
+        rising = 'rising' in query
+        first_day = self.watermark - timedelta(days=self.history_days - 1)
+
+        if 'INFORMATION_SCHEMA.PARTITIONS' in query:
+            return [{
+                'min_refresh_date': first_day.strftime('%Y%m%d'),
+                'max_refresh_date': self.watermark.strftime('%Y%m%d'),
+            }]
+        if 'DISTINCT country_name' in query:
+            return [{'country_name': country} for country in self.countries]
+
+        init_date, finish_date = to_date(params.get('init_date')), to_date(params.get('finish_date'))
+        if init_date is not None and finish_date is not None:
+            days = days_between(max(init_date, first_day), min(finish_date, self.watermark))
+        else:
+            dates = params.get('dates') or [params.get('date')]
+            days = [day for day in map(to_date, dates) if day is not None and first_day <= day <= self.watermark]
+
+        if 'MIN(rank) AS rank' in query:
+            # The rows of the analytics
+            return [
+                {'country_name': country, 'Day': day, 'term': term(day, rank), 'rank': rank}
+                for country, day, rank in itertools.product(
+                    params.get('countries') or [], days, range(1, TERMS_PER_DAY + 1),
+                )
+            ]
+        if 'IN UNNEST(@countries)' in query:
+            # The rows of the batch endpoints
+            return [
+                {'country_name': country, 'Day': day, 'Top_Term': term(day, rank), 'rank': rank,
+                 **({'percent_gain': 100 * (TERMS_PER_DAY - rank + 1)} if rising else {})}
+                for country, day, rank in itertools.product(
+                    params.get('countries') or [], days, range(1, TERMS_PER_DAY + 1),
+                )
+            ]
+        if 'DATE_TRUNC' in query:
+            # The rows of a weekly summary
+            return [
+                {'Period': day, 'Top_Term': term(day, 1), 'days_at_rank_1': 7, 'days_present': 7,
+                 'best_rank': 1, 'mean_rank': 1.0, **({'max_percent_gain': 2500} if rising else {})}
+                for day in reversed(days) if day.weekday() == 0
+            ]
+        if init_date is not None and finish_date is not None:
+            # The term at rank 1 of each day of a range
+            return [
+                {'Day': day, 'Top_Term': term(day, 1), **({'percent_gain': 2500} if rising else {})}
+                for day in reversed(days)
+            ]
+        # The terms of a day
+        return [
+            {'Top_Term': term(day, rank), 'rank': rank,
+             **({'percent_gain': 100 * (TERMS_PER_DAY - rank + 1)} if rising else {})}
+            for day in days for rank in range(1, TERMS_PER_DAY + 1)
+        ]
+
+
+class RecordingClient:
+    """
+    Wraps a BigQuery client and keeps the rows of every query it runs, to be replayed later.
+    """
+
+    def __init__(self, client):
+        """
+        :param client: The BigQuery client to record.
+        """
+        self.client = client
+        self.recordings = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def query(self, query, job_config=None, **kwargs):
+        query_job = self.client.query(query, job_config=job_config, **kwargs)
+        if job_config is not None and getattr(job_config, 'dry_run', False):
+            return query_job
+        key = make_cache_key(query, getattr(job_config, 'query_parameters', None) or [])
+        recordings, lock = self.recordings, self._lock
+
+        class RecordedJob:
+            def __getattr__(self, name):
+                return getattr(query_job, name)
+
+            def result(self, *args, **kwargs):
+                rows = ReplayRows(dict(row.items()) for row in query_job.result(*args, **kwargs))
+                with lock:
+                    recordings[key] = list(rows)
+                return rows
+
+        return RecordedJob()
+
+
+def save_recordings(recordings, path):
+    """
+    Write recorded rows to a JSON file.
+
+    :param recordings: The rows, by recording key.
+    :param path: The path of the file.
+    """
+    with open(path, 'w') as file:
+        json.dump({'recordings': recordings}, file, cls=DjangoJSONEncoder)
+
+
+def load_recordings(path):
+    """
+    Read the recorded rows of a JSON file, turning the ISO dates back into dates.
+
+    :param path: The path of the file written by save_recordings.
+    :return: The rows, by recording key.
+    """
+    def parse_dates(row):
+        return {key: to_date(value) if isinstance(value, str) and date_re.match(value) else value
+                for key, value in row.items()}
+
+    with open(path) as file:
+        data = json.load(file, object_hook=parse_dates)
+    return data['recordings']
@@ -0,0 +1,207 @@
+"""
+Negotiated compression of the API responses.
+
+Responses are compressed with brotli or gzip, whichever the client accepts
+(brotli first, since it makes smaller JSON), when they are large enough for it
+to pay off. Streamed responses are compressed chunk by chunk and flushed after
+every chunk, so the client still receives the rows as they are read.
+
+Responses that are already encoded, such as the gzip snapshots of the saved
+queries, are left untouched. The ETag of a compressed response is made weak,
+since it was computed on the uncompressed body.
+
+brotli is optional: without it the responses are only compressed with gzip.
+"""
+import re
+import zlib
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+# Default configuration of the compression, overridable with settings.RESPONSE_COMPRESSION
+DEFAULT_COMPRESSION_SETTINGS = {
+    'MIN_SIZE': 200,
+    'GZIP_LEVEL': 6,
+    'BROTLI_QUALITY': 5,
+}
+
+# Encodings in order of preference
+ENCODINGS = ('br', 'gzip')
+
+# An item of the Accept-Encoding header, with its optional quality
+accept_encoding_re = re.compile(r'^\s*([^\s;]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*$')
+
+
+def get_compression_settings():
+    """
+    Get the compression settings merged over the defaults.
+
+    :return: A dictionary with the compression settings.
+    """
+    return {**DEFAULT_COMPRESSION_SETTINGS, **getattr(settings, 'RESPONSE_COMPRESSION', {})}
+
+
+def import_brotli():
+    """
+    Import brotli, which is optional.
+
+    :return: The brotli module, or None if it is not installed.
+    """
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def available_encodings():
+    """
+    :return: The encodings the server can produce, in order of preference.
+    """
+    return [encoding for encoding in ENCODINGS if encoding != 'br' or import_brotli() is not None]
+
+
+def choose_encoding(accept_encoding, encodings=None):
+    """
+    Pick the encoding of a response from the Accept-Encoding header of its request.
+
+    :param accept_encoding: The value of the Accept-Encoding header.
+    :param encodings: The encodings to pick from, in order of preference, all the available ones by default.
+    :return: 'br', 'gzip', or None if the client accepts none of the encodings.
+    """
+    accepted = {}
+    for item in accept_encoding.split(','):
+        match = accept_encoding_re.match(item)
+        if match is None:
+            continue
+        coding, quality = match.groups()
+        try:
+            accepted[coding.lower()] = float(quality) if quality is not None else 1.0
+        except ValueError:
+            continue
+    candidates = [
+        encoding for encoding in (available_encodings() if encodings is None else encodings)
+        if accepted.get(encoding, accepted.get('*', 0)) > 0
+    ]
+    if not candidates:
+        return None
+    # The preferred encoding among those with the highest quality
+    best = max(accepted.get(encoding, accepted.get('*', 0)) for encoding in candidates)
+    return next(encoding for encoding in candidates if accepted.get(encoding, accepted.get('*', 0)) == best)
+
+
+def compressor(encoding):
+    """
+    Create a compressor for an encoding.
+
+    :param encoding: 'br' or 'gzip'.
+    :return: A function that compresses a chunk and flushes it, and a function that ends the stream.
+    """
+    compression_settings = get_compression_settings()
+    if encoding == 'br':
+        brotli = import_brotli()
+        brotli_compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=compression_settings['BROTLI_QUALITY'])
+        return (lambda chunk: brotli_compressor.process(chunk) + brotli_compressor.flush(),
+                brotli_compressor.finish)
+    # wbits 31 writes the gzip header and trailer
+    gzip_compressor = zlib.compressobj(compression_settings['GZIP_LEVEL'], zlib.DEFLATED, 31)
+    return (lambda chunk: gzip_compressor.compress(chunk) + gzip_compressor.flush(zlib.Z_SYNC_FLUSH),
+            gzip_compressor.flush)
+
+
+def compress(content, encoding):
+    """
+    :param content: The body of a response.
+    :param encoding: 'br' or 'gzip'.
+    :return: The compressed body.
+    """
+    compression_settings = get_compression_settings()
+    if encoding == 'br':
+        brotli = import_brotli()
+        return brotli.compress(content, mode=brotli.MODE_TEXT, quality=compression_settings['BROTLI_QUALITY'])
+    gzip_compressor = zlib.compressobj(compression_settings['GZIP_LEVEL'], zlib.DEFLATED, 31)
+    return gzip_compressor.compress(content) + gzip_compressor.flush()
+
+
+def compress_stream(chunks, encoding):
+    """
+    :param chunks: An iterator of the chunks of a streamed body.
+    :param encoding: 'br' or 'gzip'.
+    :return: An iterator of the compressed chunks, each one flushed.
+    """
+    process, finish = compressor(encoding)
+    for chunk in chunks:
+        compressed = process(chunk)
+        if compressed:
+            yield compressed
+    yield finish()
+
+
+async def compress_async_stream(chunks, encoding):
+    """
+    :param chunks: An async iterator of the chunks of a streamed body.
+    :param encoding: 'br' or 'gzip'.
+    :return: An async iterator of the compressed chunks, each one flushed.
+    """
+    process, finish = compressor(encoding)
+    async for chunk in chunks:
+        compressed = process(chunk)
+        if compressed:
+            yield compressed
+    yield finish()
+
+
+def weaken_etag(response):
+    """
+    Make the ETag of a response weak, since the compressed body is not the one it was computed on.
+
+    :param response: The HTTP response.
+    """
+    etag = response.get('ETag')
+    if etag is not None and etag.startswith('"'):
+        response['ETag'] = f"W/{etag}"
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    Compress the responses with the encoding the client prefers among brotli and gzip.
+    """
+
+    def process_response(self, request, response):
+        # Leave the responses that are already encoded alone
+        if response.has_header('Content-Encoding'):
+            return response
+        encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+
+        if response.status_code == 304:
+            # A 304 has the validators the compressed response would have had
+            patch_vary_headers(response, ['Accept-Encoding'])
+            if encoding is not None:
+                weaken_etag(response)
+            return response
+
+        if not response.streaming and len(response.content) < get_compression_settings()['MIN_SIZE']:
+            return response
+        # The body depends on the Accept-Encoding header even when it is not compressed
+        patch_vary_headers(response, ['Accept-Encoding'])
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = compress_async_stream(response.streaming_content, encoding)
+            else:
+                response.streaming_content = compress_stream(response.streaming_content, encoding)
+            # The length of the compressed body is not known in advance
+            del response['Content-Length']
+        else:
+            compressed = compress(response.content, encoding)
+            # Send the body as it is when compressing it does not make it smaller
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        weaken_etag(response)
+        response['Content-Encoding'] = encoding
+        return response
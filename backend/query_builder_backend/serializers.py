@@ -27,3 +27,30 @@ class CommentGetterSerializer(serializers.ModelSerializer):
     class Meta:
         model = Comment
         fields = ['id', 'query', 'username', 'comment_text']
+
+class QuerySearchSerializer(serializers.ModelSerializer):
+    rank = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = Query
+        fields = ['id', 'name', 'username', 'date', 'rank']
+
+class PrefetchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Primary key field that looks the related objects up in the 'prefetched' dictionary of the serializer
+    context ({pk: object}) instead of running one query per item.
+    """
+    def to_internal_value(self, data):
+        prefetched = self.context.get('prefetched')
+        if prefetched is None:
+            return super().to_internal_value(data)
+        try:
+            pk = int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if pk not in prefetched:
+            self.fail('does_not_exist', pk_value=data)
+        return prefetched[pk]
+
+class CommentBulkSerializer(CommentPostSerializer):
+    query = PrefetchedPrimaryKeyRelatedField(queryset=Query.objects.all())
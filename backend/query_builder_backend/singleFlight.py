@@ -0,0 +1,156 @@
+"""
+Request coalescing for identical concurrent BigQuery queries.
+
+The first caller of a key runs the work, every caller that arrives while it is
+still running waits for it and gets the same result (or the same exception).
+"""
+import asyncio
+import threading
+
+
+class _Call:
+    """
+    A piece of work in flight and the callers waiting on it.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time and shares its result with concurrent callers.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, timeout=None):
+        """
+        Run fn for the given key, or wait for the call already running for it.
+
+        :param key: The key identifying the work.
+        :param fn: A callable without arguments that does the work.
+        :param timeout: The longest a caller waits for the call already running, in seconds, None for no limit.
+        :return: The result of fn.
+        :raises TimeoutError: If the running call did not finish within the timeout.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                # Nobody is running this work yet, this caller does it
+                call = _Call()
+                self._calls[key] = call
+            else:
+                call.waiters += 1
+
+        if not leader:
+            # Wait for the running call and share its outcome
+            if not call.done.wait(timeout):
+                raise TimeoutError("The identical query already running did not finish in time")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            # Let later callers start a new call and wake up the waiting ones
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self):
+        """
+        Get the number of calls currently running.
+
+        :return: The number of keys in flight.
+        """
+        with self._lock:
+            return len(self._calls)
+
+
+class _AsyncCall:
+    """
+    A task in flight on an event loop and the number of callers awaiting it.
+    """
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines: concurrent awaits of the same key on an event loop share one call.
+
+    The call runs as its own task, which every caller awaits through a shield: a caller that is
+    cancelled, such as the one of a client that disconnected, stops waiting without cancelling the
+    call of the others. The task is only cancelled when its last caller goes away.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn, timeout=None):
+        """
+        Await fn() for the given key, or wait for the call already running for it.
+
+        :param key: The key identifying the work.
+        :param fn: A callable without arguments that returns an awaitable doing the work.
+        :param timeout: The longest a caller waits for the call already running, in seconds, None for no limit.
+        :return: The result of the awaitable.
+        :raises TimeoutError: If the running call did not finish within the timeout.
+        """
+        loop = asyncio.get_running_loop()
+        # Tasks belong to a loop, so calls are only shared within the same loop
+        flight_key = (loop, key)
+        call = self._calls.get(flight_key)
+        wait_timeout = timeout
+        if call is None:
+            # Nobody is running this work yet, start it for every caller
+            call = _AsyncCall(asyncio.ensure_future(fn()))
+            self._calls[flight_key] = call
+            call.task.add_done_callback(lambda task: self._finish(flight_key, call))
+            # The caller that started the call waits for it like it would for fn()
+            wait_timeout = None
+
+        call.waiters += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(call.task), wait_timeout)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Nobody waits for the results anymore
+                self._finish(flight_key, call)
+                call.task.cancel()
+
+    def _finish(self, flight_key, call):
+        """
+        Let later callers start a new call once a call is done or abandoned.
+
+        :param flight_key: The key of the call.
+        :param call: The _AsyncCall.
+        """
+        if self._calls.get(flight_key) is call:
+            del self._calls[flight_key]
+        if call.task.done() and not call.task.cancelled():
+            # Mark the exception as retrieved in case nobody was waiting
+            call.task.exception()
+
+    def in_flight(self):
+        """
+        Get the number of calls currently running.
+
+        :return: The number of keys in flight.
+        """
+        return len(self._calls)
@@ -0,0 +1,126 @@
+"""
+Startup of the serving processes.
+
+Loading the project is kept cheap so that management commands and new
+containers start quickly: config.json is read once, and google.cloud.bigquery,
+google-auth, pandas and numpy are only imported when first used (see
+bigQueryClient). Serving processes pay for them ahead of the first request
+instead:
+
+- preload imports the heavy modules and the URLconf. It does not create
+  clients, threads or connections, so it is safe in the master process of a
+  pre-forking server (such as gunicorn with --preload), whose workers then share
+  the imported modules.
+- warm_up preloads in a background thread, creates the shared BigQuery client
+  and fetches its token (BIGQUERY_CLIENT['WARM_ON_STARTUP']), and starts the
+  cache warming scheduler. The WSGI and ASGI entry points call it when they are
+  imported, unless STARTUP['WARM_UP_ON_IMPORT'] is off. Threads and sockets do
+  not survive a fork, so a pre-forking server that imports the application in
+  its master must turn it off and warm up every worker instead. For gunicorn
+  with --preload, post_fork is such a hook; in gunicorn.conf.py:
+
+      from query_builder_backend.startup import post_fork
+"""
+import importlib
+import logging
+import threading
+import time
+from django.conf import settings
+from django.urls import get_resolver
+from .bigQueryClient import get_client_manager, get_client_settings
+from .cacheWarming import start_scheduler
+
+logger = logging.getLogger(__name__)
+
+# Default configuration of the startup, overridable with settings.STARTUP
+DEFAULT_STARTUP_SETTINGS = {
+    'PRELOAD': True,
+    'WARM_UP_ON_IMPORT': True,
+}
+
+# Modules imported on first use, in the order preload imports them
+PRELOAD_MODULES = (
+    'google.cloud.bigquery',
+    'google.api_core.exceptions',
+    'google.auth.transport.requests',
+    'google.oauth2.service_account',
+    'pandas',
+    'pyarrow',
+)
+
+
+def get_startup_settings():
+    """
+    Get the startup settings merged over the defaults.
+
+    :return: A dictionary with the startup settings.
+    """
+    return {**DEFAULT_STARTUP_SETTINGS, **getattr(settings, 'STARTUP', {})}
+
+
+def preload(modules=PRELOAD_MODULES):
+    """
+    Import the modules the first requests would import, and the URLconf with every view.
+
+    :param modules: The names of the modules to import. Missing optional packages, such as pyarrow, are skipped.
+    :return: The seconds each import took, by module name.
+    """
+    timings = {}
+    for name in modules:
+        started = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            continue
+        timings[name] = time.perf_counter() - started
+    started = time.perf_counter()
+    get_resolver().url_patterns
+    timings[settings.ROOT_URLCONF] = time.perf_counter() - started
+    return timings
+
+
+def warm_up():
+    """
+    Preload and warm the BigQuery client in the background, and start the cache warming scheduler.
+    Called by the WSGI and ASGI entry points so that only serving processes warm up.
+
+    :return: The started thread, or None if neither preloading nor warming the client is enabled.
+    """
+    preload_modules = get_startup_settings()['PRELOAD']
+    warm_client = get_client_settings()['WARM_ON_STARTUP']
+    thread = None
+    if preload_modules or warm_client:
+        def run():
+            try:
+                if preload_modules:
+                    preload()
+                if warm_client:
+                    get_client_manager().warm()
+            except Exception:
+                logger.exception("Could not warm up the process")
+
+        thread = threading.Thread(target=run, name='startup-warmup', daemon=True)
+        thread.start()
+    start_scheduler()
+    return thread
+
+
+def warm_up_on_import():
+    """
+    Warm up the process unless STARTUP['WARM_UP_ON_IMPORT'] is off. Called by the WSGI and ASGI entry points.
+
+    :return: The thread started by warm_up, or None.
+    """
+    if not get_startup_settings()['WARM_UP_ON_IMPORT']:
+        return None
+    return warm_up()
+
+
+def post_fork(server, worker):
+    """
+    gunicorn hook run in each worker after it is forked from the master.
+
+    :param server: The gunicorn arbiter.
+    :param worker: The forked worker.
+    """
+    warm_up()
@@ -1,9 +1,104 @@
 # myapp/tests.py
-from django.test import TestCase
-from django.urls import reverse
+from django.conf import settings
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.core.management import call_command
+from django.urls import resolve, reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
-from datetime import datetime, timedelta
+from django.test import AsyncClient
+import asyncio
+import gzip
+import io
+import json
+import zlib
+from decimal import Decimal
+import threading
+import time
+from datetime import datetime, timedelta, date
+from unittest import mock
+from google.api_core import exceptions as google_exceptions
+from google.cloud import bigquery
+from query_builder_backend import bigQueryQueries
+from query_builder_backend.queryCache import LRUCacheBackend, make_cache_key
+from query_builder_backend.singleFlight import AsyncSingleFlight, SingleFlight
+from query_builder_backend.queryJobs import QueryJobQueue
+from query_builder_backend.fastJson import dumps
+from query_builder_backend import queryMetrics
+from query_builder_backend import cacheWarming
+from query_builder_backend.responseCompression import choose_encoding, import_brotli
+from query_builder_backend import trendsMirror, trendsRollups
+from query_builder_backend import benchmarks
+from query_builder_backend import bigQueryClient, startup
+from query_builder_backend.bigQueryClient import BigQueryClientManager, get_client_manager
+from query_builder_backend.projectConfig import get_config
+from query_builder_backend import queryResilience, queryShapes
+from query_builder_backend.replayClient import ReplayClient, ReplayJob
+from query_builder_backend.queryCache import reset_query_cache
+from query_builder_backend.models import (
+    Comment, HotQueryDay, MirrorSyncState, Query, RollupSyncState, TermRollup, TopTermMirror, WarmedWatermark,
+)
+
+
+class FakeRowIterator(list):
+    def to_arrow(self, *args, **kwargs):
+        import pyarrow
+        return pyarrow.Table.from_pylist(list(self))
+
+    @property
+    def pages(self):
+        # One row per page, to exercise the reads of the later pages
+        return iter([[row] for row in self])
+
+
+class FakeQueryJob:
+    # Statistics of the job, as BigQuery reports them
+    created = datetime(2023, 11, 20, 12, 0, 0)
+    started = datetime(2023, 11, 20, 12, 0, 1)
+    ended = datetime(2023, 11, 20, 12, 0, 3)
+    total_bytes_billed = 10485760
+
+    def __init__(self, rows, release=None, polls=0, total_bytes_processed=0):
+        self.rows = rows
+        self.release = release
+        self.polls = polls
+        self.total_bytes_processed = total_bytes_processed
+
+    def done(self):
+        # Report the job as running for the first polls
+        self.polls -= 1
+        return self.polls < 0
+
+    def result(self, *args, **kwargs):
+        # Block until the test lets the job finish
+        if self.release is not None:
+            self.release.wait(5)
+        return FakeRowIterator(self.rows)
+
+
+class FakeBigQueryClient:
+    """
+    Stand-in for bigquery.Client that answers every query with fixed rows and records the queries it gets.
+    """
+    def __init__(self, rows, watermark=date(2023, 11, 20), release=None, bytes_processed=1000):
+        self.rows = rows
+        self.watermark = watermark
+        self.release = release
+        self.bytes_processed = bytes_processed
+        self.queries = []
+        self.job_configs = []
+        self.dry_runs = []
+
+    def query(self, query, job_config=None, **kwargs):
+        if job_config is not None and job_config.dry_run:
+            self.dry_runs.append(query)
+            return FakeQueryJob([], total_bytes_processed=self.bytes_processed)
+        self.queries.append(query)
+        self.job_configs.append(job_config)
+        if "INFORMATION_SCHEMA.PARTITIONS" in query:
+            return FakeQueryJob([{'min_refresh_date': '20230101', 'max_refresh_date': self.watermark.strftime('%Y%m%d')}])
+        if "DISTINCT country_name" in query:
+            return FakeQueryJob([{'country_name': 'Colombia'}, {'country_name': 'Mexico'}])
+        return FakeQueryJob(self.rows, self.release)
 
 
 class BigQueryTests(APITestCase):
@@ -24,7 +119,7 @@ class BigQueryTests(APITestCase):
         # Calculate 5 days before the current date
         final_date = (datetime.now() - timedelta(days=5)).strftime('%Y-%m-%d')
 
-        url = reverse('bigquery-top-terms-day-endpoint', args=['Colombia', initial_date, final_date])
+        url = reverse('bigquery-top-terms-dates-endpoint', args=['Colombia', initial_date, final_date])
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
@@ -78,7 +173,7 @@ class BigQueryTests(APITestCase):
         # Calculate 5 days after the current date
         final_date = (datetime.now() + timedelta(days=5)).strftime('%Y-%m-%d')
 
-        url = reverse('bigquery-top-terms-day-endpoint', args=['Colombia', initial_date, final_date])
+        url = reverse('bigquery-top-terms-dates-endpoint', args=['Colombia', initial_date, final_date])
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
@@ -107,4 +202,1602 @@ class BigQueryTests(APITestCase):
 
         url = reverse('bigquery-top-terms-day-endpoint', args=['Colombiaaaa', date])
         response = self.client.get(url)
-        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class QueryCacheTests(TestCase):
+    def setUp(self):
+        self.cache = LRUCacheBackend(max_entries=10)
+        bigQueryQueries.table_metadata.clear()
+        patcher = mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cache_key_ignores_whitespace(self):
+        params = [bigquery.ScalarQueryParameter("date", "STRING", "2023-11-01")]
+        self.assertEqual(
+            make_cache_key("SELECT  a\n FROM t", params, date(2023, 11, 1)),
+            make_cache_key("SELECT a FROM t", params, date(2023, 11, 1)),
+        )
+
+    def test_cache_key_depends_on_params_and_watermark(self):
+        params = [bigquery.ScalarQueryParameter("date", "STRING", "2023-11-01")]
+        other_params = [bigquery.ScalarQueryParameter("date", "STRING", "2023-11-02")]
+        key = make_cache_key("SELECT a FROM t", params, date(2023, 11, 1))
+        self.assertNotEqual(key, make_cache_key("SELECT a FROM t", other_params, date(2023, 11, 1)))
+        self.assertNotEqual(key, make_cache_key("SELECT a FROM t", params, date(2023, 11, 2)))
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = LRUCacheBackend(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+
+    def test_lru_expires_entries(self):
+        cache = LRUCacheBackend(max_entries=2)
+        cache.set('a', 1, timeout=0)
+        self.assertIsNone(cache.get('a'))
+
+    def test_repeated_request_is_served_from_cache(self):
+        client = FakeBigQueryClient([{'Top_Term': 'term', 'rank': 1}])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            url = reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-01'])
+            first = self.client.get(url)
+            second = self.client.get(url)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(first.json(), second.json())
+        # One metadata lookup and a single query job
+        self.assertEqual(len(client.queries), 2)
+        self.assertEqual(len([q for q in client.queries if 'Top_Term' in q]), 1)
+
+    def test_watermark_change_invalidates_cache(self):
+        client = FakeBigQueryClient([{'Top_Term': 'term', 'rank': 1}])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            url = reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-01'])
+            self.client.get(url)
+            client.watermark = date(2023, 11, 21)
+            bigQueryQueries.table_metadata.clear()
+            self.client.get(url)
+        self.assertEqual(len([q for q in client.queries if 'Top_Term' in q]), 2)
+
+
+
+class SingleFlightTests(TestCase):
+    def run_concurrently(self, count, target):
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def test_concurrent_calls_share_one_execution(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def work():
+            calls.append(1)
+            release.wait(5)
+            return ['row']
+
+        threads = self.run_concurrently(8, lambda: results.append(flights.do('key', work)))
+        # Let every thread join the flight before the work finishes
+        while flights._calls.get('key') is None or flights._calls['key'].waiters < 7:
+            pass
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['row']] * 8)
+        self.assertEqual(flights.in_flight(), 0)
+
+    def test_errors_are_shared_and_not_kept(self):
+        flights = SingleFlight()
+
+        def fail():
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            flights.do('key', fail)
+        self.assertEqual(flights.do('key', lambda: 'ok'), 'ok')
+
+    async def test_cancelled_caller_does_not_cancel_the_others(self):
+        flights = AsyncSingleFlight()
+        release = asyncio.Event()
+        cancelled = []
+
+        async def work():
+            try:
+                await release.wait()
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+            return ['row']
+
+        leader = asyncio.ensure_future(flights.do('key', work))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.do('key', work))
+        await asyncio.sleep(0)
+        # The client of the first caller disconnects
+        leader.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+        release.set()
+        self.assertEqual(await follower, ['row'])
+        self.assertEqual(cancelled, [])
+        self.assertEqual(flights.in_flight(), 0)
+
+        # The call is cancelled once its last caller goes away
+        release.clear()
+        only = asyncio.ensure_future(flights.do('key', work))
+        await asyncio.sleep(0)
+        only.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await only
+        await asyncio.sleep(0)
+        self.assertEqual(cancelled, [1])
+        self.assertEqual(flights.in_flight(), 0)
+
+    def test_concurrent_requests_run_one_job(self):
+        release = threading.Event()
+        client = FakeBigQueryClient([{'Top_Term': 'term', 'rank': 1}], release=release)
+        cache = LRUCacheBackend(max_entries=10)
+        bigQueryQueries.table_metadata.clear()
+        params = [bigquery.ScalarQueryParameter("date", "STRING", "2023-11-01")]
+        results = []
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client), \
+                mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=cache):
+            bigQueryQueries.fetch_watermark(bigQueryQueries.TOP_TERMS_TABLE)
+            threads = self.run_concurrently(
+                5, lambda: results.append(bigQueryQueries.run_query("SELECT term", params, bigQueryQueries.TOP_TERMS_TABLE))
+            )
+            while sum(call.waiters for call in bigQueryQueries.query_flights._calls.values()) < 4:
+                pass
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len([q for q in client.queries if q == "SELECT term"]), 1)
+        self.assertEqual(len(results), 5)
+
+
+
+class AsyncBigQueryTests(TestCase):
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+        # The async views store their results through bigQueryQueries
+        patcher = mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=LRUCacheBackend(max_entries=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_async_endpoint_returns_rows(self):
+        client = FakeBigQueryClient([{'Top_Term': 'term', 'rank': 1}])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            url = reverse('bigquery-async-top-terms-day-endpoint', args=['Colombia', '2023-11-01'])
+            response = await AsyncClient().get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), [{'Top_Term': 'term', 'rank': 1}])
+
+    async def test_async_endpoint_returns_404_without_rows(self):
+        client = FakeBigQueryClient([])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            url = reverse('bigquery-async-top-rising-terms-dates-endpoint', args=['Colombia', '2023-11-01', '2023-11-05'])
+            response = await AsyncClient().get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_async_endpoint_validators(self):
+        client = FakeBigQueryClient([{'Top_Term': 'term', 'rank': 1}])
+        url = reverse('bigquery-async-top-terms-day-endpoint', args=['Colombia', '2023-11-01'])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            response = await AsyncClient().get(url)
+            self.assertIn('ETag', response)
+            self.assertEqual(response['Last-Modified'], 'Mon, 20 Nov 2023 00:00:00 GMT')
+            client.queries.clear()
+            not_modified = await AsyncClient().get(url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual([query for query in client.queries if "INFORMATION_SCHEMA" not in query], [])
+
+    async def test_async_endpoint_streams_and_rollups(self):
+        client = FakeBigQueryClient([{'Top_Term': 'term', 'rank': 1}])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            url = reverse('bigquery-async-top-terms-day-endpoint', args=['Colombia', '2023-11-01'])
+            response = await AsyncClient().get(url, {'stream': 'ndjson'})
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            self.assertEqual(b"".join(response.streaming_content),
+                             b'{"Top_Term":"term","rank":1}\n')
+            url = reverse('bigquery-async-top-terms-dates-endpoint', args=['Colombia', '2023-06-01', '2023-11-30'])
+            response = await AsyncClient().get(url, {'granularity': 'month'})
+        self.assertEqual(response['X-Granularity'], 'month')
+        self.assertIn("DATE_TRUNC(refresh_date, MONTH)", client.queries[-1])
+
+    async def test_wait_for_job_polls_until_done(self):
+        from query_builder_backend.asyncBigQueryQueries import wait_for_job
+        job = FakeQueryJob([], polls=3)
+        with self.settings(BIGQUERY_ASYNC={'POLL_INTERVAL': 0, 'MAX_POLL_INTERVAL': 0}):
+            await wait_for_job(job)
+        self.assertEqual(job.polls, -1)
+
+
+
+class TrendsMirrorTests(TestCase):
+    rows = [
+        {'refresh_date': date(2023, 11, 1), 'country_name': 'Colombia', 'term': 'first', 'rank': 1},
+        {'refresh_date': date(2023, 11, 1), 'country_name': 'Colombia', 'term': 'second', 'rank': 2},
+        {'refresh_date': date(2023, 11, 2), 'country_name': 'Colombia', 'term': 'third', 'rank': 1},
+    ]
+
+    def sync(self, rows, since=None):
+        client = FakeBigQueryClient(rows)
+        copied = trendsMirror.sync_table(client, bigQueryQueries.TOP_TERMS_TABLE, TopTermMirror, since=since)
+        return client, copied
+
+    def test_sync_copies_rows_and_records_coverage(self):
+        _, copied = self.sync(self.rows)
+        self.assertEqual(copied, 3)
+        state = MirrorSyncState.objects.get(table=bigQueryQueries.TOP_TERMS_TABLE)
+        self.assertEqual((state.min_refresh_date, state.max_refresh_date), (date(2023, 11, 1), date(2023, 11, 2)))
+
+    def test_incremental_sync_starts_after_last_partition(self):
+        self.sync(self.rows)
+        client, copied = self.sync([
+            {'refresh_date': date(2023, 11, 3), 'country_name': 'Colombia', 'term': 'fourth', 'rank': 1},
+        ])
+        first_date = client.job_configs[0].query_parameters[0].value
+        self.assertEqual(first_date, date(2023, 11, 3))
+        self.assertEqual(TopTermMirror.objects.count(), 4)
+
+    def test_resync_replaces_partitions(self):
+        self.sync(self.rows)
+        self.sync(self.rows[2:], since=date(2023, 11, 2))
+        self.assertEqual(TopTermMirror.objects.count(), 3)
+
+    def test_endpoint_answers_from_mirror(self):
+        self.sync(self.rows)
+        client = FakeBigQueryClient([])
+        with self.settings(TRENDS_MIRROR={'ENABLED': True}), \
+                mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            day = self.client.get(reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-01']))
+            dates = self.client.get(reverse('bigquery-top-terms-dates-endpoint', args=['Colombia', '2023-11-01', '2023-11-02']))
+        self.assertEqual(day.json(), [{'Top_Term': 'first', 'rank': 1}, {'Top_Term': 'second', 'rank': 2}])
+        self.assertEqual(dates.json(), [{'Day': '2023-11-02', 'Top_Term': 'third'}, {'Day': '2023-11-01', 'Top_Term': 'first'}])
+        self.assertEqual(client.queries, [])
+
+    def test_only_covered_requests_validate_against_the_mirror(self):
+        self.sync(self.rows)
+        client = FakeBigQueryClient([{'Top_Term': 'new', 'rank': 1}], watermark=date(2023, 11, 20))
+        with self.settings(TRENDS_MIRROR={'ENABLED': True}), \
+                mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            covered = self.client.get(reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-02']))
+            uncovered = self.client.get(reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-20']))
+        self.assertEqual(covered['Last-Modified'], 'Thu, 02 Nov 2023 00:00:00 GMT')
+        self.assertEqual(uncovered['Last-Modified'], 'Mon, 20 Nov 2023 00:00:00 GMT')
+        self.assertEqual(uncovered.json(), [{'Top_Term': 'new', 'rank': 1}])
+
+    def test_uncovered_range_falls_back_to_bigquery(self):
+        self.sync(self.rows)
+        with self.settings(TRENDS_MIRROR={'ENABLED': True}):
+            self.assertIsNone(trendsMirror.top_terms_dates(bigQueryQueries.TOP_TERMS_TABLE, 'Colombia', '2023-10-01', '2023-11-02'))
+            self.assertIsNotNone(trendsMirror.top_terms_day(bigQueryQueries.TOP_TERMS_TABLE, 'Colombia', '2023-11-02'))
+
+
+class BigQueryBatchTests(TestCase):
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+        patcher = mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=LRUCacheBackend(max_entries=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_batch_is_one_query_grouped_by_country_and_date(self):
+        client = FakeBigQueryClient([
+            {'country_name': 'Colombia', 'Day': date(2023, 11, 1), 'Top_Term': 'a', 'rank': 1},
+            {'country_name': 'Colombia', 'Day': date(2023, 11, 2), 'Top_Term': 'b', 'rank': 1},
+            {'country_name': 'Mexico', 'Day': date(2023, 11, 1), 'Top_Term': 'c', 'rank': 1},
+        ])
+        url = reverse('bigquery-top-terms-batch-endpoint')
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            response = self.client.get(url, {'country': ['Colombia', 'Mexico'], 'date': ['2023-11-01', '2023-11-02']})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {
+            'Colombia': {'2023-11-01': [{'Top_Term': 'a', 'rank': 1}], '2023-11-02': [{'Top_Term': 'b', 'rank': 1}]},
+            'Mexico': {'2023-11-01': [{'Top_Term': 'c', 'rank': 1}]},
+        })
+        batch_queries = [config for query, config in zip(client.queries, client.job_configs) if 'UNNEST' in query]
+        self.assertEqual(len(batch_queries), 1)
+        params = {param.name: param for param in batch_queries[0].query_parameters}
+        self.assertEqual(params['countries'].values, ['Colombia', 'Mexico'])
+        self.assertEqual(params['dates'].values, [date(2023, 11, 1), date(2023, 11, 2)])
+
+    def test_batch_accepts_a_range(self):
+        query, params = bigQueryQueries.BigQueryTopRisingTermsBatch().build_query(['Colombia'], [], '2023-11-01', '2023-11-05')
+        self.assertIn('BETWEEN @init_date AND @finish_date', query)
+        self.assertIn('percent_gain', query)
+
+    def test_batch_rejects_invalid_parameters(self):
+        url = reverse('bigquery-top-terms-batch-endpoint')
+        self.assertEqual(self.client.get(url, {'date': '2023-11-01'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {'country': 'Colombia'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {'country': 'Colombia', 'date': 'yesterday'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class StreamingTests(TestCase):
+    rows = [{'Day': date(2023, 11, 2), 'Top_Term': 'b'}, {'Day': date(2023, 11, 1), 'Top_Term': 'a'}]
+
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+        patcher = mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=LRUCacheBackend(max_entries=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, rows, **extra):
+        client = FakeBigQueryClient(rows)
+        url = reverse('bigquery-top-terms-dates-endpoint', args=['Colombia', '2023-11-01', '2023-11-02'])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            response = self.client.get(url, **extra)
+            body = b"".join(response.streaming_content) if response.streaming else response.content
+        return response, body.decode()
+
+    def test_stream_json_array(self):
+        response, body = self.get(self.rows, data={'stream': 'json'})
+        self.assertTrue(response.streaming)
+        self.assertEqual(json.loads(body), [{'Day': '2023-11-02', 'Top_Term': 'b'}, {'Day': '2023-11-01', 'Top_Term': 'a'}])
+
+    def test_stream_ndjson_from_accept_header(self):
+        response, body = self.get(self.rows, HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in body.splitlines()][1], {'Day': '2023-11-01', 'Top_Term': 'a'})
+
+    def test_stream_without_rows_is_404(self):
+        response, _ = self.get([], data={'stream': 'ndjson'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_unknown_stream_format_is_400(self):
+        response, _ = self.get(self.rows, data={'stream': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def failing_pages(self):
+        yield [self.rows[0]]
+        raise google_exceptions.ServiceUnavailable("down")
+
+    def get_failing(self, stream_format):
+        results = mock.Mock(pages=self.failing_pages())
+        failures = queryResilience.bigquery_breaker.failures
+        with mock.patch.object(bigQueryQueries, 'job_result', return_value=results):
+            response, body = self.get(self.rows, data={'stream': stream_format})
+        # The failed page is counted by the circuit breaker
+        self.assertEqual(queryResilience.bigquery_breaker.failures, failures + 1)
+        queryResilience.bigquery_breaker.reset()
+        return response, body
+
+    def test_failed_json_stream_is_not_valid_json(self):
+        response, body = self.get_failing('json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(body, '[{"Day":"2023-11-02","Top_Term":"b"}')
+        with self.assertRaises(ValueError):
+            json.loads(body)
+
+    def test_failed_ndjson_stream_ends_with_a_trailer(self):
+        _, body = self.get_failing('ndjson')
+        lines = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(lines, [{'Day': '2023-11-02', 'Top_Term': 'b'}, ['error', '503 down']])
+
+    def test_first_page_is_retried(self):
+        results = mock.Mock(pages=iter([[row] for row in self.rows]))
+        with mock.patch.object(bigQueryQueries, 'job_result',
+                               side_effect=[google_exceptions.ServiceUnavailable("down"), results]), \
+                mock.patch.object(queryResilience, 'retry_delay', return_value=0):
+            response, body = self.get(self.rows, data={'stream': 'ndjson'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(body.splitlines()), 2)
+
+
+
+class ColumnarResultTests(TestCase):
+    rows = [{'Top_Term': 'a', 'rank': 1}, {'Top_Term': 'b', 'rank': 2}]
+
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+        patcher = mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=LRUCacheBackend(max_entries=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, rows, **extra):
+        client = FakeBigQueryClient(rows)
+        url = reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-01'])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            return self.client.get(url, **extra)
+
+    def test_columnar_json(self):
+        response = self.get(self.rows, data={'format': 'columnar'})
+        self.assertEqual(response.json(), {'Top_Term': ['a', 'b'], 'rank': [1, 2]})
+
+    def test_arrow_stream_from_accept_header(self):
+        import pyarrow
+        response = self.get(self.rows, HTTP_ACCEPT='application/vnd.apache.arrow.stream')
+        self.assertEqual(response['Content-Type'], 'application/vnd.apache.arrow.stream')
+        arrow_table = pyarrow.ipc.open_stream(response.content).read_all()
+        self.assertEqual(arrow_table.to_pylist(), self.rows)
+
+    def test_compact_rows(self):
+        response = self.get(self.rows, data={'format': 'compact'})
+        self.assertEqual(response.json(), {'columns': ['Top_Term', 'rank'], 'rows': [['a', 1], ['b', 2]]})
+
+    def test_columnar_from_cached_rows(self):
+        self.get(self.rows)
+        response = self.get([], data={'format': 'columnar'})
+        self.assertEqual(response.json(), {'Top_Term': ['a', 'b'], 'rank': [1, 2]})
+
+    def test_unknown_format_is_400(self):
+        self.assertEqual(self.get(self.rows, data={'format': 'xml'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_empty_result_is_404(self):
+        self.assertEqual(self.get([], data={'format': 'arrow'}).status_code, status.HTTP_404_NOT_FOUND)
+
+
+
+class BigQueryClientManagerTests(TestCase):
+    def setUp(self):
+        credentials = mock.Mock(project_id='project')
+        patchers = [
+            mock.patch('google.oauth2.service_account.Credentials.from_service_account_file', return_value=credentials),
+            mock.patch('query_builder_backend.bigQueryClient.bigquery.Client'),
+        ]
+        self.load_credentials, self.client_class = [patcher.start() for patcher in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+
+    def test_threads_share_one_client(self):
+        manager = BigQueryClientManager('config.json', pool_size=4)
+        clients = []
+        threads = [threading.Thread(target=lambda: clients.append(manager.get_client())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len({id(client) for client in clients}), 1)
+        self.assertEqual(self.load_credentials.call_count, 1)
+        self.assertEqual(self.client_class.call_count, 1)
+
+    def test_pool_size_and_stats(self):
+        manager = BigQueryClientManager('config.json', pool_size=4)
+        self.assertFalse(manager.stats()['client_created'])
+        manager.get_client()
+        session = self.client_class.call_args.kwargs['_http']
+        self.assertEqual(session.get_adapter('https://')._pool_maxsize, 4)
+        stats = manager.stats()
+        self.assertTrue(stats['client_created'])
+        self.assertEqual(stats['pool_size'], 4)
+        self.assertEqual(stats['client_requests'], 1)
+
+
+
+class TrendsMetadataTests(TestCase):
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+
+    def test_interval_served_from_memory_with_freshness(self):
+        client = FakeBigQueryClient([])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            url = reverse('bigquery-interval-date-top-terms-endpoint')
+            first = self.client.get(url)
+            second = self.client.get(url)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        [interval] = second.json()
+        self.assertEqual(interval['min_refresh_date'], '2023-01-01')
+        self.assertEqual(interval['max_refresh_date'], '2023-11-20')
+        self.assertEqual(interval['source'], 'partitions')
+        self.assertIn('fetched_at', interval)
+        self.assertIn('Age', second)
+        self.assertEqual(len(client.queries), 1)
+
+    def test_scan_fallback_when_partitions_unavailable(self):
+        client = FakeBigQueryClient([{'min_refresh_date': date(2023, 1, 1), 'max_refresh_date': date(2023, 11, 20)}])
+        original_query = client.query
+
+        def query(query, job_config=None, **kwargs):
+            if "INFORMATION_SCHEMA" in query:
+                raise RuntimeError("Access denied")
+            return original_query(query, job_config, **kwargs)
+
+        client.query = query
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            metadata = bigQueryQueries.table_metadata.get(bigQueryQueries.TOP_RISING_TERMS_TABLE)
+        self.assertEqual(metadata.source, 'scan')
+        self.assertEqual(metadata.max_refresh_date, date(2023, 11, 20))
+
+    def test_countries_read_once_per_refresh_date(self):
+        client = FakeBigQueryClient([])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            url = reverse('bigquery-countries-top-terms-endpoint')
+            self.client.get(url)
+            response = self.client.get(url)
+        self.assertEqual(response.json()['countries'], ['Colombia', 'Mexico'])
+        self.assertEqual(response.json()['refresh_date'], '2023-11-20')
+        self.assertEqual(len([q for q in client.queries if 'DISTINCT country_name' in q]), 1)
+
+
+
+class QueryCostTests(TestCase):
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+        bigQueryQueries.cost_guard.estimates.clear()
+        self.cache = LRUCacheBackend(max_entries=10)
+        patcher = mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, client, *args):
+        url = reverse('bigquery-top-terms-dates-endpoint', args=args or ['Colombia', '2023-11-01', '2023-11-30'])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            return self.client.get(url)
+
+    def test_estimate_header_and_cached_estimate(self):
+        client = FakeBigQueryClient([{'Day': date(2023, 11, 1), 'Top_Term': 'a'}], bytes_processed=1234)
+        with self.settings(BIGQUERY_COST={'MAX_BYTES_PER_REQUEST': 10000}):
+            first = self.get(client)
+            self.cache.clear()
+            second = self.get(client)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(second['X-BigQuery-Estimated-Bytes'], '1234')
+        self.assertEqual(len(client.dry_runs), 1)
+
+    def test_cached_results_skip_the_dry_run(self):
+        client = FakeBigQueryClient([{'Day': date(2023, 11, 1), 'Top_Term': 'a'}], bytes_processed=1234)
+        with self.settings(BIGQUERY_COST={'MAX_BYTES_PER_REQUEST': 10000}):
+            self.get(client)
+            bigQueryQueries.cost_guard.estimates.clear()
+            second = self.get(client)
+            columnar = self.client.get(
+                reverse('bigquery-top-terms-dates-endpoint', args=['Colombia', '2023-11-01', '2023-11-30']),
+                {'format': 'columnar'},
+            )
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.json(), [{'Day': '2023-11-01', 'Top_Term': 'a'}])
+        self.assertEqual(columnar.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(client.dry_runs), 1)
+        self.assertEqual(len([q for q in client.queries if 'Top_Term' in q]), 1)
+
+    def test_query_over_budget_is_rejected_before_running(self):
+        client = FakeBigQueryClient([{'Day': date(2023, 11, 1), 'Top_Term': 'a'}], bytes_processed=10 ** 12)
+        with self.settings(BIGQUERY_COST={'MAX_BYTES_PER_REQUEST': 10 ** 9}):
+            response = self.get(client)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['estimated_bytes'], 10 ** 12)
+        self.assertEqual([q for q in client.queries if 'Top_Term' in q], [])
+
+    def test_jobs_are_capped(self):
+        client = FakeBigQueryClient([{'Day': date(2023, 11, 1), 'Top_Term': 'a'}])
+        with self.settings(BIGQUERY_COST={'MAXIMUM_BYTES_BILLED': 5000}):
+            self.get(client)
+        job_config = client.job_configs[client.queries.index(next(q for q in client.queries if 'Top_Term' in q))]
+        self.assertEqual(job_config.maximum_bytes_billed, 5000)
+
+
+
+class PaginationTests(APITestCase):
+    def setUp(self):
+        self.queries = [
+            Query.objects.create(name=f"query {i}", query="url", username="ana" if i % 2 else "luis", query_comment="")
+            for i in range(5)
+        ]
+        for i in range(5):
+            Comment.objects.create(query=self.queries[0], username="ana", comment_text=f"comment {i}")
+
+    def read_all(self, url, **params):
+        ids, cursor, pages = [], None, 0
+        while True:
+            response = self.client.get(url, {**params, **({'cursor': cursor} if cursor else {})})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [row['id'] for row in response.json()]
+            pages += 1
+            cursor = response.get('X-Next-Cursor')
+            if cursor is None:
+                return ids, pages
+
+    def test_queries_are_paginated_newest_first(self):
+        ids, pages = self.read_all(reverse('db-queries-endpoint'), limit=2)
+        self.assertEqual(ids, sorted((query.id for query in self.queries), reverse=True))
+        self.assertEqual(pages, 3)
+
+    def test_queries_filtered_by_username(self):
+        ids, _ = self.read_all(reverse('db-queries-endpoint'), username='ana')
+        self.assertEqual(set(ids), {query.id for query in self.queries if query.username == 'ana'})
+
+    def test_comments_are_paginated(self):
+        response = self.client.get(reverse('db-comments-endpoint', args=[self.queries[0].id]), {'limit': 3})
+        self.assertEqual(len(response.json()), 3)
+        self.assertIn('rel="next"', response['Link'])
+        ids, pages = self.read_all(reverse('db-comments-endpoint', args=[self.queries[0].id]), limit=3)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(ids, sorted(ids, reverse=True))
+        self.assertEqual(pages, 2)
+
+    def test_invalid_cursor_is_400(self):
+        response = self.client.get(reverse('db-queries-endpoint'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse('db-comments-endpoint', args=[1]), {'limit': 'many'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class QuerySearchTests(APITestCase):
+    def setUp(self):
+        self.colombia = Query.objects.create(
+            name="Colombia top terms", query="http://localhost:8000/api/bigquery/get/top_terms_day/Colombia/2023-11-01",
+            username="ana", query_comment="Daily terms",
+        )
+        self.mexico = Query.objects.create(
+            name="Mexico rising", query="http://localhost:8000/api/bigquery/get/top_rising_terms_day/Mexico/2023-11-01",
+            username="luis", query_comment="Rising terms of Colombia's neighbour",
+        )
+
+    def search(self, **params):
+        response = self.client.get(reverse('db-queries-search-endpoint'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_name_matches_rank_above_description_matches(self):
+        ids = [row['id'] for row in self.search(q='colombia').json()]
+        self.assertEqual(ids, [self.colombia.id, self.mexico.id])
+
+    def test_query_url_words_are_searchable(self):
+        ids = [row['id'] for row in self.search(q='rising').json()]
+        self.assertEqual(ids, [self.mexico.id])
+
+    def test_comments_update_the_vector(self):
+        self.assertEqual(self.search(q='elections').json(), [])
+        comment = Comment.objects.create(query=self.mexico, username="ana", comment_text="Elections week")
+        self.assertEqual([row['id'] for row in self.search(q='elections').json()], [self.mexico.id])
+        comment.delete()
+        self.assertEqual(self.search(q='elections').json(), [])
+
+    def test_search_is_paginated(self):
+        ids, cursor = [], None
+        while True:
+            response = self.search(q='terms', limit=1, **({'cursor': cursor} if cursor else {}))
+            ids += [row['id'] for row in response.json()]
+            cursor = response.get('X-Next-Cursor')
+            if cursor is None:
+                break
+        self.assertEqual(sorted(ids), sorted([self.colombia.id, self.mexico.id]))
+
+    def test_missing_search_is_400(self):
+        response = self.client.get(reverse('db-queries-search-endpoint'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BulkIngestTests(APITestCase):
+    def test_queries_json_array(self):
+        items = [
+            {"name": f"query {i}", "query": "url", "username": "ana", "query_comment": f"bulk {i}"}
+            for i in range(5)
+        ] + [{"name": "missing fields"}]
+        with self.settings(BULK_INGEST={'BATCH_SIZE': 2}):
+            response = self.client.post(reverse('db-queries-bulk-endpoint'), items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        body = response.json()
+        self.assertEqual((body['created'], body['failed']), (5, 1))
+        self.assertEqual(body['errors'][0]['index'], 5)
+        self.assertIn('query', body['errors'][0]['errors'])
+        self.assertEqual(Query.objects.count(), 5)
+        # bulk_create skips the signals, the search vectors are still filled
+        self.assertFalse(Query.objects.filter(search_vector=None).exists())
+
+    def test_comments_ndjson(self):
+        query = Query.objects.create(name="query", query="url", username="ana", query_comment="")
+        body = "\n".join([
+            json.dumps({"query": query.id, "username": "ana", "comment_text": "Holidays spike"}),
+            "",
+            "{not json",
+            json.dumps({"query": 999999, "username": "ana", "comment_text": "unknown query"}),
+            json.dumps({"query": str(query.id), "username": "luis", "comment_text": "second"}),
+        ])
+        response = self.client.generic(
+            'POST', reverse('db-comments-bulk-endpoint'), body, content_type='application/x-ndjson',
+        )
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        body = response.json()
+        self.assertEqual([error['index'] for error in body['errors']], [1, 2])
+        self.assertEqual(Comment.objects.filter(query=query).count(), 2)
+        search = self.client.get(reverse('db-queries-search-endpoint'), {'q': 'holidays'})
+        self.assertEqual([row['id'] for row in search.json()], [query.id])
+
+    def test_all_invalid_is_400(self):
+        response = self.client.post(reverse('db-comments-bulk-endpoint'), [{"query": "x"}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('db-queries-bulk-endpoint'), {"name": "not a list"}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_body_size_limit(self):
+        items = [
+            {"name": f"query {i}", "query": "url", "username": "ana", "query_comment": "x" * 100}
+            for i in range(50)
+        ]
+        # Bodies over DATA_UPLOAD_MAX_MEMORY_SIZE are accepted up to BULK_INGEST['MAX_BODY_SIZE']
+        with self.settings(DATA_UPLOAD_MAX_MEMORY_SIZE=1024):
+            response = self.client.post(reverse('db-queries-bulk-endpoint'), items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        with self.settings(BULK_INGEST={'MAX_BODY_SIZE': 1024}):
+            response = self.client.post(reverse('db-queries-bulk-endpoint'), items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(Query.objects.count(), 50)
+
+
+class QueryExecutionTests(TestCase):
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+        bigQueryQueries.cost_guard.estimates.clear()
+        self.saved_query = Query.objects.create(
+            name="Colombia", query="http://localhost:8000/api/bigquery/get/top_terms_day/Colombia/2023-11-01",
+            username="ana", query_comment="",
+        )
+        self.url = reverse('db-query-results-endpoint', args=[self.saved_query.id])
+
+    def get(self, client, **params):
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            return self.client.get(self.url, params)
+
+    def data_queries(self, client):
+        return [query for query in client.queries if "INFORMATION_SCHEMA" not in query]
+
+    def test_snapshot_is_served_until_the_table_is_refreshed(self):
+        client = FakeBigQueryClient([{'Top_Term': 'a', 'rank': 1}, {'Top_Term': 'b', 'rank': 2}])
+        first = self.get(client)
+        second = self.get(client)
+        self.assertEqual(first['X-Snapshot-Status'], 'miss')
+        self.assertEqual(second['X-Snapshot-Status'], 'hit')
+        self.assertEqual(second.json(), [{'Top_Term': 'a', 'rank': 1}, {'Top_Term': 'b', 'rank': 2}])
+        self.assertEqual(second['X-Snapshot-Row-Count'], '2')
+        self.assertEqual(len(self.data_queries(client)), 1)
+
+        # A new refresh date makes the snapshot stale
+        client.watermark = date(2023, 11, 21)
+        bigQueryQueries.table_metadata.clear()
+        self.assertEqual(self.get(client)['X-Snapshot-Status'], 'miss')
+        self.assertEqual(len(self.data_queries(client)), 2)
+
+    def test_snapshot_is_sent_compressed(self):
+        client = FakeBigQueryClient([{'Top_Term': 'a', 'rank': 1}])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(response.content)), [{'Top_Term': 'a', 'rank': 1}])
+
+        # A client that refuses gzip gets the rows uncompressed
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response.json(), [{'Top_Term': 'a', 'rank': 1}])
+
+    def test_editing_or_invalidating_runs_the_query_again(self):
+        client = FakeBigQueryClient([{'Top_Term': 'a', 'rank': 1}])
+        self.get(client)
+        self.saved_query.query = "http://localhost:8000/api/bigquery/get/top_terms_day/Mexico/2023-11-01"
+        self.saved_query.save()
+        self.assertEqual(self.get(client)['X-Snapshot-Status'], 'miss')
+        self.assertEqual(self.client.delete(self.url).json(), {'invalidated': True})
+        self.assertEqual(self.get(client)['X-Snapshot-Status'], 'miss')
+        self.assertEqual(self.get(client, refresh='true')['X-Snapshot-Status'], 'miss')
+        self.assertEqual(len(self.data_queries(client)), 4)
+
+    def test_query_that_is_not_an_endpoint_is_400(self):
+        self.saved_query.query = "http://localhost:8000/api/db/get/queries"
+        self.saved_query.save()
+        self.assertEqual(self.get(FakeBigQueryClient([])).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(reverse('db-query-results-endpoint', args=[0])).status_code, 404)
+
+
+class QueryJobTests(TestCase):
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+        bigQueryQueries.cost_guard.estimates.clear()
+        self.queue = QueryJobQueue(max_workers=1, max_queued=1, result_ttl=60)
+        for name, value in [('get_job_queue', self.queue), ('get_query_cache', LRUCacheBackend(max_entries=10))]:
+            patcher = mock.patch.object(bigQueryQueries, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def submit(self, client, country='Colombia'):
+        url = reverse('bigquery-job-top-terms-dates-endpoint', args=[country, '2023-11-01', '2023-11-30'])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            return self.client.post(url)
+
+    def test_submit_returns_at_once_and_serves_the_rows(self):
+        release = threading.Event()
+        client = FakeBigQueryClient([{'Day': '2023-11-01', 'Top_Term': 'a'}], release=release)
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            submitted = self.submit(client)
+            self.assertEqual(submitted.status_code, status.HTTP_202_ACCEPTED)
+            job_id = submitted.json()['job_id']
+            self.assertEqual(submitted['Location'], submitted.json()['status_url'])
+            pending = self.client.get(reverse('bigquery-job-result-endpoint', args=[job_id]))
+            self.assertEqual(pending.status_code, status.HTTP_202_ACCEPTED)
+            release.set()
+            result = self.client.get(reverse('bigquery-job-result-endpoint', args=[job_id]), {'wait': 5})
+        self.assertEqual(result.status_code, status.HTTP_200_OK)
+        self.assertEqual(result.json(), [{'Day': '2023-11-01', 'Top_Term': 'a'}])
+        job_status = self.client.get(reverse('bigquery-job-status-endpoint', args=[job_id])).json()
+        self.assertEqual((job_status['state'], job_status['rows_fetched']), ('done', 1))
+
+        # The rows are cached, so the same query is finished as soon as it is submitted
+        again = self.submit(client)
+        self.assertEqual(again.json()['state'], 'done')
+
+    def test_backlog_cap(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        client = FakeBigQueryClient([{'Top_Term': 'a'}], release=release)
+        patcher = mock.patch.object(bigQueryQueries, 'get_client', return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # One running and one queued job fill the queue
+        self.assertEqual(self.submit(client, 'Colombia').status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(self.submit(client, 'Mexico').status_code, status.HTTP_202_ACCEPTED)
+        rejected = self.submit(client, 'Peru')
+        self.assertEqual(rejected.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', rejected)
+
+    def test_failed_and_unknown_jobs(self):
+        job = self.queue.submit('failing', lambda job: 1 / 0)
+        job.wait(5)
+        response = self.client.get(reverse('bigquery-job-result-endpoint', args=[job.id]))
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        response = self.client.get(reverse('bigquery-job-status-endpoint', args=['unknown']))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class AnalyticsTests(TestCase):
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+        bigQueryQueries.cost_guard.estimates.clear()
+        patcher = mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=LRUCacheBackend(max_entries=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        day = lambda n: date(2023, 11, n)
+        rows = [
+            # "a" in Colombia on the 1st, 2nd, 3rd and 5th, "b" on the 4th and 5th
+            *[{'country_name': 'Colombia', 'Day': day(n), 'term': 'a', 'rank': rank}
+              for n, rank in [(1, 1), (2, 3), (3, 2), (5, 2)]],
+            *[{'country_name': 'Colombia', 'Day': day(n), 'term': 'b', 'rank': 5} for n in (4, 5)],
+            {'country_name': 'Mexico', 'Day': day(2), 'term': 'a', 'rank': 1},
+            {'country_name': 'Mexico', 'Day': day(2), 'term': 'c', 'rank': 2},
+        ]
+        self.client_stub = FakeBigQueryClient(rows)
+
+    def get(self, metric, **params):
+        url = reverse('bigquery-top-terms-analytics-endpoint', args=[metric])
+        params = {'country': ['Colombia', 'Mexico'], 'init_date': '2023-11-01', 'finish_date': '2023-11-05', **params}
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=self.client_stub):
+            return self.client.get(url, params)
+
+    def data_queries(self):
+        return [query for query in self.client_stub.queries if "INFORMATION_SCHEMA" not in query]
+
+    def test_persistence(self):
+        response = self.get('persistence')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        metrics = {(row['country_name'], row['term']): row for row in response.json()}
+        term_a = metrics[('Colombia', 'a')]
+        self.assertEqual(term_a['days_present'], 4)
+        self.assertEqual((term_a['first_seen'], term_a['last_seen']), ('2023-11-01', '2023-11-05'))
+        self.assertEqual((term_a['longest_streak'], term_a['current_streak']), (3, 1))
+        self.assertEqual((term_a['best_rank'], term_a['mean_rank']), (1, 2.0))
+        self.assertEqual(metrics[('Colombia', 'b')]['current_streak'], 2)
+        self.assertEqual(metrics[('Colombia', 'b')]['rank_std'], 0.0)
+        self.assertEqual(metrics[('Mexico', 'c')]['current_streak'], 0)
+
+    def test_metrics_of_a_range_share_one_query(self):
+        overlap = self.get('overlap').json()
+        self.assertEqual(overlap['terms_per_country'], {'Colombia': 2, 'Mexico': 2})
+        self.assertEqual(overlap['pairs'], [{'countries': ['Colombia', 'Mexico'], 'shared_terms': 1, 'jaccard': 0.3333}])
+        self.assertEqual(overlap['terms_in_all_countries'], ['a'])
+        self.get('persistence')
+        self.get('persistence')
+        self.assertEqual(len(self.data_queries()), 1)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.get('unknown').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.get('overlap', country=[]).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get('overlap', finish_date='2023-10-01').status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TrendsRollupTests(TestCase):
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+        bigQueryQueries.cost_guard.estimates.clear()
+        patcher = mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=LRUCacheBackend(max_entries=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def summary(self, period, term, days_at_rank_1, last_refresh_date=None):
+        return {
+            'period_start': period, 'country_name': 'Colombia', 'term': term, 'days_present': 7,
+            'days_at_rank_1': days_at_rank_1, 'best_rank': 1 if days_at_rank_1 else 2, 'mean_rank': 1.5,
+            'max_percent_gain': None, 'last_refresh_date': last_refresh_date or period,
+        }
+
+    def sync(self, granularity, rows, since=None):
+        client = FakeBigQueryClient(rows)
+        written = trendsRollups.sync_rollup(client, bigQueryQueries.TOP_TERMS_TABLE, granularity, False, since=since)
+        return client, written
+
+    def get(self, client, init_date, finish_date, granularity):
+        url = reverse('bigquery-top-terms-dates-endpoint', args=['Colombia', init_date, finish_date])
+        with self.settings(TRENDS_ROLLUPS={'ENABLED': True}), \
+                mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            return self.client.get(url, {'granularity': granularity})
+
+    def test_sync_resummarizes_the_last_period(self):
+        self.sync('month', [self.summary(date(2023, 10, 1), 'a', 20), self.summary(date(2023, 11, 1), 'b', 3)])
+        client, written = self.sync('month', [self.summary(date(2023, 11, 1), 'b', 10)])
+        self.assertEqual(written, 1)
+        self.assertEqual(client.job_configs[0].query_parameters[0].value, date(2023, 11, 1))
+        self.assertEqual(TermRollup.objects.get(period_start=date(2023, 11, 1)).days_at_rank_1, 10)
+        self.assertEqual(TermRollup.objects.count(), 2)
+
+    def test_auto_uses_the_coarsest_rollup_that_covers_the_range(self):
+        self.sync('month', [
+            self.summary(date(2023, 6, 1), 'a', 20),
+            self.summary(date(2023, 11, 1), 'b', 12, date(2023, 11, 30)),
+            self.summary(date(2023, 11, 1), 'c', 0, date(2023, 11, 30)),
+        ])
+        client = FakeBigQueryClient([])
+        response = self.get(client, '2023-06-01', '2023-11-30', 'auto')
+        self.assertEqual(response['X-Granularity'], 'month')
+        self.assertEqual([(row['Period'], row['Top_Term']) for row in response.json()],
+                         [('2023-11-01', 'b'), ('2023-06-01', 'a')])
+        self.assertEqual([query for query in client.queries if "INFORMATION_SCHEMA" not in query], [])
+
+    def test_partial_period_only_covers_the_days_it_summarized(self):
+        self.sync('month', [
+            self.summary(date(2023, 10, 1), 'a', 20, date(2023, 10, 31)),
+            self.summary(date(2023, 11, 1), 'b', 3, date(2023, 11, 15)),
+        ])
+        state = RollupSyncState.objects.get(table=bigQueryQueries.TOP_TERMS_TABLE, granularity='month')
+        self.assertEqual((state.first_period_start, state.last_refresh_date), (date(2023, 10, 1), date(2023, 11, 15)))
+        self.assertFalse(MirrorSyncState.objects.exists())
+        client = FakeBigQueryClient([{'Period': date(2023, 11, 1), 'Top_Term': 'b', 'days_at_rank_1': 10}])
+        response = self.get(client, '2023-10-01', '2023-11-15', 'month')
+        self.assertEqual(response.json()[0]['days_at_rank_1'], 3)
+        # The days of November after the sync are summarized by BigQuery
+        response = self.get(client, '2023-10-01', '2023-11-30', 'month')
+        self.assertEqual(response.json()[0]['days_at_rank_1'], 10)
+        self.assertIn("DATE_TRUNC(refresh_date, MONTH)", client.queries[-1])
+
+    def test_uncovered_range_is_summarized_by_bigquery(self):
+        client = FakeBigQueryClient([{'Period': date(2023, 10, 30), 'Top_Term': 'a', 'days_at_rank_1': 3}])
+        response = self.get(client, '2023-10-01', '2023-11-15', 'week')
+        self.assertEqual(response['X-Granularity'], 'week')
+        self.assertIn("DATE_TRUNC(refresh_date, WEEK(MONDAY))", client.queries[-1])
+        # Short ranges keep the daily rows
+        response = self.get(client, '2023-11-01', '2023-11-05', 'auto')
+        self.assertNotIn('X-Granularity', response)
+        self.assertEqual(self.get(client, '2023-11-01', '2023-11-05', 'year').status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class HttpCachingTests(TestCase):
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+        bigQueryQueries.cost_guard.estimates.clear()
+        patcher = mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=LRUCacheBackend(max_entries=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bigquery = FakeBigQueryClient([{'Top_Term': 'a', 'rank': 1}])
+        self.url = reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-01'])
+
+    def get(self, url=None, **headers):
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=self.bigquery):
+            return self.client.get(url or self.url, **headers)
+
+    def data_queries(self):
+        return [query for query in self.bigquery.queries if "INFORMATION_SCHEMA" not in query]
+
+    def test_validators_and_cache_control(self):
+        response = self.get()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertEqual(response['Last-Modified'], 'Mon, 20 Nov 2023 00:00:00 GMT')
+        self.assertIn('stale-while-revalidate=86400', response['Cache-Control'])
+        self.assertIn('max-age=300', response['Cache-Control'])
+
+    def test_if_none_match_is_answered_without_running_the_query(self):
+        etag = self.get()['ETag']
+        self.bigquery.queries.clear()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.data_queries(), [])
+        # Another ETag gets the data
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"').status_code, status.HTTP_200_OK)
+
+    def test_if_modified_since_follows_the_watermark(self):
+        response = self.get(HTTP_IF_MODIFIED_SINCE='Mon, 20 Nov 2023 00:00:00 GMT')
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(self.data_queries(), [])
+        response = self.get(HTTP_IF_MODIFIED_SINCE='Sun, 19 Nov 2023 00:00:00 GMT')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_representations_have_their_own_etag(self):
+        json_etag = self.get()['ETag']
+        columnar = self.get(self.url + '?format=columnar', HTTP_IF_NONE_MATCH=json_etag)
+        self.assertEqual(columnar.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(columnar['ETag'], json_etag)
+
+    def test_errors_are_not_cached(self):
+        self.bigquery.rows = []
+        response = self.get()
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertNotIn('ETag', response)
+
+
+
+class ResponseCompressionTests(TestCase):
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+        bigQueryQueries.cost_guard.estimates.clear()
+        patcher = mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=LRUCacheBackend(max_entries=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.rows = [{'Top_Term': f'term {i}', 'rank': i} for i in range(100)]
+        self.bigquery = FakeBigQueryClient(self.rows)
+        self.url = reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-01'])
+
+    def get(self, **extra):
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=self.bigquery):
+            response = self.client.get(self.url, **extra)
+            body = b"".join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_choose_encoding(self):
+        self.assertEqual(choose_encoding('gzip, deflate'), 'gzip')
+        self.assertEqual(choose_encoding('gzip;q=0, identity'), None)
+        self.assertEqual(choose_encoding(''), None)
+        if import_brotli() is not None:
+            self.assertEqual(choose_encoding('gzip, deflate, br'), 'br')
+            self.assertEqual(choose_encoding('br;q=0.5, gzip'), 'gzip')
+
+    def test_gzip_response(self):
+        response, body = self.get(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(body)), self.rows)
+        # The ETag of the uncompressed body is weak for the compressed one
+        self.assertTrue(response['ETag'].startswith('W/"'))
+
+    def test_brotli_response(self):
+        brotli = import_brotli()
+        if brotli is None:
+            self.skipTest("brotli is not installed")
+        response, body = self.get(HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(brotli.decompress(body)), self.rows)
+
+    def test_uncompressed_without_accept_encoding(self):
+        response, body = self.get()
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(json.loads(body), self.rows)
+
+    def test_weak_etag_revalidates(self):
+        response, _ = self.get(HTTP_ACCEPT_ENCODING='gzip')
+        revalidated, _ = self.get(HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(revalidated['ETag'], response['ETag'])
+
+    def test_streamed_response_is_compressed(self):
+        response, body = self.get(HTTP_ACCEPT_ENCODING='gzip', data={'stream': 'ndjson'})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        lines = zlib.decompress(body, 31).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], self.rows)
+
+    def test_small_response_is_not_compressed(self):
+        self.bigquery.rows = [{'Top_Term': 'a', 'rank': 1}]
+        response, _ = self.get(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_dumps(self):
+        data = {'day': date(2023, 11, 1), 'value': Decimal('1.5'), 'term': 'café'}
+        self.assertEqual(json.loads(dumps(data)), {'day': '2023-11-01', 'value': '1.5', 'term': 'café'})
+        self.assertNotIn(b' ', dumps({'a': [1, 2]}))
+
+    def test_drf_responses_are_compact(self):
+        Query.objects.create(name='q', query='http://localhost/api/bigquery/get/countries', username='ana', query_comment='c')
+        response = self.client.get(reverse('db-queries-endpoint'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn(b'", "', response.content)
+        self.assertEqual(response.json()[0]['name'], 'q')
+
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+        bigQueryQueries.cost_guard.estimates.clear()
+        patcher = mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=LRUCacheBackend(max_entries=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bigquery = FakeBigQueryClient([{'Top_Term': 'a', 'rank': 1}], bytes_processed=2048)
+        self.url = reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-01'])
+
+    def get(self):
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=self.bigquery):
+            return self.client.get(self.url)
+
+    def test_server_timing(self):
+        timing = self.get()['Server-Timing']
+        self.assertIn('bq-exec;dur=2000.0', timing)
+        self.assertIn('bq-queue;dur=1000.0', timing)
+        self.assertIn('cache;desc="miss"', timing)
+        self.assertIn('serialize;dur=', timing)
+        self.assertIn('total;dur=', timing)
+        # The second request is answered from the result cache
+        self.bigquery.queries.clear()
+        self.assertIn('cache;desc="hit"', self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"')['Server-Timing'])
+
+    def test_counters(self):
+        requests_before = queryMetrics.http_requests.value(
+            endpoint='bigquery-top-terms-day-endpoint', method='GET', status=200,
+        )
+        billed_before = queryMetrics.bigquery_bytes_billed.value()
+        misses_before = queryMetrics.result_cache_lookups.value(result='miss')
+        self.get()
+        self.assertEqual(queryMetrics.http_requests.value(
+            endpoint='bigquery-top-terms-day-endpoint', method='GET', status=200,
+        ), requests_before + 1)
+        self.assertEqual(queryMetrics.bigquery_bytes_billed.value(), billed_before + 10485760)
+        self.assertEqual(queryMetrics.result_cache_lookups.value(result='miss'), misses_before + 1)
+
+    def test_day_and_range_are_labelled_apart(self):
+        range_url = reverse('bigquery-top-terms-dates-endpoint', args=['Colombia', '2023-11-01', '2023-11-02'])
+        day_before = queryMetrics.http_requests.value(endpoint='bigquery-top-terms-day-endpoint', method='GET', status=200)
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=self.bigquery):
+            self.client.get(range_url)
+        self.assertEqual(queryMetrics.http_requests.value(
+            endpoint='bigquery-top-terms-day-endpoint', method='GET', status=200,
+        ), day_before)
+        self.assertGreater(queryMetrics.http_requests.value(
+            endpoint='bigquery-top-terms-dates-endpoint', method='GET', status=200,
+        ), 0)
+        # Deadlines are keyed by the same names
+        resilience = {'DEADLINE': 15, 'DEADLINES': {'bigquery-top-terms-dates-endpoint': 30}}
+        with self.settings(BIGQUERY_RESILIENCE=resilience):
+            request = RequestFactory().get(range_url)
+            request.resolver_match = resolve(range_url)
+            self.assertEqual(queryResilience.get_endpoint_deadline(request), 30)
+            request = RequestFactory().get(self.url)
+            request.resolver_match = resolve(self.url)
+            self.assertEqual(queryResilience.get_endpoint_deadline(request), 15)
+
+    def test_errors_are_counted(self):
+        errors_before = queryMetrics.bigquery_errors.value(error='RuntimeError')
+        with mock.patch.object(bigQueryQueries, 'submit_query', side_effect=RuntimeError("down")):
+            response = self.get()
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(queryMetrics.bigquery_errors.value(error='RuntimeError'), errors_before + 1)
+
+    def test_metrics_endpoint(self):
+        self.get()
+        response = self.client.get(reverse('metrics-endpoint'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+        self.assertIn('http_requests_total{endpoint="bigquery-top-terms-day-endpoint",method="GET",status="200"}', body)
+        self.assertIn('bigquery_job_execution_seconds_bucket{le="+Inf"}', body)
+        self.assertIn('bigquery_bytes_billed_total ', body)
+
+    def test_metrics_can_be_disabled(self):
+        with self.settings(METRICS={'ENABLED': False}):
+            self.assertEqual(self.client.get(reverse('metrics-endpoint')).status_code, status.HTTP_404_NOT_FOUND)
+
+
+
+class CacheWarmingTests(TestCase):
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+        bigQueryQueries.cost_guard.estimates.clear()
+        patcher = mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=LRUCacheBackend(max_entries=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tracker = cacheWarming.HitTracker(flush_interval=3600)
+        patcher = mock.patch.object(cacheWarming, 'get_tracker', return_value=self.tracker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bigquery = FakeBigQueryClient([{'Top_Term': 'a', 'rank': 1}], watermark=date(2023, 11, 20))
+        patcher = mock.patch.object(bigQueryQueries, 'get_client', return_value=self.bigquery)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def data_queries(self):
+        return [query for query in self.bigquery.queries if "INFORMATION_SCHEMA" not in query]
+
+    def test_requests_are_counted(self):
+        url = reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-19'])
+        self.client.get(url)
+        self.client.get(url)
+        self.client.get(reverse('bigquery-countries-top-terms-endpoint'))
+        self.assertEqual(self.tracker.flush(), 1)
+        hot_query, = cacheWarming.hot_queries()
+        self.assertEqual((hot_query.path, hot_query.hits), (url, 2))
+        self.assertEqual(hot_query.params, {'country_name': 'Colombia', 'date': '2023-11-19'})
+
+    def test_hot_queries_are_ranked_by_hits_in_the_window(self):
+        old = reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-01'])
+        new = reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-19'])
+        for _ in range(3):
+            self.tracker.track(old, 'bigquery-top-terms-day-endpoint', {'country_name': 'Colombia', 'date': '2023-11-01'})
+        self.tracker.track(new, 'bigquery-top-terms-day-endpoint', {'country_name': 'Colombia', 'date': '2023-11-19'})
+        self.tracker.flush()
+        self.assertEqual([hot_query.path for hot_query in cacheWarming.hot_queries()], [old, new])
+
+        # The hits of the days that left the window no longer count, even for URLs requested since
+        HotQueryDay.objects.filter(hot_query__path=old).update(day=date.today() - timedelta(days=30))
+        self.tracker.track(old, 'bigquery-top-terms-day-endpoint', {'country_name': 'Colombia', 'date': '2023-11-01'})
+        self.tracker.track(new, 'bigquery-top-terms-day-endpoint', {'country_name': 'Colombia', 'date': '2023-11-19'})
+        self.tracker.flush()
+        self.assertEqual([(hot_query.path, hot_query.hits) for hot_query in cacheWarming.hot_queries()],
+                         [(new, 2), (old, 1)])
+        self.assertEqual(HotQueryDay.objects.count(), 2)
+
+    def test_command_keeps_the_warmed_watermarks(self):
+        url = reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-19'])
+        self.tracker.track(url, 'bigquery-top-terms-day-endpoint', {'country_name': 'Colombia', 'date': '2023-11-19'})
+        call_command('warm_trends_cache', stdout=io.StringIO())
+        warmed = WarmedWatermark.objects.get()
+        self.assertEqual((warmed.table, warmed.watermark), (bigQueryQueries.TOP_TERMS_TABLE, date(2023, 11, 20)))
+        self.assertFalse(MirrorSyncState.objects.exists())
+
+    def test_advance_params(self):
+        previous, current = date(2023, 11, 19), date(2023, 11, 20)
+        self.assertEqual(cacheWarming.advance_params({'country_name': 'Colombia', 'date': '2023-11-19'}, previous, current),
+                         {'country_name': 'Colombia', 'date': '2023-11-20'})
+        self.assertEqual(
+            cacheWarming.advance_params(
+                {'country_name': 'Colombia', 'init_date': '2023-11-01', 'finish_date': '2023-11-19'}, previous, current,
+            ),
+            {'country_name': 'Colombia', 'init_date': '2023-11-02', 'finish_date': '2023-11-20'},
+        )
+        self.assertIsNone(cacheWarming.advance_params({'date': '2023-11-01'}, previous, current))
+        self.assertIsNone(cacheWarming.advance_params({'date': '2023-11-19'}, None, current))
+
+    def test_hot_queries_are_warmed_when_the_watermark_moves(self):
+        url = reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-19'])
+        self.tracker.track(url, 'bigquery-top-terms-day-endpoint', {'country_name': 'Colombia', 'date': '2023-11-19'})
+        watermarks = {bigQueryQueries.TOP_TERMS_TABLE: date(2023, 11, 19)}
+        outcomes = cacheWarming.check_and_warm(watermarks)
+        # The hot URL and the same URL at the new watermark
+        self.assertEqual(outcomes[cacheWarming.WARMED], 2)
+        self.assertEqual(watermarks[bigQueryQueries.TOP_TERMS_TABLE], date(2023, 11, 20))
+
+        # Both are now answered from the cache
+        self.bigquery.queries.clear()
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        self.client.get(reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-20']))
+        self.assertEqual(self.data_queries(), [])
+
+        # Nothing is warmed again until the watermark moves
+        self.assertEqual(sum(cacheWarming.check_and_warm(watermarks).values()), 0)
+        # The requests above were counted too
+        self.assertEqual(cacheWarming.check_and_warm(watermarks, force=True)[cacheWarming.CACHED], 2)
+
+    def test_watermark_is_kept_when_every_warm_up_fails(self):
+        url = reverse('bigquery-top-terms-dates-endpoint', args=['Colombia', '2023-11-01', '2023-11-19'])
+        self.tracker.track(url, 'bigquery-top-terms-dates-endpoint',
+                           {'country_name': 'Colombia', 'init_date': '2023-11-01', 'finish_date': '2023-11-19'})
+        watermarks = {bigQueryQueries.TOP_TERMS_TABLE: date(2023, 11, 19)}
+        with mock.patch.object(bigQueryQueries, 'run_query', side_effect=RuntimeError("down")):
+            self.assertEqual(cacheWarming.check_and_warm(watermarks)[cacheWarming.FAILED], 2)
+        self.assertEqual(watermarks[bigQueryQueries.TOP_TERMS_TABLE], date(2023, 11, 19))
+
+        # The next check warms them again, including the date range at the new watermark
+        self.assertEqual(cacheWarming.check_and_warm(watermarks)[cacheWarming.WARMED], 2)
+        self.assertEqual(watermarks[bigQueryQueries.TOP_TERMS_TABLE], date(2023, 11, 20))
+        self.bigquery.queries.clear()
+        self.client.get(reverse('bigquery-top-terms-dates-endpoint', args=['Colombia', '2023-11-02', '2023-11-20']))
+        self.assertEqual(self.data_queries(), [])
+
+    def test_date_ranges_are_tracked(self):
+        self.client.get(reverse('bigquery-top-terms-dates-endpoint', args=['Colombia', '2023-11-01', '2023-11-19']))
+        self.tracker.flush()
+        hot_query, = cacheWarming.hot_queries()
+        self.assertEqual(hot_query.endpoint, 'bigquery-top-terms-dates-endpoint')
+
+
+class BenchmarkTests(TransactionTestCase):
+    # The benchmark threads only see committed rows
+
+    def setUp(self):
+        self.replay = ReplayClient(latency=0.02)
+        overrides = override_settings(BIGQUERY_CLIENT={'FACTORY': lambda: self.replay})
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        for reset in (get_client_manager().reset, reset_query_cache, bigQueryQueries.table_metadata.clear):
+            reset()
+            self.addCleanup(reset)
+
+    def test_every_route_has_a_scenario(self):
+        self.assertEqual(benchmarks.missing_scenarios(), [])
+
+    def test_replay_client(self):
+        query = "SELECT term AS Top_Term, rank FROM t WHERE refresh_date = @date"
+        params = [bigquery.ScalarQueryParameter('date', 'DATE', date(2023, 11, 20))]
+        job = self.replay.query(query, job_config=bigquery.QueryJobConfig(query_parameters=params))
+        self.assertFalse(job.done())
+        rows = job.result()
+        self.assertTrue(job.done())
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(set(rows[0]), {'Top_Term', 'rank'})
+
+        # Recorded rows are replayed instead of synthetic ones
+        recorded = ReplayClient(recordings={make_cache_key(query, params): [{'Top_Term': 'recorded', 'rank': 1}]})
+        job = recorded.query(query, job_config=bigquery.QueryJobConfig(query_parameters=params))
+        self.assertEqual(list(job.result()), [{'Top_Term': 'recorded', 'rank': 1}])
+
+    def test_run_benchmark(self):
+        routes = [
+            'api/bigquery/get/top_terms_day/<str:country_name>/<str:date>',
+            'api/db/get/query/<int:query_id>',
+            'api/bigquery/jobs/<str:job_id>',
+        ]
+        report = benchmarks.run_benchmark(routes, requests=4, concurrency=2, memory_requests=1)
+        self.assertEqual(list(report['endpoints']), routes)
+        for result in report['endpoints'].values():
+            self.assertEqual(result['statuses'], {'200': 4})
+            self.assertEqual(result['errors'], 0)
+            self.assertEqual(set(result['latency_ms']), {'p50', 'p95', 'p99', 'mean', 'max'})
+            self.assertGreater(result['requests_per_second'], 0)
+            self.assertGreater(result['memory_bytes_per_request']['mean'], 0)
+        # The first request of the day waits for its replayed job, the next ones are cached
+        self.assertGreaterEqual(report['endpoints'][routes[0]]['latency_ms']['max'], 20)
+
+        comparison = benchmarks.compare_reports(report, report)
+        self.assertEqual(comparison[routes[0]]['p95'], 0)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(
+            [benchmarks.percentile(values, fraction) for fraction in (0.5, 0.95, 0.99)], [50, 95, 99],
+        )
+        self.assertIsNone(benchmarks.percentile([], 0.5))
+
+
+@override_settings(BIGQUERY_RESILIENCE={'RETRIES': 2, 'RETRY_BASE_DELAY': 0, 'BREAKER_FAILURES': 2, 'DEADLINE': 5})
+class ResilienceTests(TestCase):
+    def setUp(self):
+        bigQueryQueries.table_metadata.clear()
+        bigQueryQueries.cost_guard.estimates.clear()
+        queryResilience.bigquery_breaker.reset()
+        self.addCleanup(queryResilience.bigquery_breaker.reset)
+        patcher = mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=LRUCacheBackend(max_entries=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bigquery = FakeBigQueryClient([{'Top_Term': 'a', 'rank': 1}])
+        patcher = mock.patch.object(bigQueryQueries, 'get_client', return_value=self.bigquery)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.url = reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-11-20'])
+
+    def test_retryable_errors_are_retried(self):
+        unavailable = google_exceptions.ServiceUnavailable("backend unavailable")
+        jobs = [unavailable, unavailable, FakeQueryJob([{'Top_Term': 'a', 'rank': 1}])]
+        # Every failed attempt counts towards opening the breaker
+        with self.settings(BIGQUERY_RESILIENCE={'RETRY_BASE_DELAY': 0, 'BREAKER_FAILURES': 3}), \
+                mock.patch.object(bigQueryQueries, 'submit_query', side_effect=jobs) as submit_query:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(submit_query.call_count, 3)
+        self.assertEqual(queryResilience.bigquery_breaker.state, queryResilience.CLOSED)
+
+    def test_invalid_queries_are_not_retried(self):
+        with mock.patch.object(bigQueryQueries, 'submit_query',
+                               side_effect=google_exceptions.BadRequest("Syntax error")) as submit_query:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(submit_query.call_count, 1)
+        self.assertEqual(queryResilience.bigquery_breaker.failures, 0)
+
+    def test_deadline_cancels_the_job(self):
+        job = ReplayJob([], latency=5, total_bytes_processed=0)
+        with self.settings(BIGQUERY_RESILIENCE={'DEADLINE': 0.1}), \
+                mock.patch.object(bigQueryQueries, 'submit_query', return_value=job):
+            started = time.monotonic()
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertTrue(job.cancelled)
+
+    def test_stale_results_are_served_while_bigquery_fails(self):
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+        # The table is refreshed, and BigQuery starts failing
+        self.bigquery.watermark = date(2023, 11, 21)
+        bigQueryQueries.table_metadata.clear()
+        with mock.patch.object(bigQueryQueries, 'submit_query',
+                               side_effect=google_exceptions.ServiceUnavailable("unavailable")) as submit_query:
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.json(), [{'Top_Term': 'a', 'rank': 1}])
+            self.assertEqual(response[queryResilience.STALE_HEADER], 'true')
+            self.assertNotIn('ETag', response)
+            self.assertEqual(queryResilience.bigquery_breaker.state, queryResilience.OPEN)
+
+            # The open breaker fails queries without running them
+            calls = submit_query.call_count
+            self.assertEqual(self.client.get(self.url)[queryResilience.STALE_HEADER], 'true')
+            response = self.client.get(reverse('bigquery-top-terms-day-endpoint', args=['Mexico', '2023-11-20']))
+            self.assertEqual(submit_query.call_count, calls)
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn('Retry-After', response)
+
+    def test_open_breaker_skips_the_dry_run(self):
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+        # The results leave the cache and BigQuery starts hanging with the breaker open
+        query, query_params, table = bigQueryQueries.BigQueryTopTermsDay.build_query(
+            country_name='Colombia', date='2023-11-20',
+        )
+        bigQueryQueries.get_query_cache().delete(
+            make_cache_key(query, query_params, bigQueryQueries.fetch_watermark(table)),
+        )
+        bigQueryQueries.cost_guard.estimates.clear()
+        for _ in range(2):
+            queryResilience.bigquery_breaker.record_failure()
+        with self.settings(BIGQUERY_RESILIENCE={'DEADLINE': 0.5, 'BREAKER_FAILURES': 2}), \
+                mock.patch.object(self.bigquery, 'query', side_effect=lambda *args, **kwargs: time.sleep(3)) as query:
+            started = time.monotonic()
+            stale = self.client.get(self.url)
+            unavailable = self.client.get(reverse('bigquery-top-terms-day-endpoint', args=['Mexico', '2023-11-20']))
+            elapsed = time.monotonic() - started
+        self.assertEqual(stale[queryResilience.STALE_HEADER], 'true')
+        self.assertEqual(unavailable.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(query.call_count, 0)
+
+    def test_jobs_and_dry_runs_are_sent_within_the_deadline(self):
+        with self.settings(BIGQUERY_RESILIENCE={'DEADLINE': 0.5}), \
+                mock.patch.object(self.bigquery, 'query', wraps=self.bigquery.query) as query:
+            self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+        timeouts = [call.kwargs['timeout'] for call in query.call_args_list]
+        # The metadata query, the dry run and the query
+        self.assertEqual(len(timeouts), 3)
+        self.assertTrue(all(0 < timeout <= 0.5 for timeout in timeouts))
+
+    def test_background_and_saved_queries_go_through_the_breaker(self):
+        from query_builder_backend.queryExecution import execute_saved_query
+        from query_builder_backend.queryJobs import QueryJob
+        saved_query = Query.objects.create(name="Colombia", query=self.url, username="ana", query_comment="")
+        query, query_params, table = bigQueryQueries.BigQueryTopTermsDay.build_query(
+            country_name='Colombia', date='2023-11-20',
+        )
+        bigQueryQueries.fetch_watermark(table)
+        for _ in range(2):
+            queryResilience.bigquery_breaker.record_failure()
+        with mock.patch.object(bigQueryQueries, 'submit_query') as submit_query:
+            with self.assertRaises(queryResilience.CircuitOpen):
+                bigQueryQueries.run_job_query(QueryJob('test'), query, query_params, table)
+            with self.settings(BIGQUERY_COST={'DRY_RUN': False}), self.assertRaises(queryResilience.CircuitOpen):
+                execute_saved_query(saved_query)
+        submit_query.assert_not_called()
+
+    def test_circuit_breaker_lets_one_trial_through(self):
+        breaker = queryResilience.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        with self.assertRaises(queryResilience.CircuitOpen):
+            breaker.before_call()
+        time.sleep(0.06)
+        breaker.before_call()
+        with self.assertRaises(queryResilience.CircuitOpen):
+            breaker.before_call()
+        breaker.record_success()
+        self.assertEqual(breaker.state, queryResilience.CLOSED)
+
+    def test_metadata_is_served_while_bigquery_fails(self):
+        metadata = bigQueryQueries.table_metadata.get(bigQueryQueries.TOP_TERMS_TABLE)
+        with self.settings(BIGQUERY_METADATA={'REFRESH_INTERVAL': 0}), \
+                mock.patch.object(self.bigquery, 'query', side_effect=google_exceptions.ServiceUnavailable("down")), \
+                self.assertLogs('query_builder_backend.trendsMetadata', 'WARNING'):
+            self.assertIs(bigQueryQueries.table_metadata.get(bigQueryQueries.TOP_TERMS_TABLE), metadata)
+        # The partition metadata is still used
+        self.assertFalse(bigQueryQueries.table_metadata._partitions_unavailable)
+
+    async def test_async_deadline_cancels_the_job(self):
+        from query_builder_backend.asyncBigQueryQueries import wait_for_job
+        job = FakeQueryJob([], polls=1000)
+        job.cancel = mock.Mock()
+        with self.settings(BIGQUERY_ASYNC={'POLL_INTERVAL': 0.01, 'MAX_POLL_INTERVAL': 0.01}), \
+                queryResilience.deadline(0.05):
+            with self.assertRaises(queryResilience.DeadlineExceeded):
+                await wait_for_job(job)
+        job.cancel.assert_called_once()
+
+
+class StartupTests(TestCase):
+    def test_urlconf_does_not_import_bigquery(self):
+        report = benchmarks.run_startup_benchmark(['setup', 'urlconf'], repeat=1)
+        for result in report['phases'].values():
+            self.assertEqual(result['heavy_modules'], [])
+            self.assertGreater(result['process_ms']['p50'], result['django_ms']['p50'])
+        comparison = benchmarks.compare_startup_reports(report, report)
+        self.assertEqual(comparison['urlconf']['process_ms'], 0)
+
+    def test_preload(self):
+        timings = startup.preload()
+        self.assertIn('google.cloud.bigquery', timings)
+        self.assertIn(settings.ROOT_URLCONF, timings)
+        self.assertIs(bigQueryClient.bigquery.QueryJobConfig, bigquery.QueryJobConfig)
+
+    def test_warm_up_warms_the_client_in_the_background(self):
+        manager = mock.Mock()
+        with self.settings(STARTUP={'PRELOAD': False}, BIGQUERY_CLIENT={'WARM_ON_STARTUP': True}), \
+                mock.patch.object(startup, 'get_client_manager', return_value=manager), \
+                mock.patch.object(startup, 'start_scheduler') as start_scheduler:
+            startup.warm_up().join()
+        manager.warm.assert_called_once_with()
+        start_scheduler.assert_called_once_with()
+
+        with self.settings(STARTUP={'PRELOAD': False}, BIGQUERY_CLIENT={'WARM_ON_STARTUP': False}), \
+                mock.patch.object(startup, 'start_scheduler'):
+            self.assertIsNone(startup.warm_up())
+
+    def test_warm_up_on_import_can_be_turned_off(self):
+        with mock.patch.object(startup, 'warm_up') as warm_up:
+            with self.settings(STARTUP={'WARM_UP_ON_IMPORT': False}):
+                self.assertIsNone(startup.warm_up_on_import())
+            warm_up.assert_not_called()
+            startup.warm_up_on_import()
+            warm_up.assert_called_once_with()
+            # The gunicorn hook warms up every worker
+            startup.post_fork(mock.Mock(), mock.Mock())
+            self.assertEqual(warm_up.call_count, 2)
+
+    def test_config_is_read_once(self):
+        self.assertIs(get_config(), get_config())
+        self.assertEqual(get_config().get('dataset_id'), bigQueryQueries.DATASET_ID)
+
+
+class QueryShapeTests(TestCase):
+    def setUp(self):
+        self.cache = LRUCacheBackend(max_entries=10)
+        bigQueryQueries.table_metadata.clear()
+        patcher = mock.patch.object(bigQueryQueries, 'get_query_cache', return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_dates_are_date_parameters_without_grouping(self):
+        for shape in queryShapes.shapes.values():
+            self.assertNotIn('GROUP BY', shape.sql)
+            self.assertTrue(shape.sql.strip().startswith('SELECT DISTINCT'))
+        query, params, table = bigQueryQueries.BigQueryTopTermsDate.build_query(
+            country_name='Colombia', init_date='2023-11-01', finish_date='2023-11-05',
+        )
+        self.assertIn('refresh_date BETWEEN @init_date AND @finish_date', query)
+        self.assertEqual([(param.name, param.type_) for param in params],
+                         [('init_date', 'DATE'), ('finish_date', 'DATE'), ('country_name', 'STRING')])
+        self.assertEqual(params[0].value, date(2023, 11, 1))
+        self.assertEqual(table, bigQueryQueries.TOP_TERMS_TABLE)
+
+    def test_invalid_date_is_400_without_a_query(self):
+        client = FakeBigQueryClient([])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            response = self.client.get(reverse('bigquery-top-terms-day-endpoint', args=['Colombia', '2023-13-01']))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), {'error': 'Invalid date: 2023-13-01'})
+        self.assertEqual(client.queries, [])
+
+    def test_declared_endpoint_is_cached_and_counted(self):
+        shape = queryShapes.QueryShape(
+            'test_top_term', bigQueryQueries.TOP_TERMS_TABLE,
+            columns=[('term', 'Top_Term')],
+            filters=[queryShapes.Constant('rank', 1), queryShapes.Equals('refresh_date', 'date', param_type='DATE')],
+        )
+        view = type('TopTermView', (bigQueryQueries.BigQueryShapeView,), {'shape': shape}).as_view()
+        client = FakeBigQueryClient([{'Top_Term': 'term'}])
+        with mock.patch.object(bigQueryQueries, 'get_client', return_value=client):
+            for _ in range(2):
+                response = view(RequestFactory().get('/top_term'), date='2023-11-01')
+        self.assertEqual(json.loads(response.content), [{'Top_Term': 'term'}])
+        self.assertEqual(len([query for query in client.queries if 'Top_Term' in query]), 1)
+        self.assertEqual(queryShapes.shape_requests.value(shape='test_top_term', source=queryShapes.QUERY), 2)
+
+    def test_shape_names_are_unique(self):
+        shape = queryShapes.get_shape('top_terms_day')
+        self.assertIs(queryShapes.register(shape), shape)
+        with self.assertRaises(ValueError):
+            queryShapes.register(queryShapes.QueryShape('top_terms_day', 'other.table', ['term'], []))
@@ -0,0 +1,136 @@
+"""
+Analytics over a range of the Google Trends tables.
+
+The rows of a range (one per country, day and term) are loaded into a pandas
+DataFrame once, from the Arrow table of the query results, and every metric is
+computed with vectorized operations instead of looping over the rows:
+
+- persistence: for each country and term, the days it was in the top terms,
+  the first and last day it was seen, its longest and current streak of
+  consecutive days, and its best, mean and standard deviation of rank.
+- overlap: for each pair of countries, the terms they share in the range and
+  the Jaccard index of their sets of terms.
+
+numpy and pandas are imported by the functions that use them, so that loading
+the endpoints does not load them.
+"""
+from .bigQueryClient import bigquery
+
+# Columns of the rows the metrics are computed from
+ANALYTICS_COLUMNS = ['country_name', 'Day', 'term', 'rank']
+
+
+def build_range_query(table, countries, init_date, finish_date):
+    """
+    Build the query that reads the rows of a range, one per country, day and term.
+
+    :param table: The fully qualified table name.
+    :param countries: The countries to read.
+    :param init_date: The first day of the range, as a date.
+    :param finish_date: The last day of the range, as a date.
+    :return: The query and its parameters.
+    """
+    query = f"""
+        SELECT
+            country_name,
+            refresh_date AS Day,
+            term,
+            MIN(rank) AS rank
+         FROM `{table}`
+        WHERE
+            country_name IN UNNEST(@countries)
+            AND
+            refresh_date BETWEEN @init_date AND @finish_date
+        GROUP BY country_name, Day, term
+    """
+    return query, [
+        bigquery.ArrayQueryParameter("countries", "STRING", countries),
+        bigquery.ScalarQueryParameter("init_date", "DATE", init_date),
+        bigquery.ScalarQueryParameter("finish_date", "DATE", finish_date),
+    ]
+
+
+def persistence(frame, last_day):
+    """
+    Compute how long every term stayed in the top terms of every country.
+
+    :param frame: A DataFrame with the ANALYTICS_COLUMNS, one row per country, day and term.
+    :param last_day: The last day of the range, the current streaks are the ones that reach it.
+    :return: A list of dictionaries, one per country and term, sorted by country and by days present.
+    """
+    import numpy as np
+    import pandas as pd
+
+    frame = frame.sort_values(['country_name', 'term', 'Day'], ignore_index=True)
+    days = pd.to_datetime(frame['Day']).to_numpy().astype('datetime64[D]').astype(np.int64)
+    group = frame.groupby(['country_name', 'term'], sort=False).ngroup().to_numpy()
+
+    # A streak starts on the first row of a term or after a day without it
+    new_streak = np.ones(len(frame), dtype=bool)
+    new_streak[1:] = (group[1:] != group[:-1]) | (np.diff(days) != 1)
+    streak_id = np.cumsum(new_streak)
+    frame['streak'] = np.bincount(streak_id)[streak_id]
+
+    metrics = frame.groupby(['country_name', 'term'], sort=False).agg(
+        days_present=('Day', 'size'),
+        first_seen=('Day', 'min'),
+        last_seen=('Day', 'max'),
+        longest_streak=('streak', 'max'),
+        last_streak=('streak', 'last'),
+        best_rank=('rank', 'min'),
+        mean_rank=('rank', 'mean'),
+        rank_std=('rank', 'std'),
+    ).reset_index()
+
+    # The last streak of a term is only current if it reaches the end of the range
+    metrics['current_streak'] = np.where(metrics['last_seen'] == last_day, metrics['last_streak'], 0)
+    metrics['mean_rank'] = metrics['mean_rank'].round(2)
+    # The rank of a term seen on a single day does not vary
+    metrics['rank_std'] = metrics['rank_std'].fillna(0.0).round(2)
+    metrics = metrics.drop(columns='last_streak').sort_values(
+        ['country_name', 'days_present', 'best_rank'], ascending=[True, False, True],
+    )
+    return metrics.to_dict('records')
+
+
+def overlap(frame):
+    """
+    Compute how many terms every pair of countries shares over the range.
+
+    :param frame: A DataFrame with the ANALYTICS_COLUMNS.
+    :return: A dictionary with the number of terms of each country, the shared terms and Jaccard index
+        of each pair of countries, and the terms every country had.
+    """
+    import numpy as np
+    import pandas as pd
+
+    # One row per term and one column per country, true if the country had the term
+    presence = pd.crosstab(frame['term'], frame['country_name']).gt(0)
+    countries = list(presence.columns)
+    matrix = presence.to_numpy(dtype=np.int64)
+    shared = matrix.T @ matrix
+    sizes = np.diag(shared)
+    union = sizes[:, None] + sizes[None, :] - shared
+    jaccard = np.divide(shared, union, out=np.zeros(shared.shape), where=union > 0)
+
+    first, second = np.triu_indices(len(countries), k=1)
+    return {
+        'countries': countries,
+        'terms_per_country': {country: int(size) for country, size in zip(countries, sizes)},
+        'pairs': [
+            {
+                'countries': [countries[i], countries[j]],
+                'shared_terms': int(shared[i, j]),
+                'jaccard': round(float(jaccard[i, j]), 4),
+            }
+            for i, j in zip(first, second)
+        ],
+        'terms_in_all_countries': sorted(presence.index[presence.all(axis=1)]),
+    }
+
+
+# Metrics that can be requested, by name
+ANALYTICS_METRICS = {
+    'persistence': lambda frame, init_date, finish_date: persistence(frame, finish_date),
+    'overlap': lambda frame, init_date, finish_date: overlap(frame),
+}
@@ -0,0 +1,281 @@
+"""
+Metadata of the Google Trends tables: the range of refresh dates they have and
+the countries available on the latest one.
+
+The date bounds are read from the partition metadata of the table
+(INFORMATION_SCHEMA.PARTITIONS), which does not scan the table, and kept in
+memory for one refresh cycle. A MIN/MAX scan is only used when the partition
+metadata is not available. The countries are read once per refresh date.
+
+The metadata queries go through the circuit breaker and the retries of
+queryResilience. When the metadata cannot be read again, the last one read is
+served for ERROR_RETRY_INTERVAL more seconds, so that cached results stay
+reachable while BigQuery is failing.
+"""
+import logging
+import threading
+import time
+from datetime import date, datetime
+from django.conf import settings
+from .bigQueryClient import bigquery
+from .queryResilience import CircuitOpen, call_with_retries, is_upstream_failure, job_result, remaining_time
+from .singleFlight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Default configuration of the metadata service, overridable with settings.BIGQUERY_METADATA
+DEFAULT_METADATA_SETTINGS = {
+    'REFRESH_INTERVAL': 60 * 5,
+    'ERROR_RETRY_INTERVAL': 30,
+}
+
+
+def get_metadata_settings():
+    """
+    Get the metadata settings merged over the defaults.
+
+    :return: A dictionary with the metadata settings.
+    """
+    return {**DEFAULT_METADATA_SETTINGS, **getattr(settings, 'BIGQUERY_METADATA', {})}
+
+
+class TableMetadata:
+    """
+    Refresh date bounds of a table and when they were read.
+    """
+
+    def __init__(self, min_refresh_date, max_refresh_date, source, fetched_at=None):
+        """
+        :param min_refresh_date: The first refresh date the table has data for.
+        :param max_refresh_date: The last refresh date the table has data for.
+        :param source: Where the bounds were read from, 'partitions' or 'scan'.
+        :param fetched_at: The time the bounds were read, as a timestamp.
+        """
+        self.min_refresh_date = min_refresh_date
+        self.max_refresh_date = max_refresh_date
+        self.source = source
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+
+    def age(self):
+        """
+        :return: The number of seconds since the bounds were read.
+        """
+        return time.time() - self.fetched_at
+
+    def to_dict(self):
+        """
+        :return: The bounds and their freshness as a JSON-serializable dictionary.
+        """
+        return {
+            'min_refresh_date': self.min_refresh_date,
+            'max_refresh_date': self.max_refresh_date,
+            'fetched_at': datetime.fromtimestamp(self.fetched_at).isoformat(),
+            'age_seconds': int(self.age()),
+            'source': self.source,
+        }
+
+
+def split_table(table):
+    """
+    Split a fully qualified table name into its dataset and table name.
+
+    :param table: The fully qualified table name, [project.]dataset.table.
+    :return: The dataset, with its project if given, and the table name.
+    """
+    dataset, table_name = table.rsplit('.', 1)
+    return dataset, table_name
+
+
+def parse_partition_date(value):
+    """
+    Turn a bound read from the partition metadata into a date.
+
+    :param value: A date, or a YYYYMMDD partition id.
+    :return: The date, or None.
+    """
+    if value is None or isinstance(value, date):
+        return value
+    return datetime.strptime(value, '%Y%m%d').date()
+
+
+class TableMetadataService:
+    """
+    Keeps the metadata of each table in memory and refreshes it once per refresh cycle.
+    """
+
+    def __init__(self, client_getter, refresh_interval=None):
+        """
+        :param client_getter: A callable that returns the BigQuery client.
+        :param refresh_interval: How long the metadata is served before being read again, in seconds.
+        """
+        self.client_getter = client_getter
+        self.refresh_interval = refresh_interval
+        self._metadata = {}
+        self._countries = {}
+        self._partitions_unavailable = set()
+        self._retry_at = {}
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+
+    def get_refresh_interval(self):
+        if self.refresh_interval is not None:
+            return self.refresh_interval
+        return get_metadata_settings()['REFRESH_INTERVAL']
+
+    def get(self, table):
+        """
+        Get the metadata of a table, reading it again if it is older than the refresh interval.
+
+        :param table: The fully qualified table name.
+        :return: The TableMetadata of the table.
+        """
+        with self._lock:
+            metadata = self._metadata.get(table)
+            retry_at = self._retry_at.get(table, 0)
+        if metadata is not None and (metadata.age() < self.get_refresh_interval() or time.monotonic() < retry_at):
+            return metadata
+        try:
+            return self._flights.do(('bounds', table), lambda: self.refresh(table))
+        except Exception:
+            if metadata is None:
+                raise
+            # Serve the last metadata while BigQuery is failing, and try again later
+            logger.warning("Could not read the metadata of %s, serving the last one", table, exc_info=True)
+            with self._lock:
+                self._retry_at[table] = time.monotonic() + get_metadata_settings()['ERROR_RETRY_INTERVAL']
+            return metadata
+
+    def refresh(self, table):
+        """
+        Read the metadata of a table from BigQuery.
+
+        :param table: The fully qualified table name.
+        :return: The new TableMetadata of the table.
+        """
+        metadata = None
+        if table not in self._partitions_unavailable:
+            try:
+                metadata = self._read_partitions(table)
+            except Exception as e:
+                if is_upstream_failure(e) or isinstance(e, CircuitOpen):
+                    # BigQuery is failing, not the partition metadata
+                    raise
+                # Without access to the partition metadata, scan the table from now on
+                logger.warning("Partition metadata of %s is not available, scanning it instead", table, exc_info=True)
+                self._partitions_unavailable.add(table)
+        if metadata is None:
+            metadata = self._scan(table)
+        with self._lock:
+            self._metadata[table] = metadata
+        return metadata
+
+    def _read(self, query, job_config=None):
+        """
+        Run a metadata query through the circuit breaker, retrying it on retryable errors within the deadline.
+
+        :param query: The query.
+        :param job_config: The QueryJobConfig with its parameters, if any.
+        :return: The list of rows.
+        """
+        return call_with_retries(lambda: list(job_result(
+            self.client_getter().query(query, job_config=job_config, timeout=remaining_time()),
+        )))
+
+    def _read_partitions(self, table):
+        """
+        Read the date bounds of a table from its partition metadata.
+
+        :param table: The fully qualified table name.
+        :return: The TableMetadata, or None if the table is not partitioned by day.
+        """
+        dataset, table_name = split_table(table)
+        query = f"""
+            SELECT
+                MIN(partition_id) AS min_refresh_date,
+                MAX(partition_id) AS max_refresh_date
+             FROM `{dataset}.INFORMATION_SCHEMA.PARTITIONS`
+            WHERE
+                table_name = @table_name
+                AND
+                partition_id NOT IN ('__NULL__', '__UNPARTITIONED__')
+                AND
+                total_rows > 0
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("table_name", "STRING", table_name),
+        ])
+        rows = self._read(query, job_config)
+        if not rows or rows[0]['max_refresh_date'] is None:
+            return None
+        return TableMetadata(
+            parse_partition_date(rows[0]['min_refresh_date']),
+            parse_partition_date(rows[0]['max_refresh_date']),
+            'partitions',
+        )
+
+    def _scan(self, table):
+        """
+        Read the date bounds of a table with a MIN/MAX scan of its refresh_date column.
+
+        :param table: The fully qualified table name.
+        :return: The TableMetadata.
+        """
+        query = f"""
+            SELECT
+                MIN(refresh_date) AS min_refresh_date,
+                MAX(refresh_date) AS max_refresh_date
+             FROM `{table}`
+        """
+        rows = self._read(query)
+        row = rows[0] if rows else {'min_refresh_date': None, 'max_refresh_date': None}
+        return TableMetadata(row['min_refresh_date'], row['max_refresh_date'], 'scan')
+
+    def get_countries(self, table):
+        """
+        Get the countries a table has data for on its latest refresh date.
+        They are only read again when the refresh date moves forward.
+
+        :param table: The fully qualified table name.
+        :return: The TableMetadata of the table and the sorted list of country names.
+        """
+        metadata = self.get(table)
+        key = (table, metadata.max_refresh_date)
+        with self._lock:
+            countries = self._countries.get(key)
+        if countries is None:
+            countries = self._flights.do(('countries',) + key, lambda: self._read_countries(*key))
+        return metadata, countries
+
+    def _read_countries(self, table, max_refresh_date):
+        """
+        Read the countries of a table on a refresh date, reading only that partition.
+
+        :param table: The fully qualified table name.
+        :param max_refresh_date: The refresh date.
+        :return: The sorted list of country names.
+        """
+        query = f"""
+            SELECT DISTINCT country_name
+             FROM `{table}`
+            WHERE refresh_date = @refresh_date
+            ORDER BY country_name
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("refresh_date", "DATE", max_refresh_date),
+        ])
+        countries = [row['country_name'] for row in self._read(query, job_config)]
+        with self._lock:
+            # Only keep the countries of the latest refresh date of each table
+            self._countries = {key: value for key, value in self._countries.items() if key[0] != table}
+            self._countries[(table, max_refresh_date)] = countries
+        return countries
+
+    def clear(self):
+        """
+        Forget the metadata of every table.
+        """
+        with self._lock:
+            self._metadata.clear()
+            self._countries.clear()
+            self._partitions_unavailable.clear()
+            self._retry_at.clear()
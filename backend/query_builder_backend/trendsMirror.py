@@ -0,0 +1,230 @@
+"""
+Local mirror of the Google Trends tables.
+
+The sync stage copies the refresh_date partitions that are newer than the last
+synced one from BigQuery into the local database. The BigQuery endpoints answer
+from the mirror when it covers the requested dates and fall back to BigQuery
+otherwise.
+"""
+from datetime import date, timedelta
+from itertools import islice
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max, Min
+from .bigQueryClient import bigquery
+from .models import MirrorSyncState, TopRisingTermMirror, TopTermMirror
+
+# Default configuration of the mirror, overridable with settings.TRENDS_MIRROR
+DEFAULT_MIRROR_SETTINGS = {
+    'ENABLED': False,
+    'INITIAL_DAYS': 30,
+    'BATCH_SIZE': 5000,
+}
+
+# Columns copied from each kind of table
+MIRROR_COLUMNS = {
+    TopTermMirror: ['refresh_date', 'country_name', 'term', 'rank'],
+    TopRisingTermMirror: ['refresh_date', 'country_name', 'term', 'rank', 'percent_gain'],
+}
+
+
+def get_mirror_settings():
+    """
+    Get the mirror settings merged over the defaults.
+
+    :return: A dictionary with the mirror settings.
+    """
+    return {**DEFAULT_MIRROR_SETTINGS, **getattr(settings, 'TRENDS_MIRROR', {})}
+
+
+def sync_table(client, table, model, since=None):
+    """
+    Copy the partitions of a BigQuery table newer than the last synced one into the mirror.
+
+    :param client: The BigQuery client.
+    :param table: The fully qualified table name.
+    :param model: The mirror model of the table.
+    :param since: Re-sync every partition from this date on, replacing the mirrored rows.
+    :return: The number of rows copied.
+    """
+    mirror_settings = get_mirror_settings()
+    state, _ = MirrorSyncState.objects.get_or_create(table=table)
+
+    # Only copy the partitions after the last synced one
+    if since is None and state.max_refresh_date is not None:
+        first_date = state.max_refresh_date + timedelta(days=1)
+    elif since is not None:
+        first_date = since
+    elif mirror_settings['INITIAL_DAYS'] is not None:
+        first_date = date.today() - timedelta(days=mirror_settings['INITIAL_DAYS'])
+    else:
+        first_date = date.min
+
+    # The tables have one row per region and week, keep the distinct daily rows
+    columns = ", ".join(MIRROR_COLUMNS[model])
+    query = f"""
+        SELECT {columns}
+        FROM `{table}`
+        WHERE refresh_date >= @first_date
+        GROUP BY {columns}
+    """
+    query_job = client.query(
+        query,
+        job_config=bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("first_date", "DATE", first_date),
+        ]),
+    )
+    rows = (
+        model(**{column: row[column] for column in MIRROR_COLUMNS[model]})
+        for row in query_job.result()
+    )
+
+    copied = 0
+    with transaction.atomic():
+        # Drop the partitions that are being synced again
+        model.objects.filter(refresh_date__gte=first_date).delete()
+        # Write the rows in batches
+        while True:
+            batch = list(islice(rows, mirror_settings['BATCH_SIZE']))
+            if not batch:
+                break
+            model.objects.bulk_create(batch)
+            copied += len(batch)
+
+        # Record the dates the mirror covers
+        bounds = model.objects.aggregate(min_refresh_date=Min('refresh_date'), max_refresh_date=Max('refresh_date'))
+        state.min_refresh_date = bounds['min_refresh_date']
+        state.max_refresh_date = bounds['max_refresh_date']
+        state.save()
+    return copied
+
+
+def parse_date(value):
+    """
+    Parse a date received from the API.
+
+    :param value: The date as a YYYY-MM-DD string.
+    :return: The date, or None if it is not valid.
+    """
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def covers(table, first_date, last_date):
+    """
+    Check whether the mirror of a table has the given dates.
+
+    :param table: The fully qualified table name.
+    :param first_date: The first date needed.
+    :param last_date: The last date needed.
+    :return: True if the mirror is enabled and covers the range.
+    """
+    if not get_mirror_settings()['ENABLED'] or first_date is None or last_date is None:
+        return False
+    state = MirrorSyncState.objects.filter(table=table).first()
+    if state is None or state.min_refresh_date is None:
+        return False
+    return state.min_refresh_date <= first_date and last_date <= state.max_refresh_date
+
+
+def watermark(table):
+    """
+    Get the latest refresh date the mirror of a table has.
+
+    :param table: The fully qualified table name.
+    :return: The date, or None if the mirror is disabled or the table was never synced.
+    """
+    if not get_mirror_settings()['ENABLED']:
+        return None
+    state = MirrorSyncState.objects.filter(table=table).first()
+    return state.max_refresh_date if state is not None else None
+
+
+def top_terms_day(table, country_name, day):
+    """
+    Get the top terms of a day from the mirror.
+
+    :param table: The fully qualified top terms table.
+    :param country_name: The country to get the top terms from.
+    :param day: The date to get the top terms from.
+    :return: The rows, the same as the BigQuery endpoint, or None if the mirror does not cover the day.
+    """
+    day = parse_date(day)
+    if not covers(table, day, day):
+        return None
+    return list(
+        TopTermMirror.objects
+        .filter(country_name=country_name, refresh_date=day)
+        .annotate(Top_Term=F('term'))
+        .values('Top_Term', 'rank')
+        .order_by('rank')
+    )
+
+
+def top_terms_dates(table, country_name, init_date, finish_date):
+    """
+    Get the top term of each day in a range from the mirror.
+
+    :param table: The fully qualified top terms table.
+    :param country_name: The country to get the top terms from.
+    :param init_date: The initial date of the range.
+    :param finish_date: The final date of the range.
+    :return: The rows, the same as the BigQuery endpoint, or None if the mirror does not cover the range.
+    """
+    init_date, finish_date = parse_date(init_date), parse_date(finish_date)
+    if not covers(table, init_date, finish_date):
+        return None
+    return list(
+        TopTermMirror.objects
+        .filter(country_name=country_name, rank=1, refresh_date__range=(init_date, finish_date))
+        .annotate(Day=F('refresh_date'), Top_Term=F('term'))
+        .values('Day', 'Top_Term')
+        .distinct()
+        .order_by('-refresh_date')
+    )
+
+
+def top_rising_terms_day(table, country_name, day):
+    """
+    Get the top rising terms of a day from the mirror.
+
+    :param table: The fully qualified top rising terms table.
+    :param country_name: The country to get the top rising terms from.
+    :param day: The date to get the top rising terms from.
+    :return: The rows, the same as the BigQuery endpoint, or None if the mirror does not cover the day.
+    """
+    day = parse_date(day)
+    if not covers(table, day, day):
+        return None
+    return list(
+        TopRisingTermMirror.objects
+        .filter(country_name=country_name, refresh_date=day)
+        .annotate(Top_Term=F('term'))
+        .values('Top_Term', 'rank', 'percent_gain')
+        .order_by('rank')
+    )
+
+
+def top_rising_terms_dates(table, country_name, init_date, finish_date):
+    """
+    Get the top rising term of each day in a range from the mirror.
+
+    :param table: The fully qualified top rising terms table.
+    :param country_name: The country to get the top rising terms from.
+    :param init_date: The initial date of the range.
+    :param finish_date: The final date of the range.
+    :return: The rows, the same as the BigQuery endpoint, or None if the mirror does not cover the range.
+    """
+    init_date, finish_date = parse_date(init_date), parse_date(finish_date)
+    if not covers(table, init_date, finish_date):
+        return None
+    return list(
+        TopRisingTermMirror.objects
+        .filter(country_name=country_name, rank=1, refresh_date__range=(init_date, finish_date))
+        .annotate(Day=F('refresh_date'), Top_Term=F('term'))
+        .values('Day', 'Top_Term', 'percent_gain')
+        .distinct()
+        .order_by('-refresh_date')
+    )
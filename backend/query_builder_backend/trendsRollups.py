@@ -0,0 +1,307 @@
+"""
+Weekly and monthly rollups of the Google Trends tables.
+
+The rollup stage summarizes the daily rows of each country and term per week
+and per month (days present, days at rank 1, best and mean rank, and the
+largest percent gain of the rising terms) into the local database. The range
+endpoints answer long ranges from the coarsest rollup that covers them instead
+of reading every daily row from BigQuery. Ranges a rollup does not cover are
+summarized by BigQuery with the same query.
+
+The periods of a rollup are whole: a range is widened to the start of the week
+or month of its first day and to the end of the week or month of its last day.
+"""
+from datetime import date, timedelta
+from itertools import islice
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Min
+from .bigQueryClient import bigquery
+from .models import RollupSyncState, TermRollup
+
+# Default configuration of the rollups, overridable with settings.TRENDS_ROLLUPS
+DEFAULT_ROLLUP_SETTINGS = {
+    'ENABLED': False,
+    'INITIAL_DAYS': 365,
+    'BATCH_SIZE': 5000,
+    'WEEKLY_MIN_DAYS': 31,
+    'MONTHLY_MIN_DAYS': 180,
+}
+
+# Granularities of the rollups, from the finest to the coarsest, with their BigQuery date part
+GRANULARITIES = {
+    'week': 'WEEK(MONDAY)',
+    'month': 'MONTH',
+}
+
+# Columns of the rollup rows returned by the range endpoints
+ROLLUP_VALUES = ['Period', 'Top_Term', 'days_at_rank_1', 'days_present', 'best_rank', 'mean_rank']
+
+
+def get_rollup_settings():
+    """
+    Get the rollup settings merged over the defaults.
+
+    :return: A dictionary with the rollup settings.
+    """
+    return {**DEFAULT_ROLLUP_SETTINGS, **getattr(settings, 'TRENDS_ROLLUPS', {})}
+
+
+def period_start(day, granularity):
+    """
+    :param day: A date.
+    :param granularity: 'week' or 'month'.
+    :return: The first day of the week (Monday) or month of the date.
+    """
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def rollup_select(table, granularity, with_percent_gain, where):
+    """
+    Build the query that summarizes the daily rows of a table per country, period and term.
+
+    :param table: The fully qualified table name.
+    :param granularity: 'week' or 'month'.
+    :param with_percent_gain: Whether the table has a percent_gain column.
+    :param where: The condition on the daily rows.
+    :return: The query.
+    """
+    date_part = GRANULARITIES[granularity]
+    percent_gain = ", percent_gain" if with_percent_gain else ""
+    max_percent_gain = "MAX(percent_gain)" if with_percent_gain else "CAST(NULL AS INT64)"
+    # The tables have one row per region, keep the distinct daily rows first
+    return f"""
+        SELECT
+            country_name,
+            DATE_TRUNC(refresh_date, {date_part}) AS period_start,
+            term,
+            COUNT(*) AS days_present,
+            COUNTIF(rank = 1) AS days_at_rank_1,
+            MIN(rank) AS best_rank,
+            AVG(rank) AS mean_rank,
+            {max_percent_gain} AS max_percent_gain,
+            MAX(refresh_date) AS last_refresh_date
+         FROM (
+            SELECT DISTINCT refresh_date, country_name, term, rank{percent_gain}
+             FROM `{table}`
+            WHERE {where}
+         )
+        GROUP BY country_name, period_start, term
+    """
+
+
+def build_range_query(table, granularity, with_percent_gain, country_name, init_date, finish_date):
+    """
+    Build the query that answers a range endpoint at a granularity directly on BigQuery.
+
+    :param table: The fully qualified table name.
+    :param granularity: 'week' or 'month'.
+    :param with_percent_gain: Whether the table has a percent_gain column.
+    :param country_name: The country to get the terms from.
+    :param init_date: The first day of the range, as a date.
+    :param finish_date: The last day of the range, as a date.
+    :return: The query and its parameters, with the same rows as range_rows.
+    """
+    date_part = GRANULARITIES[granularity]
+    summary = rollup_select(
+        table, granularity, with_percent_gain,
+        f"""country_name = @country_name
+                AND
+                refresh_date BETWEEN DATE_TRUNC(@init_date, {date_part}) AND LAST_DAY(@finish_date, {date_part})""",
+    )
+    percent_gain = ",\n            max_percent_gain" if with_percent_gain else ""
+    query = f"""
+        SELECT
+            period_start AS Period,
+            term AS Top_Term,
+            days_at_rank_1,
+            days_present,
+            best_rank,
+            ROUND(mean_rank, 2) AS mean_rank{percent_gain}
+         FROM ({summary})
+        WHERE days_at_rank_1 > 0
+        ORDER BY Period DESC, days_at_rank_1 DESC, Top_Term
+    """
+    query_params = [
+        bigquery.ScalarQueryParameter("country_name", "STRING", country_name),
+        bigquery.ScalarQueryParameter("init_date", "DATE", init_date),
+        bigquery.ScalarQueryParameter("finish_date", "DATE", finish_date),
+    ]
+    return query, query_params
+
+
+def sync_rollup(client, table, granularity, with_percent_gain, since=None):
+    """
+    Summarize the daily rows of a BigQuery table into a rollup, from the last synced period on.
+    The last synced period is summarized again, since it may have been incomplete. The sync state
+    records the first period of the rollup and the last refresh date it summarized.
+
+    :param client: The BigQuery client.
+    :param table: The fully qualified table name.
+    :param granularity: 'week' or 'month'.
+    :param with_percent_gain: Whether the table has a percent_gain column.
+    :param since: Summarize every period from the one of this date on, replacing the stored ones.
+    :return: The number of rows written.
+    """
+    rollup_settings = get_rollup_settings()
+    state, _ = RollupSyncState.objects.get_or_create(table=table, granularity=granularity)
+
+    if since is not None:
+        first_date = since
+    elif state.last_refresh_date is not None:
+        first_date = state.last_refresh_date
+    elif rollup_settings['INITIAL_DAYS'] is not None:
+        first_date = date.today() - timedelta(days=rollup_settings['INITIAL_DAYS'])
+    else:
+        first_date = date.min
+    first_date = period_start(first_date, granularity)
+
+    query_job = client.query(
+        rollup_select(table, granularity, with_percent_gain, "refresh_date >= @first_date"),
+        job_config=bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("first_date", "DATE", first_date),
+        ]),
+    )
+    # The last daily rows summarized, up to which the last period is complete
+    last_refresh_date = state.last_refresh_date
+
+    def read_rows():
+        nonlocal last_refresh_date
+        for row in query_job.result():
+            if last_refresh_date is None or row['last_refresh_date'] > last_refresh_date:
+                last_refresh_date = row['last_refresh_date']
+            yield TermRollup(
+                table=table,
+                granularity=granularity,
+                period_start=row['period_start'],
+                country_name=row['country_name'],
+                term=row['term'],
+                days_present=row['days_present'],
+                days_at_rank_1=row['days_at_rank_1'],
+                best_rank=row['best_rank'],
+                mean_rank=row['mean_rank'],
+                max_percent_gain=row['max_percent_gain'],
+            )
+
+    rows = read_rows()
+
+    written = 0
+    rollups = TermRollup.objects.filter(table=table, granularity=granularity)
+    with transaction.atomic():
+        # Drop the periods that are being summarized again
+        rollups.filter(period_start__gte=first_date).delete()
+        # Write the rows in batches
+        while True:
+            batch = list(islice(rows, rollup_settings['BATCH_SIZE']))
+            if not batch:
+                break
+            TermRollup.objects.bulk_create(batch)
+            written += len(batch)
+
+        # Record the first period the rollup covers and the last day it summarized
+        state.first_period_start = rollups.aggregate(first_period_start=Min('period_start'))['first_period_start']
+        state.last_refresh_date = last_refresh_date if state.first_period_start is not None else None
+        state.save()
+    return written
+
+
+def choose_granularity(requested, init_date, finish_date):
+    """
+    Pick the granularity of a range request.
+
+    :param requested: The granularity query parameter: None or 'day' for daily rows, 'week', 'month',
+        or 'auto' for the coarsest one the length of the range calls for.
+    :param init_date: The first day of the range, as a date.
+    :param finish_date: The last day of the range, as a date.
+    :return: 'day', 'week' or 'month'.
+    :raises ValueError: If the granularity is not known.
+    """
+    if requested in (None, '', 'day'):
+        return 'day'
+    if requested in GRANULARITIES:
+        return requested
+    if requested != 'auto':
+        raise ValueError(f"Unknown granularity: {requested}")
+    rollup_settings = get_rollup_settings()
+    days = (finish_date - init_date).days + 1
+    if days >= rollup_settings['MONTHLY_MIN_DAYS']:
+        return 'month'
+    if days >= rollup_settings['WEEKLY_MIN_DAYS']:
+        return 'week'
+    return 'day'
+
+
+def covers(table, granularity, init_date, finish_date):
+    """
+    Check whether a rollup has the periods of a range, summarized up to its last day at least.
+    A period summarized before all its days were published only covers the ranges that end
+    by the last day it summarized.
+
+    :param table: The fully qualified table name.
+    :param granularity: 'week' or 'month'.
+    :param init_date: The first day of the range.
+    :param finish_date: The last day of the range.
+    :return: True if the rollups are enabled and the rollup covers the range.
+    """
+    if not get_rollup_settings()['ENABLED']:
+        return False
+    state = RollupSyncState.objects.filter(table=table, granularity=granularity).first()
+    if state is None or state.first_period_start is None:
+        return False
+    return (state.first_period_start <= period_start(init_date, granularity)
+            and state.last_refresh_date is not None and finish_date <= state.last_refresh_date)
+
+
+def range_rows(table, granularity, with_percent_gain, country_name, init_date, finish_date):
+    """
+    Get the terms that were at rank 1 in each period of a range from a rollup.
+
+    :param table: The fully qualified table name.
+    :param granularity: 'week' or 'month'.
+    :param with_percent_gain: Whether to include the largest percent gain of each term.
+    :param country_name: The country to get the terms from.
+    :param init_date: The first day of the range, as a date.
+    :param finish_date: The last day of the range, as a date.
+    :return: The rows, the same as build_range_query, or None if the rollup does not cover the range.
+    """
+    if not covers(table, granularity, init_date, finish_date):
+        return None
+    values = ROLLUP_VALUES + (['max_percent_gain'] if with_percent_gain else [])
+    rows = list(
+        TermRollup.objects
+        .filter(
+            table=table,
+            granularity=granularity,
+            country_name=country_name,
+            days_at_rank_1__gt=0,
+            period_start__range=(period_start(init_date, granularity), period_start(finish_date, granularity)),
+        )
+        .annotate(Period=F('period_start'), Top_Term=F('term'))
+        .values(*values)
+        .order_by('-period_start', '-days_at_rank_1', 'term')
+    )
+    for row in rows:
+        row['mean_rank'] = round(row['mean_rank'], 2)
+    return rows
+
+
+def coarsest_rollup_rows(table, granularity, with_percent_gain, country_name, init_date, finish_date):
+    """
+    Get the rows of a range from the coarsest rollup that covers it, no coarser than a granularity.
+
+    :param table: The fully qualified table name.
+    :param granularity: The coarsest granularity the request accepts, 'week' or 'month'.
+    :param with_percent_gain: Whether to include the largest percent gain of each term.
+    :param country_name: The country to get the terms from.
+    :param init_date: The first day of the range, as a date.
+    :param finish_date: The last day of the range, as a date.
+    :return: The granularity used and its rows, or the granularity and None if no rollup covers the range.
+    """
+    candidates = list(GRANULARITIES)[:list(GRANULARITIES).index(granularity) + 1]
+    for candidate in reversed(candidates):
+        rows = range_rows(table, candidate, with_percent_gain, country_name, init_date, finish_date)
+        if rows is not None:
+            return candidate, rows
+    return granularity, None
@@ -7,22 +7,25 @@ const proxy = config.proxy;
 
 const Comments = () => {
   const [comments, setComments] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const router = useRouter();
   const { id } = router.query;
 
+  // Fetch a page of comments and append it to the list, null for the first one
+  const fetchData = async (cursor) => {
+    try {
+      const params = cursor ? { cursor } : {};
+      const response = await axios.get(proxy + '/api/db/get/comments/' + id, { params });
+      setComments(previous => cursor ? [...previous, ...response.data] : response.data);
+      setNextCursor(response.headers['x-next-cursor'] || null);
+    } catch (error) {
+      console.error('Error fetching queries:', error);
+    }
+  };
+
   useEffect(() => {
     // Fetch data when the component mounts
-    const fetchData = async () => {
-      try {
-        const response = await axios.get(proxy + '/api/db/get/comments/' + id);
-        console.log(response.data)
-        setComments(response.data); // Assuming the response is an array of queries
-      } catch (error) {
-        console.error('Error fetching queries:', error);
-      }
-    };
-
-    fetchData();
+    fetchData(null);
   }, []); // Empty dependency array ensures the effect runs only once when the component mounts
 
   return (
@@ -45,6 +48,9 @@ const Comments = () => {
           ))}
         </tbody>
       </table>
+      {nextCursor && (
+        <button onClick={() => fetchData(nextCursor)}>Load more</button>
+      )}
     </div>
   );
 };
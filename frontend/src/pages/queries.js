@@ -11,6 +11,26 @@ const Queries = ({ queries }) => {
   const router = useRouter();
   const [username, setUsername] = useState('');
   const [userQueries, setUserQueries] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+
+  /**
+   * Fetch a page of queries and append it to the list.
+   *
+   * @function
+   * @param {string|null} cursor - The cursor of the page, null for the first one.
+   */
+  const fetchQueries = (cursor) => {
+    const params = cursor ? { cursor } : {};
+    axios.get(`${proxy}/api/db/get/queries`, { params })
+      .then(response => {
+        // Append the page and remember where the next one starts
+        setUserQueries(previous => cursor ? [...previous, ...response.data] : response.data);
+        setNextCursor(response.headers['x-next-cursor'] || null);
+      })
+      .catch(error => {
+        console.error('Error fetching queries:', error);
+      });
+  };
 
   useEffect(() => {
     const { username } = router.query;
@@ -21,14 +41,8 @@ const Queries = ({ queries }) => {
 
     setUsername(username);
 
-    // Make a request to fetch queries
-    axios.get(`${proxy}/api/db/get/queries`)
-      .then(response => {
-        setUserQueries(response.data); // Assuming the API response is an array of objects
-      })
-      .catch(error => {
-        console.error('Error fetching queries:', error);
-      });
+    // Make a request to fetch the first page of queries
+    fetchQueries(null);
 
     return () => {
     };
@@ -55,6 +69,9 @@ const Queries = ({ queries }) => {
           </li>
         ))}
       </ul>
+      {nextCursor && (
+        <button onClick={() => fetchQueries(nextCursor)}>Load more</button>
+      )}
     </body>
   </div>
   );
@@ -28,6 +28,7 @@ const Query = () => {
     const [loading, setLoading] = useState(true); // Introduce loading state
     const [seeQuery, setSeeQuery] = useState(false);
     const [queryResult, setQueryResult] = useState([]);
+    const [nextCursor, setNextCursor] = useState(null);
 
     /**
      * Handle the change of the comment input
@@ -40,6 +41,28 @@ const Query = () => {
         setComment(event.target.value);
     };
 
+    /**
+     * Fetch a page of comments and append it to the list.
+     *
+     * @function
+     * @param {string} queryid - The id of the query.
+     * @param {string|null} cursor - The cursor of the page, null for the first one.
+     */
+    const fetchComments = (queryid, cursor) => {
+        const params = cursor ? { cursor } : {};
+        axios.get(`${proxy}/api/db/get/comments/${queryid}`, { params })
+                .then(response => {
+                    // Append the page and remember where the next one starts
+                    setComments(previous => cursor ? [...previous, ...response.data] : response.data);
+                    setNextCursor(response.headers['x-next-cursor'] || null);
+                    setLoading(false); // Set loading to false after fetching comments
+                })
+                .catch(error => {
+                    console.error('Error fetching comments:', error);
+                    setLoading(false); // Set loading to false on error
+                });
+    };
+
     /**
      * Handle the sending of a comment
      * 
@@ -115,16 +138,8 @@ const handleUseQuery = async () => {
                 console.error('Error fetching queries:', error);
                 setLoading(false); // Set loading to false on error
             });
-        // Fetch the comments
-        axios.get(`${proxy}/api/db/get/comments/${queryid}`)
-                .then(response => {
-                    setComments(response.data);
-                    setLoading(false); // Set loading to false after fetching comments
-                })
-                .catch(error => {
-                    console.error('Error fetching comments:', error);
-                    setLoading(false); // Set loading to false on error
-                });
+        // Fetch the first page of comments
+        fetchComments(queryid, null);
     }, []);
 
     // Render the component when both query and comments data are available
@@ -166,6 +181,9 @@ const handleUseQuery = async () => {
                             <li key={index}>{comment.username}: {comment.comment_text}</li>
                         ))}
                     </ul>
+                    {nextCursor && (
+                        <button onClick={() => fetchComments(query.id, nextCursor)}>Load more</button>
+                    )}
                 </div>
                 </div>
             )}